@@ -42,6 +42,9 @@ DATABASES = {
         'HOST': '',                         # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                         # Set to empty string for default. Not used with sqlite3.
         'TEST_NAME': 'test_database',
+        # Client options such as REPLICASET or MAX_POOL_SIZE, they are also
+        # used by the shared client of raw database accesses
+        'OPTIONS': {},
     }
 }
 
@@ -221,9 +224,12 @@ MARKETPLACE_PASSWORD = 'store_conwet'
 
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 
-# Daily job that checks pending pay-per-use charges
+# Daily job that checks pending pay-per-use charges and jobs that process
+# the due CDRs and invoices when no web process is running their workers
 CRONJOBS = [
     ('0 5 * * *', 'django.core.management.call_command', ['resolve_use_charging']),
+    ('*/10 * * * *', 'django.core.management.call_command', ['inspect_cdr_outbox'], {'flush': True}),
+    ('*/10 * * * *', 'django.core.management.call_command', ['inspect_invoice_queue'], {'flush': True}),
 ]
 
 # Hack to ignore `site` instance creation
@@ -244,6 +250,46 @@ PAYMENT_CLIENT = CLIENTS[PAYMENT_METHOD]
 
 RESOURCE_INDEX_DIR = path.join(DATADIR, path.join('admin', 'indexes'))
 
+# Search index updates made by purchases and reviews are queued and
+# committed in batches by a background writer, failed updates are retried
+# with an exponential backoff. A warning is logged when the index lags more
+# than SEARCH_INDEX_LAG_WARNING seconds behind the updates
+SEARCH_INDEX_ASYNC = not TESTING
+SEARCH_INDEX_BATCH_SIZE = 50
+SEARCH_INDEX_COMMIT_DELAY = 2.0
+SEARCH_INDEX_MAX_ATTEMPTS = 5
+SEARCH_INDEX_RETRY_DELAY = 5.0
+SEARCH_INDEX_LAG_WARNING = 60
+
+# CDRs are persisted in an outbox and delivered to the RSS in batches by
+# a pool of background workers, retrying with an exponential backoff
+CDR_OUTBOX_ASYNC = not TESTING
+CDR_OUTBOX_WORKERS = 2
+CDR_OUTBOX_BATCH_SIZE = 100
+CDR_OUTBOX_MAX_ATTEMPTS = 10
+CDR_OUTBOX_RETRY_DELAY = 30
+CDR_OUTBOX_POLL_INTERVAL = 10
+
+# Invoice PDFs are generated by a pool of background workers, the bill link
+# of the purchase is available when its generation job finishes
+INVOICE_ASYNC = not TESTING
+INVOICE_WORKERS = 2
+INVOICE_MAX_ATTEMPTS = 5
+INVOICE_RETRY_DELAY = 30
+INVOICE_POLL_INTERVAL = 10
+
+# Maximum number of SDRs accepted in a single accounting request
+SDR_BATCH_MAX_SIZE = 1000
+
+# Cache of search results, invalidated by each index commit. The backend
+# can be 'local', 'django' (using CACHE_ALIAS) or None to disable it
+SEARCH_RESULT_CACHE = {
+    'BACKEND': None if TESTING else 'local',
+    'SIZE': 1000,
+    'TTL': 300,
+    'CACHE_ALIAS': 'default'
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': True,
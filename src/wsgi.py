@@ -23,6 +23,13 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "FiwareStore.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Start the background workers of the queues, so the jobs left by previous
+# processes are processed without waiting for a new one
+from wstore.charging_engine.invoice_queue import start_invoice_pool
+from wstore.rss_adaptor.cdr_outbox import start_dispatcher
+start_invoice_pool()
+start_dispatcher()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
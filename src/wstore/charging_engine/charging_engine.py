@@ -23,10 +23,7 @@ from __future__ import absolute_import
 import os
 import json
 import time
-import codecs
-import subprocess
 import threading
-from pymongo import MongoClient
 from bson import ObjectId
 from urllib2 import HTTPError
 
@@ -45,9 +42,14 @@ from wstore.models import RSS
 from wstore.charging_engine.models import Contract
 from wstore.charging_engine.models import Unit
 from wstore.charging_engine.price_resolver import PriceResolver
+from wstore.charging_engine.service_records import append_sdrs, get_last_sdr, iter_pending_sdrs, \
+    update_oldest_pending_ts, get_last_correlation
+from wstore.charging_engine.usage_aggregation import get_usage, format_usage
+from wstore.charging_engine.invoice_queue import enqueue_invoice, get_invoice_name
 from wstore.store_commons.utils.usdlParser import USDLParser
+from wstore.store_commons.database import get_database_connection
 from wstore.contracting.purchase_rollback import rollback
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptorThread
+from wstore.rss_adaptor.cdr_outbox import enqueue_cdrs, record_reservation
 from wstore.rss_adaptor.utils.rss_codes import get_country_code, get_curency_code
 from wstore.rss_adaptor.expenditure_manager import ExpenditureManager
 
@@ -81,8 +83,7 @@ class ChargingEngine:
 
     def _timeout_handler(self):
 
-        connection = MongoClient()
-        db = connection[settings.DATABASES['default']['NAME']]
+        db = get_database_connection()
 
         # Uses an atomic operation to get and set the _lock value in the purchase
         # document
@@ -164,19 +165,29 @@ class ChargingEngine:
         else:
             raise Exception('Invalid payment method')
 
-    def _generate_cdr_part(self, part, model, cdr_info):
-        # Take and increment the correlation number using
-        # the mongoDB atomic access in order to avoid race
-        # problems
+    def _reserve_correlation_numbers(self, rss, count):
+        """
+        Reserves a block of consecutive correlation numbers of the RSS
+        returning the first one. The block is taken with a single mongoDB
+        atomic increment, so the numbers of a charge are contiguous and
+        concurrent charges never share a number. The reserved block is
+        recorded, a charge failing before its CDRs reach the outbox leaves
+        a gap that can be audited
+        """
         # Create connection for raw database access
-        connection = MongoClient()
-        db = connection[settings.DATABASES['default']['NAME']]
+        db = get_database_connection()
 
-        corr_number = db.wstore_rss.find_and_modify(
-            query={'_id': ObjectId(cdr_info['rss'].pk)},
-            update={'$inc': {'correlation_number': 1}}
+        first = db.wstore_rss.find_and_modify(
+            query={'_id': ObjectId(rss.pk)},
+            update={'$inc': {'correlation_number': count}}
         )['correlation_number']
 
+        record_reservation(rss, first, count, self._purchase.pk)
+
+        return first
+
+    def _generate_cdr_part(self, part, model, cdr_info):
+
         # Set the description
         currency = get_curency_code(part['currency'])
 
@@ -184,7 +195,6 @@ class ChargingEngine:
             'provider': cdr_info['provider'],
             'service': cdr_info['service_name'],
             'defined_model': model,
-            'correlation': str(corr_number),
             'purchase': self._purchase.pk,
             'offering': cdr_info['offering'],
             'product_class': cdr_info['product_class'],
@@ -247,7 +257,6 @@ class ChargingEngine:
             country_code = get_country_code(country_code)
 
             cdr_info = {
-                'rss': rss,
                 'provider': provider,
                 'service_name': service_name,
                 'offering': offering,
@@ -262,14 +271,18 @@ class ChargingEngine:
             # order to avoid a mismatch between the revenues being shared
             # and the real payment
 
+            # The parts of the CDRs are collected first so all the correlation
+            # numbers of the charge are reserved at once
+            cdr_parts = []
+
             if price:
                 # Create a payment part representing the whole payment
                 aggregated_part = {
                     'value': price,
                     'currency': self._price_model['general_currency']
                 }
-                cdr_info['description'] = 'Complete Charging event: ' + str(price) + ' ' + self._price_model['general_currency']
-                cdrs.append(self._generate_cdr(aggregated_part, 'Charging event', cdr_info))
+                description = 'Complete Charging event: ' + str(price) + ' ' + self._price_model['general_currency']
+                cdr_parts.append((aggregated_part, 'Charging event', description))
 
             else:
                 # Check the type of the applied parts
@@ -277,15 +290,15 @@ class ChargingEngine:
 
                     # A cdr is generated for every price part
                     for part in applied_parts['single_payment']:
-                        cdr_info['description'] = 'Single payment: ' + part['value'] + ' ' + part['currency']
-                        cdrs.append(self._generate_cdr_part(part, 'Single payment event', cdr_info))
+                        description = 'Single payment: ' + part['value'] + ' ' + part['currency']
+                        cdr_parts.append((part, 'Single payment event', description))
 
                 if 'subscription' in applied_parts:
 
                     # A cdr is generated by price part
                     for part in applied_parts['subscription']:
-                        cdr_info['description'] = 'Subscription: ' + part['value'] + ' ' + part['currency'] + ' ' + part['unit']
-                        cdrs.append(self._generate_cdr_part(part, 'Subscription event', cdr_info))
+                        description = 'Subscription: ' + part['value'] + ' ' + part['currency'] + ' ' + part['unit']
+                        cdr_parts.append((part, 'Subscription event', description))
 
                 if 'charges' in applied_parts:
 
@@ -295,22 +308,33 @@ class ChargingEngine:
                             'value': part['price'],
                         }
                         if 'price_function' in part['model']:
-                            cdr_info['description'] = part['model']['text_function']
+                            description = part['model']['text_function']
                             use_part['currency'] = self._price_model['general_currency']
                         else:
                             use_part['currency'] = part['model']['currency']
 
-                            # Calculate the total consumption
-                            use = 0
-                            for sdr in part['accounting']:
-                                use += int(sdr['value'])
-                            cdr_info['description'] = 'Fee per ' + part['model']['unit'] + ', Consumption: ' + str(use)
+                            # Get the total consumption
+                            use = format_usage(get_usage(part)['value'])
+                            description = 'Fee per ' + part['model']['unit'] + ', Consumption: ' + use
+
+                        cdr_parts.append((use_part, 'Pay per use event', description))
 
-                        cdrs.append(self._generate_cdr_part(use_part, 'Pay per use event', cdr_info))
+            # The CDRs are built before reserving their correlation numbers,
+            # so invalid parts do not consume numbers
+            for part, model, description in cdr_parts:
+                cdr_info['description'] = description
+                cdrs.append(self._generate_cdr_part(part, model, cdr_info))
 
-            # Send the created CDRs to the Revenue Sharing System
-            r = RSSAdaptorThread(rss, cdrs)
-            r.start()
+            if len(cdrs):
+                corr_number = self._reserve_correlation_numbers(rss, len(cdrs))
+
+                for cdr in cdrs:
+                    cdr['correlation'] = str(corr_number)
+                    corr_number += 1
+
+            # Store the created CDRs in the outbox, they are sent to the
+            # Revenue Sharing System by the outbox workers
+            enqueue_cdrs(rss, cdrs)
 
     def _generate_invoice(self, price, applied_parts, type_):
 
@@ -359,10 +383,8 @@ class ChargingEngine:
                         unit = model['unit']
                         value_unit = model['value']
 
-                        # Aggregate use made
-                        use = 0
-                        for sdr in part['accounting']:
-                            use += int(sdr['value'])
+                        # Get the use made
+                        use = format_usage(get_usage(part)['value'])
 
                     parts['use_parts'].append((model['title'], unit, value_unit, use, part['price']))
                     parts['use_subtotal'] += part['price']
@@ -383,10 +405,8 @@ class ChargingEngine:
                         unit = model['unit']
                         value_unit = model['value']
 
-                        # Aggregate use made
-                        use = 0
-                        for sdr in part['accounting']:
-                            use += int(sdr['value'])
+                        # Get the use made
+                        use = format_usage(get_usage(part)['value'])
 
                     parts['deduct_parts'].append((model['title'], unit, value_unit, use, part['price']))
                     parts['deduct_subtotal'] += part['price'] 
@@ -410,10 +430,8 @@ class ChargingEngine:
                     unit = model['unit']
                     value_unit = model['value']
 
-                    # Aggregate use made
-                    use = 0
-                    for sdr in part['accounting']:
-                        use += int(sdr['value'])
+                    # Get the use made
+                    use = format_usage(get_usage(part)['value'])
 
                 parts['use_parts'].append((model['title'], unit, value_unit, use, part['price']))
                 parts['use_subtotal'] += part['price']
@@ -434,10 +452,8 @@ class ChargingEngine:
                         unit = model['unit']
                         value_unit = model['value']
 
-                        # Aggregate use made
-                        use = 0
-                        for sdr in part['accounting']:
-                            use += int(sdr['value'])
+                        # Get the use made
+                        use = format_usage(get_usage(part)['value'])
 
                     parts['deduct_parts'].append((model['title'], unit, value_unit, use, part['price']))
                     parts['deduct_subtotal'] += part['price']
@@ -538,30 +554,10 @@ class ChargingEngine:
 
         bill_code = bill_template.render(Context(context))
 
-        # Create the bill code file
-        invoice_name = self._purchase.ref + '_' + date
-        bill_path = os.path.join(settings.BILL_ROOT, invoice_name + '.html')
-        f = codecs.open(bill_path, 'wb', 'utf-8')
-        f.write(bill_code)
-        f.close()
-
-        in_name = bill_path[:-4] + 'pdf'
-
-        if os.path.exists(in_name):
-            in_name = bill_path[:-5] + '_1.pdf'
-            invoice_name += '_1'
-
-        # Compile the bill file
-        try:
-            subprocess.call([settings.BASEDIR + '/create_invoice.sh', bill_path, in_name])
-        except:
-            raise Exception('Invoice generation problem')
-
-        # Remove temporal files
-        for file_ in os.listdir(settings.BILL_ROOT):
-
-            if not file_.endswith('.pdf'):
-                os.remove(os.path.join(settings.BILL_ROOT, file_))
+        # The PDF of the invoice is generated by the invoice workers, the
+        # bill link of the purchase is available when the job finishes
+        invoice_name = get_invoice_name(self._purchase, date)
+        enqueue_invoice(self._purchase, invoice_name, bill_code)
 
         # Load bill path into the purchase
         self._purchase.bill.append(os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name + '.pdf'))
@@ -683,7 +679,6 @@ class ChargingEngine:
         Contract.objects.create(
             pricing_model=price_model,
             charges=[],
-            applied_sdrs=[],
             purchase=self._purchase,
             revenue_class=revenue_class
         )
@@ -702,16 +697,24 @@ class ChargingEngine:
         renovation_date = datetime.fromtimestamp(renovation_date)
         return renovation_date
 
-    def include_sdr(self, sdr):
-        # Check the offering and customer
-        off_data = sdr['offering']
-        org = Organization.objects.get(name=off_data['organization'])
-        offering = Offering.objects.get(name=off_data['name'], owner_organization=org, version=off_data['version'])
+    def _check_sdr_offering(self, off_data, offerings):
+        # Offerings are cached by organization, name and version
+        # so they are only loaded once for each batch
+        key = (off_data['organization'], off_data['name'], off_data['version'])
+
+        if not key in offerings:
+            org = Organization.objects.get(name=off_data['organization'])
+            offerings[key] = Offering.objects.get(name=off_data['name'], owner_organization=org, version=off_data['version'])
 
-        if offering != self._purchase.offering:
+        if offerings[key] != self._purchase.offering:
             raise Exception('The offering defined in the SDR is not the purchase offering')
 
-        customer = User.objects.get(username=sdr['customer'])
+    def _check_sdr_customer(self, username, customers):
+        # Customers already checked in the batch are not loaded again
+        if username in customers:
+            return
+
+        customer = User.objects.get(username=username)
 
         if self._purchase.organization_owned:
             # Check if the user belongs to the organization
@@ -730,41 +733,9 @@ class ChargingEngine:
             if customer != self._purchase.customer:
                 raise Exception('The user has not purchased the offering')
 
-        # Extract the pricing model from the purchase
-        self._price_model = self._purchase.contract.pricing_model
-
-        if not 'pay_per_use' in self._price_model:
-            raise Exception('No pay per use parts in the pricing model of the offering')
-
-        # Check the correlation number and timestamp
-        applied_sdrs = self._purchase.contract.applied_sdrs
-        pending_sdrs = self._purchase.contract.pending_sdrs
-        last_corr = 0
-        last_time = 0
-
-        if len(pending_sdrs) > 0:
-            last_corr = int(pending_sdrs[-1]['correlation_number'])
-            last_time = pending_sdrs[-1]['time_stamp']
-            last_time = time.mktime(last_time.timetuple())
-        else:
-            if len(applied_sdrs) > 0:
-                last_corr = int(applied_sdrs[-1]['correlation_number'])
-                last_time = applied_sdrs[-1]['time_stamp']
-                last_time = time.mktime(last_time.timetuple())
-
-        try:
-            time_stamp = datetime.strptime(sdr['time_stamp'], '%Y-%m-%dT%H:%M:%S.%f')
-        except:
-            time_stamp = datetime.strptime(sdr['time_stamp'], '%Y-%m-%d %H:%M:%S.%f')
-
-        time_stamp_sec = time.mktime(time_stamp.timetuple())
-
-        if (int(sdr['correlation_number']) != last_corr + 1):
-            raise Exception('Invalid correlation number, expected: ' + str(last_corr + 1))
-
-        if last_time > time_stamp_sec:
-            raise Exception('Invalid time stamp')
+        customers.add(username)
 
+    def _check_sdr_model(self, sdr):
         # Check unit or component_label depending if the model defines components or 
         # price functions
         found_model = False
@@ -793,14 +764,72 @@ class ChargingEngine:
                             found_deduction = True
                             break
 
-        if found_model or found_deduction:
-            # Store the SDR
-            sdr['time_stamp'] = time_stamp
-            self._purchase.contract.pending_sdrs.append(sdr)
-        else:
+        if not found_model and not found_deduction:
             raise Exception('The specified unit or component label is not included in the pricing model')
 
-        self._purchase.contract.save()
+    def include_sdr(self, sdr):
+        self.include_sdrs([sdr])
+
+    def include_sdrs(self, sdrs):
+        """
+        Validates an ordered batch of SDRs and stores them as pending
+        SDRs of the contract. The batch is stored only if all its SDRs
+        are valid, using a single insert
+        """
+        if not len(sdrs):
+            raise Exception('No SDRs have been provided')
+
+        contract = self._purchase.contract
+
+        # Extract the pricing model from the purchase
+        self._price_model = contract.pricing_model
+
+        if not 'pay_per_use' in self._price_model:
+            raise Exception('No pay per use parts in the pricing model of the offering')
+
+        # Check the correlation number and timestamp
+        last_sdr = get_last_sdr(contract)
+        last_corr = 0
+        last_time = 0
+
+        if last_sdr is not None:
+            last_corr = int(last_sdr['correlation_number'])
+            last_time = time.mktime(last_sdr['time_stamp'].timetuple())
+
+        offerings = {}
+        customers = set()
+
+        for sdr in sdrs:
+            # Check the offering and customer
+            self._check_sdr_offering(sdr['offering'], offerings)
+            self._check_sdr_customer(sdr['customer'], customers)
+
+            try:
+                time_stamp = datetime.strptime(sdr['time_stamp'], '%Y-%m-%dT%H:%M:%S.%f')
+            except:
+                time_stamp = datetime.strptime(sdr['time_stamp'], '%Y-%m-%d %H:%M:%S.%f')
+
+            time_stamp_sec = time.mktime(time_stamp.timetuple())
+
+            # SDRs of the batch are checked against the previous one
+            if (int(sdr['correlation_number']) != last_corr + 1):
+                raise Exception('Invalid correlation number, expected: ' + str(last_corr + 1))
+
+            if last_time > time_stamp_sec:
+                raise Exception('Invalid time stamp')
+
+            self._check_sdr_model(sdr)
+
+            sdr['time_stamp'] = time_stamp
+            last_corr += 1
+            last_time = time_stamp_sec
+
+        # Store the SDRs, the insert fails if other request has stored
+        # SDRs with the same correlation numbers in the meantime
+        append_sdrs(contract, sdrs)
+
+        if contract.oldest_pending_ts is None:
+            contract.oldest_pending_ts = sdrs[0]['time_stamp']
 
     def _check_expenditure_limits(self, price):
         """
@@ -955,15 +984,13 @@ class ChargingEngine:
             if accounting:
                 related_model['charges'] = accounting['charges']
                 related_model['deductions'] = accounting['deductions']
-                contract.applied_sdrs.extend(contract.pending_sdrs)
-                contract.pending_sdrs = []
+                self._apply_sdrs(contract, accounting)
 
             self._generate_invoice(price, related_model, 'renovation')
 
         elif concept == 'pay per use':
-            # Move SDR from pending to applied
-            contract.applied_sdrs.extend(contract.pending_sdrs)
-            contract.pending_sdrs = []
+            # Mark the charged SDRs as applied
+            self._apply_sdrs(contract, accounting)
             # Generate the invoice
             self._generate_invoice(price, accounting, 'use')
             related_model['charges'] = accounting['charges']
@@ -972,7 +999,7 @@ class ChargingEngine:
         # The contract is saved before the CDR creation to prevent
         # that a transmission error in RSS request causes the
         # customer being charged twice
-        contract.save()
+        self._save_contract(contract)
 
         # If the customer has been charged create the CDR and update balance
         if price > 0:
@@ -980,6 +1007,18 @@ class ChargingEngine:
             if self._expenditure_used:
                 self._update_actor_balance(price)
 
+    def _apply_sdrs(self, contract, accounting):
+        # Move the applied correlation watermark to the last charged SDR,
+        # SDRs received during the charge keep pending
+        contract.applied_correlation = max(contract.applied_correlation, get_last_correlation(accounting))
+
+    def _save_contract(self, contract):
+        # The whole contract document is written, so the time stamp of the
+        # oldest pending SDR is stored again after saving it since SDRs may
+        # have been received during the charge
+        contract.save()
+        update_oldest_pending_ts(contract)
+
     def resolve_charging(self, new_purchase=False, sdr=False):
 
         # Check if there is a new purchase
@@ -1022,7 +1061,7 @@ class ChargingEngine:
                     'concept': 'initial charge',
                     'related_model': related_model
                 }
-                self._purchase.contract.save()
+                self._save_contract(self._purchase.contract)
                 return redirect_url
 
         else:
@@ -1052,11 +1091,12 @@ class ChargingEngine:
                         unmodified.append(s)
 
                 accounting_info = None
+                pending_sdrs = list(iter_pending_sdrs(self._purchase.contract))
+
                 # If pending SDR documents resolve the use charging
-                if len(self._purchase.contract.pending_sdrs) > 0:
+                if len(pending_sdrs) > 0:
                     related_model['pay_per_use'] = self._price_model['pay_per_use']
-                    accounting_info = []
-                    accounting_info.extend(self._purchase.contract.pending_sdrs)
+                    accounting_info = pending_sdrs
 
                 # If deductions have been included resolve the discount
                 if 'deductions' in self._price_model and len(self._price_model['deductions']) > 0:
@@ -1096,15 +1136,14 @@ class ChargingEngine:
                         pending_payment['accounting'] = applied_accounting
 
                     self._purchase.contract.pending_payment    
-                    self._purchase.contract.save()
+                    self._save_contract(self._purchase.contract)
                     return redirect_url
 
             # If sdr is true means that the call is a request for charging the use
             # made of a service.
             else:
                 # Aggregate the calculated charges
-                pending_sdrs = []
-                pending_sdrs.extend(self._purchase.contract.pending_sdrs)
+                pending_sdrs = list(iter_pending_sdrs(self._purchase.contract))
 
                 if len(pending_sdrs) == 0:
                     raise Exception('No SDRs to charge')
@@ -1136,5 +1175,5 @@ class ChargingEngine:
                         'related_model': related_model,
                         'accounting': applied_accounting
                     }
-                    self._purchase.contract.save()
+                    self._save_contract(self._purchase.contract)
                     return redirect_url
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+import logging
+import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from wstore.charging_engine.charging_engine import ChargingEngine
+from wstore.charging_engine.models import Contract
+from wstore.store_commons.database import get_database_connection
+
+
+logger = logging.getLogger('wstore.charging_engine.charging_scheduler')
+
+# Pending SDRs are charged once the oldest one is older than a month
+CHARGING_PERIOD = 2592000
+
+# Seconds a contract is locked for a charging process, the lock expires
+# so a contract locked by a dead process is charged by the next run
+LOCK_TIME = 600
+
+
+def get_due_contracts(now=None, period=CHARGING_PERIOD, db=None):
+    """
+    Returns a cursor with the ids of the contracts whose oldest pending
+    SDR is older than period. Contracts including subscriptions are
+    excluded, since their renovations charge the pending SDRs
+    """
+    if now is None:
+        now = datetime.now()
+
+    if db is None:
+        db = get_database_connection()
+
+    return db.charging_engine_contract.find({
+        'oldest_pending_ts': {'$lte': now - timedelta(seconds=period)},
+        'pricing_model.subscription': {'$exists': False}
+    }, {
+        '_id': True,
+        'purchase_id': True,
+        'oldest_pending_ts': True
+    }).sort('oldest_pending_ts', ASCENDING)
+
+
+def _acquire_lock(db, contract_id):
+    """
+    Locks a contract for a charging process, returns the expiration of
+    the lock or None if other process holds it. Locks are kept in their
+    own collection so saving the contract during the charge does not
+    remove them
+    """
+    now = datetime.now()
+    expires = now + timedelta(seconds=LOCK_TIME)
+
+    try:
+        # The lock is created, or taken if it has expired, a
+        # duplicated key means that it is held by other process
+        db.charging_engine_charginglock.update({
+            '_id': contract_id,
+            'expires': {'$lt': now}
+        }, {
+            '$set': {'expires': expires}
+        }, upsert=True)
+    except DuplicateKeyError:
+        return None
+
+    return expires
+
+
+def _release_lock(db, contract_id, expires):
+    # The lock is only removed if it has not been taken by other
+    # process after expiring
+    db.charging_engine_charginglock.remove({
+        '_id': contract_id,
+        'expires': expires
+    })
+
+
+def charge_contract(contract_id, cutoff):
+    """
+    Charges the pending SDRs of a contract holding its charging lock,
+    returns 'charged', 'locked' if other process is charging it, or
+    'skipped' if it is not due anymore
+    """
+    db = get_database_connection()
+
+    expires = _acquire_lock(db, ObjectId(contract_id))
+    if expires is None:
+        return 'locked'
+
+    try:
+        # The contract is checked again since it may have been charged
+        # after the due contracts were queried
+        contract = Contract.objects.get(pk=contract_id)
+
+        if contract.oldest_pending_ts is None or contract.oldest_pending_ts > cutoff:
+            return 'skipped'
+
+        # Get the related payment info
+        purchase = contract.purchase
+
+        if purchase.organization_owned:
+            payment_info = purchase.owner_organization.payment_info
+        else:
+            payment_info = purchase.customer.userprofile.payment_info
+
+        charging = ChargingEngine(purchase, payment_method='credit_card', credit_card=payment_info)
+        charging.resolve_charging(sdr=True)
+    finally:
+        _release_lock(db, ObjectId(contract_id), expires)
+
+    return 'charged'
+
+
+class ChargingRun():
+    """
+    Charges the contracts with due pending SDRs using a bounded pool of
+    threads, each contract being charged by a single thread
+    """
+
+    def __init__(self, workers=4, period=CHARGING_PERIOD, dry_run=False, report=None, report_every=100):
+        self._workers = workers
+        self._period = period
+        self._dry_run = dry_run
+        self._report = report
+        self._report_every = report_every
+        self._cutoff = None
+
+        self.stats = {
+            'due': 0,
+            'charged': 0,
+            'skipped': 0,
+            'locked': 0,
+            'failed': 0
+        }
+
+    def _charge(self, contract_id):
+        try:
+            return charge_contract(contract_id, self._cutoff)
+        except:
+            logger.exception('Error charging the contract %s' % contract_id)
+            return 'failed'
+
+    def _report_progress(self, start):
+        if self._report is not None:
+            elapsed = time.time() - start
+            processed = self.stats['due']
+            rate = processed / elapsed if elapsed > 0 else 0.0
+
+            self._report('%d contracts processed, %d charged, %d failed (%.2f contracts/s)' % (
+                processed, self.stats['charged'], self.stats['failed'], rate))
+
+    def run(self, now=None):
+        """
+        Charges the due contracts, returns the ids of the due contracts
+        without charging them when running in dry run mode
+        """
+        if now is None:
+            now = datetime.now()
+
+        self._cutoff = now - timedelta(seconds=self._period)
+        start = time.time()
+
+        contract_ids = (unicode(contract['_id']) for contract in get_due_contracts(now, self._period))
+
+        if self._dry_run:
+            due = list(contract_ids)
+            self.stats['due'] = len(due)
+            return due
+
+        pool = ThreadPool(self._workers)
+
+        try:
+            for result in pool.imap_unordered(self._charge, contract_ids):
+                self.stats['due'] += 1
+                self.stats[result] += 1
+
+                if not self.stats['due'] % self._report_every:
+                    self._report_progress(start)
+        finally:
+            pool.close()
+            pool.join()
+
+        self._report_progress(start)
+
+        return None
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+import codecs
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+from shutil import rmtree
+
+from django.conf import settings
+
+from wstore.store_commons.job_queue import JobQueue, WorkerPool, PENDING, FAILED
+
+
+logger = logging.getLogger('wstore.charging_engine.invoice_queue')
+
+RENDERING = 'rendering'
+
+# Seconds a claimed job is reserved for a worker, after that time the
+# job is due again so a job claimed by a dead process is not lost
+LEASE_TIME = 600
+
+# Maximum number of seconds between two retries of a job
+MAX_RETRY_DELAY = 3600
+
+# The HTML code of the invoices is not included when inspecting the queue
+invoice_jobs = JobQueue('wstore_invoice_job', RENDERING, LEASE_TIME, max_retry_delay=MAX_RETRY_DELAY, fields={'html': False})
+
+
+def _get_collection():
+    return invoice_jobs.get_collection()
+
+
+def get_invoice_name(purchase, date):
+    """
+    Returns a name for a new invoice of the purchase not used by its
+    generated or pending invoices
+    """
+    base_name = purchase.ref + '_' + date
+    invoice_name = base_name
+    suffix = 0
+
+    while os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name + '.pdf') in purchase.bill or \
+            os.path.exists(os.path.join(settings.BILL_ROOT, invoice_name + '.pdf')):
+        suffix += 1
+        invoice_name = base_name + '_' + unicode(suffix)
+
+    return invoice_name
+
+
+def _render_pdf(job):
+    """
+    Converts the HTML code of an invoice into a PDF file in a temporal
+    directory of the job, the PDF is moved to the bills directory when
+    it has been completely generated
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='.invoice_', dir=settings.BILL_ROOT)
+
+    try:
+        html_path = os.path.join(tmp_dir, job['name'] + '.html')
+        pdf_path = os.path.join(tmp_dir, job['name'] + '.pdf')
+
+        f = codecs.open(html_path, 'wb', 'utf-8')
+        f.write(job['html'])
+        f.close()
+
+        code = subprocess.call([settings.BASEDIR + '/create_invoice.sh', html_path, pdf_path])
+
+        if code:
+            raise Exception('The invoice generation script exited with code ' + unicode(code))
+
+        if not os.path.isfile(pdf_path):
+            raise Exception('The invoice generation script has not generated the PDF')
+
+        os.rename(pdf_path, os.path.join(settings.BILL_ROOT, job['name'] + '.pdf'))
+    finally:
+        rmtree(tmp_dir, True)
+
+
+def enqueue_invoice(purchase, invoice_name, bill_code):
+    """
+    Persists an invoice generation job with the rendered HTML code of the
+    invoice. If asynchronous generation is disabled the PDF is generated
+    before returning
+    """
+    job = invoice_jobs.get_initial_fields()
+    job['purchase'] = purchase.ref
+    job['name'] = invoice_name
+    job['html'] = bill_code
+
+    collection = _get_collection()
+    job['_id'] = collection.insert(job)
+
+    if getattr(settings, 'INVOICE_ASYNC', True):
+        get_invoice_pool().wake_up()
+        return
+
+    try:
+        _render_pdf(job)
+    except:
+        raise Exception('Invoice generation problem')
+    finally:
+        collection.remove({'_id': job['_id']})
+
+
+def claim_job():
+    """
+    Reserves the next due invoice generation job, None is returned
+    if there is not a due job
+    """
+    jobs = invoice_jobs.claim()
+
+    if not len(jobs):
+        return None
+
+    return jobs[0]
+
+
+def render_invoice(job, max_attempts=5, retry_delay=30):
+    """
+    Generates the PDF of a claimed job. Finished jobs are removed, otherwise
+    they are scheduled again with an exponential backoff until max_attempts
+    is reached. Returns whether the invoice has been generated
+    """
+    try:
+        _render_pdf(job)
+    except Exception as e:
+        error = unicode(e) or e.__class__.__name__
+        invoice_jobs.fail([job], error, max_attempts, retry_delay)
+
+        logger.warning('Error generating the invoice %s: %s' % (job['name'], error))
+        return False
+
+    invoice_jobs.complete([job])
+    logger.debug('Generated the invoice %s' % job['name'])
+
+    return True
+
+
+def render_due_invoices():
+    """
+    Generates the invoices of the due jobs in the current thread, jobs
+    whose generation fails are left in the queue waiting for their retry.
+    Returns the number of generated invoices
+    """
+    max_attempts = getattr(settings, 'INVOICE_MAX_ATTEMPTS', 5)
+    retry_delay = getattr(settings, 'INVOICE_RETRY_DELAY', 30)
+
+    generated = 0
+    job = claim_job()
+
+    while job is not None:
+        if render_invoice(job, max_attempts, retry_delay):
+            generated += 1
+
+        job = claim_job()
+
+    return generated
+
+
+def get_invoice_job(invoice_name):
+    """
+    Returns the generation job of an invoice, or None if the invoice
+    is not waiting to be generated. Failed jobs are not returned since
+    they are not generated until being retried
+    """
+    return _get_collection().find_one({
+        'name': invoice_name,
+        'state': {'$in': [PENDING, RENDERING]}
+    }, {'html': False})
+
+
+def get_queue_stats():
+    """
+    Returns the number of jobs in each state and the creation date
+    of the oldest job waiting to be generated
+    """
+    return invoice_jobs.get_stats()
+
+
+def get_failed_jobs(limit=20):
+    """
+    Returns the jobs whose invoices could not be generated
+    """
+    return invoice_jobs.get_failed(limit)
+
+
+def retry_failed_jobs():
+    """
+    Schedules the failed jobs to be generated again, returns the number
+    of scheduled jobs
+    """
+    return invoice_jobs.retry_failed()
+
+
+class InvoicePool(WorkerPool):
+    """
+    Bounded pool of workers generating the queued invoices
+    """
+
+    def __init__(self, workers=2, max_attempts=5, retry_delay=30, poll_interval=10):
+        WorkerPool.__init__(self, workers=workers, poll_interval=poll_interval)
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+
+    def process(self):
+        job = claim_job()
+
+        if job is None:
+            return None
+
+        if render_invoice(job, self._max_attempts, self._retry_delay):
+            return 1
+
+        return 0
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_invoice_pool():
+    """
+    Returns the invoice worker pool of the process
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = InvoicePool(
+                workers=getattr(settings, 'INVOICE_WORKERS', 2),
+                max_attempts=getattr(settings, 'INVOICE_MAX_ATTEMPTS', 5),
+                retry_delay=getattr(settings, 'INVOICE_RETRY_DELAY', 30),
+                poll_interval=getattr(settings, 'INVOICE_POLL_INTERVAL', 10)
+            )
+
+    return _pool
+
+
+def start_invoice_pool():
+    """
+    Starts the invoice workers if asynchronous generation is enabled,
+    so the jobs left in the queue by previous processes are generated
+    without waiting for a new invoice
+    """
+    if getattr(settings, 'INVOICE_ASYNC', True):
+        get_invoice_pool().wake_up()
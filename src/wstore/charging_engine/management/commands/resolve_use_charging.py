@@ -18,50 +18,86 @@
 # along with WStore.
 # If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
 
-import time
+from optparse import make_option
 
-from datetime import datetime
-
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from wstore.charging_engine.charging_engine import ChargingEngine
-from wstore.charging_engine.models import Contract
-from wstore.models import Organization
+from wstore.charging_engine.charging_scheduler import ChargingRun, CHARGING_PERIOD
+from wstore.charging_engine.invoice_queue import render_due_invoices
+from wstore.charging_engine.service_records import get_oldest_pending_ts, migrate_contract_sdrs, \
+    migrate_embedded_sdrs
 from wstore.contracting.models import Purchase
+from wstore.rss_adaptor.cdr_outbox import deliver_due_cdrs
 
 
 class Command(BaseCommand):
 
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=4,
+            help='Number of threads charging contracts'),
+        make_option('--period',
+            action='store',
+            type='int',
+            dest='period',
+            default=CHARGING_PERIOD,
+            help='Seconds the oldest pending SDR of a contract has to wait before being charged'),
+        make_option('--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='List the contracts to be charged without charging them'),
+    )
+
+    def _write(self, msg):
+        self.stdout.write(msg + '\n')
+
+    def _flush_queues(self):
+        # The background workers are daemon threads ending with the command,
+        # so the invoices and CDRs of the charges are processed before exiting
+        self._write('%d invoices generated' % render_due_invoices())
+        self._write('%d CDRs sent' % deliver_due_cdrs())
+
     def handle(self, *args, **options):
         """
             This method is used to perform the charging process
             of the offerings that have pending SDR for more than
             a month
         """
-        now = time.mktime(datetime.now().timetuple())
-
         if len(args) == 0:
-            # Get contracts
-            for contract in Contract.objects.all():
-
-                pending_sdrs = contract.pending_sdrs
-
-                # If there are subscriptions the renovations are used as triggers
-                if len(pending_sdrs) > 0 and (not 'subscription' in contract.pricing_model):
-                    time_stamp = time.mktime(pending_sdrs[0]['time_stamp'].timetuple())
-
-                    if (time_stamp + 2592000) <= now:  # A month
-                        # Get the related payment info
-                        purchase = contract.purchase
-
-                        if purchase.organization_owned:
-                            org = purchase.owner_organization
-                            payment_info = org.payment_info
-                        else:
-                            payment_info = purchase.customer.userprofile.payment_info
-
-                        charging = ChargingEngine(purchase, payment_method='credit_card', credit_card=payment_info)
-                        charging.resolve_charging(sdr=True)
+            workers = options.get('workers') or 4
+
+            if workers < 1:
+                raise CommandError('The number of workers must be positive')
+
+            # The SDRs embedded in contracts created by previous versions
+            # are moved to the SDR collection so the contracts can be found
+            migrated = migrate_embedded_sdrs()
+            if migrated:
+                self._write('%d contracts migrated' % migrated)
+
+            charging_run = ChargingRun(
+                workers=workers,
+                period=options.get('period') or CHARGING_PERIOD,
+                dry_run=options.get('dry_run', False),
+                report=self._write
+            )
+            due = charging_run.run()
+
+            if due is not None:
+                for contract_id in due:
+                    self._write('Contract %s would be charged' % contract_id)
+
+                self._write('%d contracts would be charged' % len(due))
+            else:
+                stats = charging_run.stats
+                self._write('%d contracts charged, %d skipped, %d locked by other process, %d failed' % (
+                    stats['charged'], stats['skipped'], stats['locked'], stats['failed']))
+                self._flush_queues()
 
         elif len(args) == 1:
             # Get the purchase
@@ -74,7 +110,8 @@ class Command(BaseCommand):
             contract = purchase.contract
 
             # Check if there are pending SDRs
-            if (len(contract.pending_sdrs) > 0):
+            migrate_contract_sdrs(contract)
+            if get_oldest_pending_ts(contract.pk, contract.applied_correlation) is not None:
 
                 # Get payment info
                 if purchase.organization_owned:
@@ -85,6 +122,7 @@ class Command(BaseCommand):
 
                 charging = ChargingEngine(purchase, payment_method='credit_card', credit_card=payment_info)
                 charging.resolve_charging(sdr=True)
+                self._flush_queues()
 
             else:
                 raise Exception('No accounting info in the provided purchase')
@@ -31,16 +31,38 @@ class Contract(models.Model):
     last_charge = models.DateTimeField(blank=True, null=True)
     # List with the made charges
     charges = ListField()
-    # List with the charged SDRs for that offering
-    applied_sdrs = ListField()
-    # List the pending SDRs for that offering
-    pending_sdrs = ListField()
+    # Correlation number of the last charged SDR, the SDRs of the
+    # contract with a greater correlation number are pending
+    applied_correlation = models.IntegerField(default=0)
     # Related purchase
     purchase = models.OneToOneField(Purchase)
     # Pending paid info used in asynchronous charges
     pending_payment = DictField()
     # Revenue sharing product class
     revenue_class = models.CharField(max_length=15, blank=True, null=True)
+    # Time stamp of the oldest pending SDR, used for finding the
+    # contracts to be charged without loading their SDRs
+    oldest_pending_ts = models.DateTimeField(blank=True, null=True)
+    # SDRs embedded by previous versions, they are declared so saving a
+    # contract keeps them until they are moved to the SDR collection
+    applied_sdrs = ListField()
+    pending_sdrs = ListField()
+
+
+class ServiceRecord(models.Model):
+    """
+    SDR received for a contract. SDRs are stored in their own collection
+    and never modified, the applied correlation of the contract marks
+    the ones that have been charged
+    """
+    contract = models.ForeignKey(Contract)
+    correlation_number = models.IntegerField()
+    time_stamp = models.DateTimeField()
+    # SDR document as received
+    record = DictField()
+
+    class Meta:
+        unique_together = ('contract', 'correlation_number')
 
 
 # This model is used as a unit dictionary in order to determine
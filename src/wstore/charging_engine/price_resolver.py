@@ -19,6 +19,149 @@
 # If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
 
 
+import hashlib
+import json
+import operator
+
+from django.conf import settings
+
+from wstore.charging_engine.usage_aggregation import UsageAggregation, get_summary, merge_columns
+from wstore.store_commons.utils.cache import LRUCache
+
+
+_OPERATIONS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.div
+}
+
+# Compiled pay per use components, keyed by the hash of their definition
+_evaluators = LRUCache(getattr(settings, 'PRICING_MODEL_CACHE_SIZE', 256))
+
+
+def _compile_argument(arg, error):
+    if type(arg) == str or type(arg) == unicode:
+        return lambda variables: variables[arg]
+    elif type(arg) == dict:
+        return _compile_function(arg)
+    else:
+        raise Exception(error)
+
+
+def _compile_function(function):
+    """
+    Compiles a price function tree into nested closures that
+    receive the value of the price variables
+    """
+    arg1 = _compile_argument(function['arg1'], 'Invalid argument 1')
+    arg2 = _compile_argument(function['arg2'], 'Invalid argument 2')
+
+    if not function['operation'] in _OPERATIONS:
+        raise Exception('Unsupported operation')
+
+    op = _OPERATIONS[function['operation']]
+
+    return lambda variables: op(arg1(variables), arg2(variables))
+
+
+class PayPerUseEvaluator():
+    """
+    Pay per use components of a pricing model compiled in order to
+    aggregate the accounting info of all of them in a single pass
+    """
+
+    def __init__(self, use_models):
+        self._components = []
+        self._use_units = False
+        self._use_labels = False
+
+        for payment in use_models:
+            if 'price_function' in payment:
+                price_function = payment['price_function']
+                variables = {}
+                labels = {}
+
+                for k, var in price_function['variables'].iteritems():
+                    label = labels.setdefault(var['label'].lower(), [0, []])
+                    label[0] += 1
+
+                    if var['type'] == 'usage':
+                        label[1].append(k)
+                        variables[k] = 0
+                    else:
+                        variables[k] = float(var['value'])
+
+                self._components.append({
+                    'function': _compile_function(price_function['function']),
+                    'variables': variables,
+                    # Label -> (number of variables with the label, usage variables)
+                    'labels': labels
+                })
+                self._use_labels = self._use_labels or len(labels) > 0
+            else:
+                self._components.append({
+                    'unit': payment['unit'].lower(),
+                    'value': float(payment['value'])
+                })
+                self._use_units = True
+
+    def aggregate(self, accounting_info):
+        """
+        Returns the price of each component, the SDRs related to it and
+        a summary of the usage made
+        """
+        aggregation = UsageAggregation(accounting_info, units=self._use_units, labels=self._use_labels)
+
+        prices = []
+        related = []
+        usages = []
+        for component in self._components:
+            if 'function' in component:
+                variables = dict(component['variables'])
+                columns = []
+
+                for label, (count, keys) in component['labels'].iteritems():
+                    column = aggregation.get_label(label)
+                    # The SDRs are related and aggregated once per
+                    # variable of the component with their label
+                    columns.append((column, count))
+
+                    for k in keys:
+                        if count == 1:
+                            variables[k] = sum(column.values)
+                        else:
+                            variables[k] = sum([v for v in column.values for j in range(count)])
+
+                prices.append(component['function'](variables))
+                related.append(merge_columns(columns))
+                usages.append(get_summary([column for column, count in columns]))
+            else:
+                column = aggregation.get_unit(component['unit'])
+                value = component['value']
+
+                prices.append(sum([v * value for v in column.values]))
+                related.append(list(column.sdrs))
+                usages.append(column.get_summary())
+
+        return prices, related, usages
+
+
+def get_evaluator(use_models):
+    """
+    Returns the compiled evaluator of a list of pay per use components,
+    evaluators are cached using the hash of the components definition
+    """
+    key = hashlib.sha1(json.dumps(use_models, sort_keys=True).encode('utf-8')).hexdigest()
+
+    evaluator = _evaluators.get(key)
+    if evaluator is None:
+        evaluator = PayPerUseEvaluator(use_models)
+        _evaluators.set(key, evaluator)
+
+    return evaluator
+
+
 class PriceResolver():
 
     _applied_sdrs = None
@@ -35,82 +178,7 @@ class PriceResolver():
             using the provided function value extracted
             from the different SDR documents
        """
-       
-        # Get arguments
-        if type(function['arg1']) == str or type(function['arg1']) == unicode:
-            arg1 = variables[function['arg1']]
-        elif type(function['arg1']) == dict:
-            arg1 = self._price_function_calculation(function['arg1'], variables)
-        else:
-            raise Exception('Invalid argument 1')
-
-        if type(function['arg2']) == str or type(function['arg2']) == unicode:
-            arg2 = variables[function['arg2']]
-        elif type(function['arg2']) == dict:
-            arg2 = self._price_function_calculation(function['arg2'], variables)
-        else:
-            raise Exception('Invalid argument 2')
-
-        result = 0
-        # Make operation
-        if function['operation'] == '+':
-            result = arg1 + arg2
-        elif function['operation'] == '-':
-            result = arg1 - arg2
-        elif function['operation'] == '*':
-            result = arg1 * arg2
-        elif function['operation'] == '/':
-            result = arg1 / arg2
-        else:
-            raise Exception('Unsupported operation')
-
-        return result
-
-    def _resolve_price_function(self, function, accounting):
-        """
-           Aggregates the accounting information in the 
-           different variables present in a price function
-           in order to calculate the related charging
-       """
-
-        function = function['price_function']
-        # Map price variables id with SDR documents
-        aggregated_accounting_val = {}
-        for k, v in function['variables'].iteritems():
-
-            if v['type'] == 'usage':
-                aggregated_accounting_val[k] = []
-
-                for sdr in accounting:
-                    if sdr['component_label'].lower() == v['label'].lower():
-                        aggregated_accounting_val[k].append(sdr)
-            else:
-                aggregated_accounting_val[k] = float(v['value'])
-
-        # Reduce accounting info to a single value per price variable
-        for k in aggregated_accounting_val:
-            usage = 0
-            # Avoid iterations over constants
-            if type(aggregated_accounting_val[k]) == list:
-                for value in aggregated_accounting_val[k]:
-                    usage += float(value['value'])
-
-                aggregated_accounting_val[k] = usage
-
-        return self._price_function_calculation(function['function'], aggregated_accounting_val)
-
-    def _resolve_pay_per_use_agregation(self, component, accounting):
-        """
-           Resolves the charging of pay per use component based
-           on a fixed use value
-       """
-
-        result = 0
-        for sdr in accounting:
-            # Calculate and aggregate price based on value per consumption
-            result += (float(sdr['value']) * float(component['value']))
-
-        return result
+        return _compile_function(function)(variables)
 
     def _pay_per_use_preprocesing(self, use_models, accounting_info, discount=False):
         """
@@ -118,30 +186,16 @@ class PriceResolver():
            price calculator
        """
 
-        price = 0
-        for payment in use_models: # TODO check if the payment can be applied
-            related_accounting = []
-            # Check price function
-            if 'price_function' in payment:
-                for sdr in accounting_info:
-                    # Iterate over price variables
-                    for k, var in payment['price_function']['variables'].iteritems():
-                        if var['label'].lower() == sdr['component_label'].lower():
-                            related_accounting.append(sdr)
-                agregator = self._resolve_price_function
-            else:
-                # Get the related accounting info
-                for sdr in accounting_info:
-                    if sdr['unit'].lower() == payment['unit'].lower():
-                        related_accounting.append(sdr)
-
-                agregator = self._resolve_pay_per_use_agregation
+        prices, related, usages = get_evaluator(use_models).aggregate(accounting_info or [])
 
+        price = 0
+        for i, payment in enumerate(use_models): # TODO check if the payment can be applied
             # Include the applied SDRs
-            price += agregator(payment, related_accounting)
+            price += prices[i]
             applied_accounting = {
                 'model': payment,
-                'accounting': related_accounting,
+                'accounting': related[i],
+                'usage': usages[i],
                 'price': price
             }
             if discount:
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+from wstore.store_commons.database import get_database_connection
+
+
+# Number of SDRs fetched in each round trip when reading pending SDRs
+BATCH_SIZE = 500
+
+# Query matching the contracts with SDRs embedded by previous versions
+_EMBEDDED_SDRS = [
+    {'applied_sdrs.0': {'$exists': True}},
+    {'pending_sdrs.0': {'$exists': True}}
+]
+
+
+def _get_collection(db=None):
+    if db is None:
+        db = get_database_connection()
+
+    return db.charging_engine_servicerecord
+
+
+def _get_record(doc):
+    record = doc['record']
+    # The stored correlation number and time stamp are the parsed ones
+    record['correlation_number'] = unicode(doc['correlation_number'])
+    record['time_stamp'] = doc['time_stamp']
+    return record
+
+
+def get_last_sdr(contract):
+    """
+    Returns the last SDR received for a contract, or None if no SDR
+    has been received
+    """
+    migrate_contract_sdrs(contract)
+
+    cursor = _get_collection().find({
+        'contract_id': ObjectId(contract.pk)
+    }).sort('correlation_number', DESCENDING).limit(1)
+
+    for doc in cursor:
+        return _get_record(doc)
+
+    return None
+
+
+def append_sdrs(contract, sdrs):
+    """
+    Stores an ordered batch of validated SDRs of a contract with a single
+    insert. The unique index on the contract and correlation number makes
+    the insert fail if other request has stored the same SDRs
+    """
+    docs = []
+    for sdr in sdrs:
+        docs.append({
+            'contract_id': ObjectId(contract.pk),
+            'correlation_number': int(sdr['correlation_number']),
+            'time_stamp': sdr['time_stamp'],
+            'record': sdr
+        })
+
+    db = get_database_connection()
+
+    try:
+        _get_collection(db).insert(docs)
+    except DuplicateKeyError:
+        raise Exception('The accounting info of the purchase has been modified concurrently')
+
+    # Set the oldest pending time stamp if there were no pending SDRs
+    db.charging_engine_contract.update({
+        '_id': ObjectId(contract.pk),
+        'oldest_pending_ts': None
+    }, {
+        '$set': {'oldest_pending_ts': docs[0]['time_stamp']}
+    })
+
+
+def iter_pending_sdrs(contract):
+    """
+    Iterates over the pending SDRs of a contract in correlation order
+    using a streaming cursor
+    """
+    migrate_contract_sdrs(contract)
+
+    cursor = _get_collection().find({
+        'contract_id': ObjectId(contract.pk),
+        'correlation_number': {'$gt': contract.applied_correlation}
+    }, {
+        'correlation_number': True,
+        'time_stamp': True,
+        'record': True
+    }).sort('correlation_number', ASCENDING).batch_size(BATCH_SIZE)
+
+    for doc in cursor:
+        yield _get_record(doc)
+
+
+def get_oldest_pending_ts(contract_id, applied_correlation):
+    """
+    Returns the time stamp of the oldest SDR of a contract whose
+    correlation number is greater than applied_correlation
+    """
+    cursor = _get_collection().find({
+        'contract_id': ObjectId(contract_id),
+        'correlation_number': {'$gt': applied_correlation}
+    }, {'time_stamp': True}).sort('correlation_number', ASCENDING).limit(1)
+
+    for doc in cursor:
+        return doc['time_stamp']
+
+    return None
+
+
+def get_last_correlation(accounting):
+    """
+    Returns the greatest correlation number of the SDRs included in the
+    applied accounting info of a charge
+    """
+    last = 0
+    for part in accounting['charges'] + accounting['deductions']:
+        for sdr in part['accounting']:
+            last = max(last, int(sdr['correlation_number']))
+
+    return last
+
+
+def update_oldest_pending_ts(contract):
+    """
+    Stores the time stamp of the oldest pending SDR of a contract. It is
+    called after saving the contract, since the save writes back the time
+    stamp loaded with it and SDRs may have been received in the meantime
+    """
+    db = get_database_connection()
+    query = {
+        '_id': ObjectId(contract.pk),
+        'applied_correlation': contract.applied_correlation
+    }
+
+    oldest = get_oldest_pending_ts(contract.pk, contract.applied_correlation)
+    db.charging_engine_contract.update(query, {
+        '$set': {'oldest_pending_ts': oldest}
+    })
+
+    if oldest is None:
+        # SDRs appended before the update do not set the time stamp since
+        # it was not empty, so the pending SDRs are checked again
+        oldest = get_oldest_pending_ts(contract.pk, contract.applied_correlation)
+
+        if oldest is not None:
+            query['oldest_pending_ts'] = None
+            db.charging_engine_contract.update(query, {
+                '$set': {'oldest_pending_ts': oldest}
+            })
+
+    contract.oldest_pending_ts = oldest
+
+
+def _move_sdrs(db, contract_id, applied, pending):
+    collection = _get_collection(db)
+
+    for sdr in applied + pending:
+        # The SDRs are upserted so an interrupted migration can be
+        # run again
+        collection.update({
+            'contract_id': contract_id,
+            'correlation_number': int(sdr['correlation_number'])
+        }, {
+            '$setOnInsert': {
+                'time_stamp': sdr['time_stamp'],
+                'record': sdr
+            }
+        }, upsert=True)
+
+    applied_correlation = 0
+    if len(applied):
+        applied_correlation = int(applied[-1]['correlation_number'])
+
+    oldest_pending_ts = None
+    if len(pending):
+        oldest_pending_ts = pending[0]['time_stamp']
+
+    # The embedded SDRs are emptied only if they have not been
+    # moved by other process
+    db.charging_engine_contract.update({
+        '_id': contract_id,
+        '$or': _EMBEDDED_SDRS
+    }, {
+        '$set': {
+            'applied_correlation': applied_correlation,
+            'oldest_pending_ts': oldest_pending_ts,
+            'applied_sdrs': [],
+            'pending_sdrs': []
+        }
+    })
+
+    return applied_correlation, oldest_pending_ts
+
+
+def migrate_contract_sdrs(contract):
+    """
+    Moves the SDRs embedded in a contract created by previous versions to
+    the SDR collection. It is called before reading the SDRs of a contract
+    so contracts not migrated yet by the charging task can be used
+    """
+    if not len(contract.applied_sdrs) and not len(contract.pending_sdrs):
+        return
+
+    applied_correlation, oldest_pending_ts = _move_sdrs(
+        get_database_connection(),
+        ObjectId(contract.pk),
+        contract.applied_sdrs,
+        contract.pending_sdrs
+    )
+
+    contract.applied_correlation = applied_correlation
+    contract.oldest_pending_ts = oldest_pending_ts
+    contract.applied_sdrs = []
+    contract.pending_sdrs = []
+
+
+def migrate_embedded_sdrs(db=None):
+    """
+    Moves the SDRs embedded in the contracts created by previous versions
+    to the SDR collection, returns the number of migrated contracts
+    """
+    if db is None:
+        db = get_database_connection()
+
+    cursor = db.charging_engine_contract.find({
+        '$or': _EMBEDDED_SDRS
+    }, {
+        'applied_sdrs': True,
+        'pending_sdrs': True
+    })
+
+    migrated = 0
+    for contract in cursor:
+        _move_sdrs(db, contract['_id'], contract.get('applied_sdrs') or [], contract.get('pending_sdrs') or [])
+        migrated += 1
+
+    return migrated
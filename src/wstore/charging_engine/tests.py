@@ -23,7 +23,8 @@ from __future__ import absolute_import
 import os
 import json
 import rdflib
-from datetime import datetime
+from StringIO import StringIO
+from datetime import datetime, timedelta
 from pymongo import MongoClient
 from bson import ObjectId
 from mock import MagicMock
@@ -33,11 +34,14 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.test.utils import override_settings
 
-from wstore.charging_engine import charging_engine
+from wstore.charging_engine import charging_engine, charging_scheduler, service_records, invoice_queue
+from wstore.charging_engine.models import ServiceRecord
 from wstore.models import Purchase
 from wstore.models import UserProfile
 from wstore.models import Organization
+from wstore.models import RSS
 from wstore.charging_engine.management.commands import resolve_use_charging
+from wstore.store_commons.database import get_database_connection
 
 
 __test__ = False
@@ -93,10 +97,32 @@ class FakeChargingEngine():
     def resolve_charging(self, sdr=False):
 
         if sdr and self._payment_method == 'credit_card':
-            sdrs = self._purchase.contract.pending_sdrs
-            self._purchase.contract.pending_sdrs = []
-            self._purchase.contract.applied_sdrs.extend(sdrs)
-            self._purchase.contract.save()
+            contract = self._purchase.contract
+            contract.applied_correlation = ServiceRecord.objects.filter(contract=contract).count()
+            contract.oldest_pending_ts = None
+            contract.save()
+
+
+def _store_pending_sdrs(contract, sdrs):
+    # Store the SDRs after the applied ones of the contract
+    for i, sdr in enumerate(sdrs):
+        ServiceRecord.objects.create(
+            contract=contract,
+            correlation_number=contract.applied_correlation + i + 1,
+            time_stamp=sdr['time_stamp'],
+            record=sdr
+        )
+
+    contract.oldest_pending_ts = sdrs[0]['time_stamp']
+    contract.save()
+
+
+def _get_pending_sdrs(contract):
+    return list(service_records.iter_pending_sdrs(contract))
+
+
+def _get_applied_sdrs(contract):
+    return list(ServiceRecord.objects.filter(contract=contract, correlation_number__lte=contract.applied_correlation))
 
 
 def fake_cdr_generation(parts, time):
@@ -109,7 +135,9 @@ class FakeSubprocess():
         pass
 
     def call(self, prams):
-        pass
+        # The invoice generation script writes the PDF
+        open(prams[2], 'wb').close()
+        return 0
 
 class SinglePaymentChargingTestCase(TestCase):
 
@@ -122,7 +150,7 @@ class SinglePaymentChargingTestCase(TestCase):
     def setUpClass(cls):
         reload(charging_engine)
         cls._auth = settings.OILAUTH
-        charging_engine.subprocess = FakeSubprocess()
+        invoice_queue.subprocess = FakeSubprocess()
         settings.OILAUTH = False
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
         super(SinglePaymentChargingTestCase, cls).setUpClass()
@@ -302,7 +330,7 @@ class SubscriptionChargingTestCase(TestCase):
     @classmethod
     def setUpClass(cls):
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
-        charging_engine.subprocess = FakeSubprocess()
+        invoice_queue.subprocess = FakeSubprocess()
         super(SubscriptionChargingTestCase, cls).setUpClass()
 
     def test_basic_subscription_charging(self):
@@ -569,7 +597,7 @@ class PayPerUseChargingTestCase(TestCase):
     def setUpClass(cls):
         cls._auth = settings.OILAUTH
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
-        charging_engine.subprocess = FakeSubprocess()
+        invoice_queue.subprocess = FakeSubprocess()
         settings.OILAUTH = False
         super(PayPerUseChargingTestCase, cls).setUpClass()
 
@@ -603,9 +631,9 @@ class PayPerUseChargingTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 1)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 1)
 
-        loaded_sdr = contract.pending_sdrs[0]
+        loaded_sdr = _get_pending_sdrs(contract)[0]
 
         self.assertEqual(loaded_sdr['customer'], 'test_user')
         self.assertEqual(loaded_sdr['correlation_number'], '1')
@@ -635,11 +663,6 @@ class PayPerUseChargingTestCase(TestCase):
         }
 
         purchase = Purchase.objects.get(pk='61074ab65e05acc415f322f2')
-        applied_date = purchase.contract.applied_sdrs[0]['time_stamp']
-        applied_date = datetime.strptime(applied_date, '%Y-%m-%d %H:%M:%S')
-        purchase.contract.applied_sdrs[0]['time_stamp'] = applied_date
-        purchase.contract.save()
-
         charging = charging_engine.ChargingEngine(purchase)
         charging.include_sdr(sdr)
 
@@ -647,11 +670,11 @@ class PayPerUseChargingTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61074ab65e05acc415f322f2')
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 1)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 1)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 1)
         self.assertEqual(len(contract.charges), 1)
 
-        loaded_sdr = contract.pending_sdrs[0]
+        loaded_sdr = _get_pending_sdrs(contract)[0]
 
         self.assertEqual(loaded_sdr['customer'], 'test_user')
         self.assertEqual(loaded_sdr['correlation_number'], '2')
@@ -679,11 +702,6 @@ class PayPerUseChargingTestCase(TestCase):
         }
 
         purchase = Purchase.objects.get(pk='61077ab75e07a7c415f372f2')
-        applied_date = purchase.contract.pending_sdrs[0]['time_stamp']
-        applied_date = datetime.strptime(applied_date, '%Y-%m-%d %H:%M:%S')
-        purchase.contract.pending_sdrs[0]['time_stamp'] = applied_date
-        purchase.contract.save()
-
         charging = charging_engine.ChargingEngine(purchase)
         charging.include_sdr(sdr)
 
@@ -691,9 +709,9 @@ class PayPerUseChargingTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61077ab75e07a7c415f372f2')
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 2)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 2)
 
-        loaded_sdr = contract.pending_sdrs[1]
+        loaded_sdr = _get_pending_sdrs(contract)[1]
 
         self.assertEqual(loaded_sdr['customer'], 'test_user')
         self.assertEqual(loaded_sdr['correlation_number'], '2')
@@ -703,6 +721,193 @@ class PayPerUseChargingTestCase(TestCase):
 
     test_sdr_feeding_some_pending.tags = ('fiware-ut-14',)
 
+    def _build_sdr(self, correlation, time_stamp, value='10'):
+        return {
+            'offering': {
+                'name': 'test_offering',
+                'organization': 'test_organization',
+                'version': '1.0'
+            },
+            'component_label': 'invocations',
+            'customer': 'test_user',
+            'correlation_number': unicode(correlation),
+            'time_stamp': str(time_stamp),
+            'record_type': 'event',
+            'value': value,
+            'unit': 'invocation'
+        }
+
+    def test_sdr_batch_feeding(self):
+
+        now = datetime.now()
+        sdrs = [self._build_sdr(i + 1, now + timedelta(seconds=i), unicode(i)) for i in range(3)]
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        charging = charging_engine.ChargingEngine(purchase)
+        charging.include_sdrs(sdrs)
+
+        # Refresh the purchase
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        contract = purchase.contract
+
+        self.assertEqual(len(_get_pending_sdrs(contract)), 3)
+        self.assertEqual([sdr['correlation_number'] for sdr in _get_pending_sdrs(contract)], ['1', '2', '3'])
+        self.assertEqual([sdr['value'] for sdr in _get_pending_sdrs(contract)], ['0', '1', '2'])
+        self.assertEqual(contract.oldest_pending_ts.replace(microsecond=0), now.replace(microsecond=0))
+
+    def test_sdr_batch_feeding_invalid(self):
+
+        now = datetime.now()
+        sdrs = [
+            self._build_sdr(1, now),
+            self._build_sdr(2, now + timedelta(seconds=1)),
+            self._build_sdr(4, now + timedelta(seconds=2))
+        ]
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        charging = charging_engine.ChargingEngine(purchase)
+
+        error = None
+        try:
+            charging.include_sdrs(sdrs)
+        except Exception, e:
+            error = e
+
+        self.assertFalse(error is None)
+        self.assertEqual(error.message, 'Invalid correlation number, expected: 3')
+
+        # No SDR of the batch is stored
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEqual(len(_get_pending_sdrs(purchase.contract)), 0)
+
+        # The time stamps are checked across the batch
+        sdrs = [
+            self._build_sdr(1, now),
+            self._build_sdr(2, now - timedelta(seconds=10))
+        ]
+
+        error = None
+        try:
+            charging.include_sdrs(sdrs)
+        except Exception, e:
+            error = e
+
+        self.assertFalse(error is None)
+        self.assertEqual(error.message, 'Invalid time stamp')
+
+    def test_migrate_embedded_sdrs(self):
+
+        # Contracts of previous versions embed their SDRs
+        applied_sdr = self._build_sdr(1, None)
+        applied_sdr['time_stamp'] = datetime(2013, 04, 01)
+        pending_sdr = self._build_sdr(2, None)
+        pending_sdr['time_stamp'] = datetime(2013, 04, 02)
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        db = get_database_connection()
+        db.charging_engine_contract.update({'_id': ObjectId(purchase.contract.pk)}, {
+            '$set': {
+                'applied_sdrs': [applied_sdr],
+                'pending_sdrs': [pending_sdr]
+            }
+        })
+
+        self.assertEqual(service_records.migrate_embedded_sdrs(), 1)
+
+        contract = Purchase.objects.get(pk='61004aba5e05acc115f022f0').contract
+        self.assertEqual(contract.applied_correlation, 1)
+        self.assertEqual(contract.oldest_pending_ts, datetime(2013, 04, 02))
+        self.assertEqual([sdr.correlation_number for sdr in _get_applied_sdrs(contract)], [1])
+        self.assertEqual([sdr['correlation_number'] for sdr in _get_pending_sdrs(contract)], ['2'])
+
+        raw_contract = db.charging_engine_contract.find_one({'_id': ObjectId(contract.pk)})
+        self.assertEqual(raw_contract['applied_sdrs'], [])
+        self.assertEqual(raw_contract['pending_sdrs'], [])
+
+        # Migrated contracts are not processed again
+        self.assertEqual(service_records.migrate_embedded_sdrs(), 0)
+
+    def _embed_sdrs(self):
+        # Contracts of previous versions embed their SDRs
+        applied_sdr = self._build_sdr(1, None)
+        applied_sdr['time_stamp'] = datetime(2013, 04, 01)
+        pending_sdr = self._build_sdr(2, None)
+        pending_sdr['time_stamp'] = datetime(2013, 04, 02)
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        get_database_connection().charging_engine_contract.update({'_id': ObjectId(purchase.contract.pk)}, {
+            '$set': {
+                'applied_sdrs': [applied_sdr],
+                'pending_sdrs': [pending_sdr]
+            }
+        })
+
+    def test_sdr_feeding_not_migrated(self):
+
+        self._embed_sdrs()
+
+        # Saving a contract not migrated keeps its SDRs
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        purchase.contract.save()
+
+        # The SDRs of the contract are moved when they are read
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        charging = charging_engine.ChargingEngine(purchase)
+        charging.include_sdrs([self._build_sdr(3, datetime.now())])
+
+        contract = Purchase.objects.get(pk='61004aba5e05acc115f022f0').contract
+        self.assertEqual(contract.applied_correlation, 1)
+        self.assertEqual(contract.oldest_pending_ts, datetime(2013, 04, 02))
+        self.assertEqual(contract.pending_sdrs, [])
+        self.assertEqual([sdr['correlation_number'] for sdr in _get_pending_sdrs(contract)], ['2', '3'])
+
+    def test_update_oldest_pending_ts(self):
+
+        now = datetime(2013, 04, 01, 00, 00, 00, 500000)
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        charging = charging_engine.ChargingEngine(purchase)
+        charging.include_sdrs([self._build_sdr(1, now)])
+
+        # The contract was loaded before the SDR was received, the charge
+        # saves the time stamp loaded with it
+        contract = Purchase.objects.get(pk='61004aba5e05acc115f022f0').contract
+        contract.oldest_pending_ts = None
+        contract.save()
+
+        service_records.update_oldest_pending_ts(contract)
+
+        contract = Purchase.objects.get(pk='61004aba5e05acc115f022f0').contract
+        self.assertEqual(contract.oldest_pending_ts, now)
+
+        # Once the SDRs are applied there is nothing pending
+        contract.applied_correlation = 1
+        contract.save()
+        service_records.update_oldest_pending_ts(contract)
+
+        contract = Purchase.objects.get(pk='61004aba5e05acc115f022f0').contract
+        self.assertEqual(contract.oldest_pending_ts, None)
+
+    def test_sdr_batch_feeding_concurrent(self):
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        charging = charging_engine.ChargingEngine(purchase)
+
+        # Other request includes a SDR after the contract has been loaded
+        other_purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        charging_engine.ChargingEngine(other_purchase).include_sdr(self._build_sdr(1, datetime.now()))
+
+        error = None
+        try:
+            charging.include_sdrs([self._build_sdr(1, datetime.now())])
+        except Exception, e:
+            error = e
+
+        self.assertFalse(error is None)
+        self.assertEqual(error.message, 'The accounting info of the purchase has been modified concurrently')
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEqual(len(_get_pending_sdrs(purchase.contract)), 1)
+
     def test_sdr_feeding_org_owned(self):
 
         sdr = {
@@ -738,9 +943,9 @@ class PayPerUseChargingTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61004a9a5e95ac9115902290')
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 1)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 1)
 
-        loaded_sdr = contract.pending_sdrs[0]
+        loaded_sdr = _get_pending_sdrs(contract)[0]
 
         self.assertEqual(loaded_sdr['customer'], 'test_user2')
         self.assertEqual(loaded_sdr['correlation_number'], '1')
@@ -832,11 +1037,6 @@ class PayPerUseChargingTestCase(TestCase):
         }
 
         purchase = Purchase.objects.get(pk='61074ab65e05acc415f322f2')
-        applied_date = purchase.contract.applied_sdrs[0]['time_stamp']
-        applied_date = datetime.strptime(applied_date, '%Y-%m-%d %H:%M:%S')
-        purchase.contract.applied_sdrs[0]['time_stamp'] = applied_date
-        purchase.contract.save()
-
         charging = charging_engine.ChargingEngine(purchase)
 
         error = False
@@ -1027,8 +1227,8 @@ class PayPerUseChargingTestCase(TestCase):
         self.assertEqual(contract.charges[0]['cost'], 10.00)
         self.assertEqual(contract.charges[0]['concept'], 'pay per use')
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 1)
 
     test_basic_resolve_use_charging.tags = ('fiware-ut-15',)
 
@@ -1061,7 +1261,7 @@ class AsynchronousPaymentTestCase(TestCase):
     @classmethod
     def setUpClass(cls):
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
-        charging_engine.subprocess = FakeSubprocess()
+        invoice_queue.subprocess = FakeSubprocess()
         charging_engine.threading = FakeThreading()
         super(AsynchronousPaymentTestCase, cls).setUpClass()
 
@@ -1213,7 +1413,11 @@ class ChargingDaemonTestCase(TestCase):
     def setUpClass(cls):
 
         resolve_use_charging.ChargingEngine = FakeChargingEngine
+        resolve_use_charging.deliver_due_cdrs = MagicMock(return_value=0)
+        resolve_use_charging.render_due_invoices = MagicMock(return_value=0)
+        charging_scheduler.ChargingEngine = FakeChargingEngine
         cls._command = resolve_use_charging.Command()
+        cls._command.stdout = StringIO()
         super(ChargingDaemonTestCase, cls).setUpClass()
 
     def test_basic_charging_daemon(self):
@@ -1236,11 +1440,11 @@ class ChargingDaemonTestCase(TestCase):
             'time_stamp': datetime(2013, 04, 01, 00, 00, 00, 00)
         })
 
-        purchase.contract.pending_sdrs = pending_sdrs
-
-        purchase.contract.save()
+        _store_pending_sdrs(purchase.contract, pending_sdrs)
 
         # Run the method
+        resolve_use_charging.deliver_due_cdrs.reset_mock()
+        resolve_use_charging.render_due_invoices.reset_mock()
         self._command.handle()
 
         # Check the contract
@@ -1248,8 +1452,12 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 1)
+
+        # The invoices and CDRs of the charges are processed before the command exits
+        resolve_use_charging.render_due_invoices.assert_called_once_with()
+        resolve_use_charging.deliver_due_cdrs.assert_called_once_with()
 
     def test_charging_daemon_multiple_sdrs(self):
 
@@ -1277,9 +1485,7 @@ class ChargingDaemonTestCase(TestCase):
             'time_stamp': datetime(2013, 04, 03, 00, 00, 00, 00)
         })
 
-        purchase.contract.pending_sdrs = pending_sdrs
-
-        purchase.contract.save()
+        _store_pending_sdrs(purchase.contract, pending_sdrs)
 
         # Run the method
         self._command.handle()
@@ -1289,8 +1495,8 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 3)
 
     def test_charging_daemon_multiple_contracts(self):
 
@@ -1324,11 +1530,9 @@ class ChargingDaemonTestCase(TestCase):
             'time_stamp': datetime(2013, 04, 03, 00, 00, 00, 00)
         })
 
-        purchase_1.contract.pending_sdrs = pending_sdrs_1
-        purchase_1.contract.save()
+        _store_pending_sdrs(purchase_1.contract, pending_sdrs_1)
 
-        purchase_2.contract.pending_sdrs = pending_sdrs_2
-        purchase_2.contract.save()
+        _store_pending_sdrs(purchase_2.contract, pending_sdrs_2)
 
         # Run the method
         self._command.handle()
@@ -1338,16 +1542,16 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase_1.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 1)
 
         # Check the first contract
         purchase_2 = Purchase.objects.get(pk='61004aba5e05acc115f03333')
 
         contract = purchase_2.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 3)
 
     def test_charging_daemon_organization_purchased(self):
 
@@ -1370,9 +1574,7 @@ class ChargingDaemonTestCase(TestCase):
             'time_stamp': datetime(2013, 04, 01, 00, 00, 00, 00)
         })
 
-        purchase.contract.pending_sdrs = pending_sdrs
-
-        purchase.contract.save()
+        _store_pending_sdrs(purchase.contract, pending_sdrs)
 
         # Run the method
         self._command.handle()
@@ -1382,8 +1584,8 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 1)
 
     def test_charging_daemon_now_time(self):
 
@@ -1405,9 +1607,7 @@ class ChargingDaemonTestCase(TestCase):
             'time_stamp': datetime.now()
         })
 
-        purchase.contract.pending_sdrs = pending_sdrs
-
-        purchase.contract.save()
+        _store_pending_sdrs(purchase.contract, pending_sdrs)
 
         # Run the method
         self._command.handle()
@@ -1417,26 +1617,101 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 1)
-        self.assertEqual(len(contract.applied_sdrs), 0)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 1)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 0)
+
+    def _set_pending_sdrs(self):
+        user = User.objects.get(pk='51000aba8e05ac2115f022f9')
+        user.userprofile.payment_info = {}
+        user.userprofile.save()
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        _store_pending_sdrs(purchase.contract, [{
+            'time_stamp': datetime(2013, 04, 01, 00, 00, 00, 00)
+        }, {
+            'time_stamp': datetime(2013, 04, 02, 00, 00, 00, 00)
+        }])
+
+        return purchase.contract
+
+    def test_charging_daemon_dry_run(self):
+
+        contract = self._set_pending_sdrs()
+        self.assertEqual(contract.oldest_pending_ts, datetime(2013, 04, 01, 00, 00, 00, 00))
+
+        self._command.stdout = StringIO()
+        self._command.handle(dry_run=True)
+
+        # The contract is listed but not charged
+        self.assertTrue(('Contract %s would be charged' % contract.pk) in self._command.stdout.getvalue())
+
+        contract = Purchase.objects.get(pk='61004aba5e05acc115f022f0').contract
+        self.assertEqual(len(_get_pending_sdrs(contract)), 2)
+
+    def test_charging_daemon_locked(self):
+
+        contract = self._set_pending_sdrs()
+
+        # Other process is charging the contract
+        db = get_database_connection()
+        db.charging_engine_charginglock.insert({
+            '_id': ObjectId(contract.pk),
+            'expires': datetime.now() + timedelta(seconds=60)
+        })
+
+        charging_run = charging_scheduler.ChargingRun(workers=2)
+        charging_run.run()
+
+        self.assertEqual(charging_run.stats['locked'], 1)
+        self.assertEqual(charging_run.stats['charged'], 0)
+
+        contract = Purchase.objects.get(pk='61004aba5e05acc115f022f0').contract
+        self.assertEqual(len(_get_pending_sdrs(contract)), 2)
+
+        # Once the lock expires the contract is charged
+        db.charging_engine_charginglock.update({'_id': ObjectId(contract.pk)}, {
+            '$set': {'expires': datetime.now() - timedelta(seconds=1)}
+        })
+
+        charging_run = charging_scheduler.ChargingRun(workers=2)
+        charging_run.run()
+
+        self.assertEqual(charging_run.stats['charged'], 1)
+
+        contract = Purchase.objects.get(pk='61004aba5e05acc115f022f0').contract
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(contract.oldest_pending_ts, None)
+
+        # The lock is released after charging
+        self.assertEqual(db.charging_engine_charginglock.find({'_id': ObjectId(contract.pk)}).count(), 0)
+
+    def test_charging_lock_kept_on_save(self):
+
+        contract = self._set_pending_sdrs()
+        db = get_database_connection()
+
+        expires = charging_scheduler._acquire_lock(db, ObjectId(contract.pk))
+        self.assertNotEqual(expires, None)
+
+        # Saving the contract while charging it does not release the lock
+        contract.save()
+        self.assertEqual(charging_scheduler._acquire_lock(db, ObjectId(contract.pk)), None)
+
+        charging_scheduler._release_lock(db, ObjectId(contract.pk), expires)
+        self.assertNotEqual(charging_scheduler._acquire_lock(db, ObjectId(contract.pk)), None)
 
 
-class AdaptorWrapperThread():
+class OutboxWrapper():
 
     _context = None
-    _url = None
-    _cdr = None
+    _rss = None
 
     def __init__(self, context):
         self._context = context
 
-    def __call__(self, url, cdr):
-        self._url = url
-        self._cdr = cdr
-        return self
-
-    def start(self):
-        self._context._cdrs = self._cdr
+    def __call__(self, rss, cdr):
+        self._rss = rss
+        self._context._cdrs = cdr
 
 @override_settings(STORE_NAME='wstore')
 class CDRGeranationTestCase(TestCase):
@@ -1447,15 +1722,20 @@ class CDRGeranationTestCase(TestCase):
 
     @classmethod
     def setUpClass(cls):
-        charging_engine.RSSAdaptorThread = AdaptorWrapperThread(cls)
+        charging_engine.enqueue_cdrs = OutboxWrapper(cls)
         charging_engine.get_country_code = lambda x: '1'
         charging_engine.get_curency_code = lambda x: '1'
         super(CDRGeranationTestCase, cls).setUpClass()
 
     def tearDown(self):
         self._cdrs = None
+        get_database_connection().wstore_cdr_reservation.remove({})
         TestCase.tearDown(self)
 
+    def _get_reservations(self):
+        reservations = get_database_connection().wstore_cdr_reservation.find().sort('first', 1)
+        return [(res['first'], res['count'], res['purchase']) for res in reservations]
+
     def test_basic_cdr_generation(self):
 
         applied_parts = {
@@ -1667,6 +1947,123 @@ class CDRGeranationTestCase(TestCase):
         self.assertEqual(cdr['country'], '1')
         self.assertEqual(cdr['customer'], 'test_user')
 
+    def test_cdr_generation_correlation_block(self):
+
+        applied_parts = {
+            'single_payment': [{
+               'title': 'example part',
+               'unit': 'single_payment',
+               'currency': 'EUR',
+               'value': '1'
+            }, {
+               'title': 'example part2',
+               'unit': 'single_payment',
+               'currency': 'EUR',
+               'value': '2'
+            }],
+            'subscription': [{
+                'title': 'example part3',
+                'unit': 'per month',
+                'currency': 'EUR',
+                'value': '10'
+            }]
+        }
+
+        # Load usdl
+        model = os.path.join(settings.BASEDIR, 'wstore')
+        model = os.path.join(model, 'charging_engine')
+        model = os.path.join(model, 'test')
+        model = os.path.join(model, 'basic_price.ttl')
+        f = open(model, 'rb')
+        graph = rdflib.Graph()
+        graph.parse(data=f.read(), format='n3')
+        f.close()
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        purchase.offering.offering_description = json.loads(graph.serialize(format='json-ld', auto_compact=True))
+        purchase.offering.save()
+
+        charging = charging_engine.ChargingEngine(purchase)
+        charging._price_model = {
+            'general_currency': 'EUR'
+        }
+        charging._generate_cdr(applied_parts, str(datetime.now()))
+
+        # The whole block is reserved with a single increment
+        self.assertEqual([cdr['correlation'] for cdr in self._cdrs], ['0', '1', '2'])
+        self.assertEqual(int(RSS.objects.all()[0].correlation_number), 3)
+
+        # The next charge continues with the following number, when a
+        # deduction has been applied a single CDR is generated
+        charging._generate_cdr(applied_parts, str(datetime.now()), price='13.0')
+
+        self.assertEqual(len(self._cdrs), 1)
+
+        cdr = self._cdrs[0]
+        self.assertEqual(cdr['defined_model'], 'Charging event')
+        self.assertEqual(cdr['correlation'], '3')
+        self.assertEqual(cdr['description'], 'Complete Charging event: 13.0 EUR')
+        self.assertEqual(cdr['cost_value'], '13.0')
+        self.assertEqual(int(RSS.objects.all()[0].correlation_number), 4)
+
+        # Each reserved block is recorded
+        self.assertEqual(self._get_reservations(), [
+            (0, 3, '61004aba5e05acc115f022f0'),
+            (3, 1, '61004aba5e05acc115f022f0')
+        ])
+
+    def test_cdr_generation_invalid_currency(self):
+
+        applied_parts = {
+            'single_payment': [{
+               'title': 'example part',
+               'unit': 'single_payment',
+               'currency': 'EUR',
+               'value': '1'
+            }, {
+               'title': 'example part2',
+               'unit': 'single_payment',
+               'currency': 'XXX',
+               'value': '2'
+            }]
+        }
+
+        # Load usdl
+        model = os.path.join(settings.BASEDIR, 'wstore')
+        model = os.path.join(model, 'charging_engine')
+        model = os.path.join(model, 'test')
+        model = os.path.join(model, 'basic_price.ttl')
+        f = open(model, 'rb')
+        graph = rdflib.Graph()
+        graph.parse(data=f.read(), format='n3')
+        f.close()
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        purchase.offering.offering_description = json.loads(graph.serialize(format='json-ld', auto_compact=True))
+        purchase.offering.save()
+
+        def _get_currency_code(currency):
+            if currency != 'EUR':
+                raise Exception('Invalid currency code')
+            return '1'
+
+        charging_engine.get_curency_code = _get_currency_code
+
+        error = None
+        try:
+            charging = charging_engine.ChargingEngine(purchase)
+            charging._generate_cdr(applied_parts, str(datetime.now()))
+        except Exception as e:
+            error = e
+        finally:
+            charging_engine.get_curency_code = lambda x: '1'
+
+        # The parts are validated before reserving the correlation numbers
+        self.assertEqual(unicode(error), 'Invalid currency code')
+        self.assertEqual(self._cdrs, None)
+        self.assertEqual(int(RSS.objects.all()[0].correlation_number), 0)
+        self.assertEqual(self._get_reservations(), [])
+
 
 class PriceFunctionPaymentTestCase(TestCase):
 
@@ -1677,7 +2074,7 @@ class PriceFunctionPaymentTestCase(TestCase):
     def setUpClass(cls):
         cls._auth = settings.OILAUTH
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
-        charging_engine.subprocess = FakeSubprocess()
+        invoice_queue.subprocess = FakeSubprocess()
         settings.OILAUTH = False
         super(PriceFunctionPaymentTestCase, cls).setUpClass()
 
@@ -1729,8 +2126,8 @@ class PriceFunctionPaymentTestCase(TestCase):
         self.assertEqual(contract.charges[0]['cost'], 33.00)
         self.assertEqual(contract.charges[0]['concept'], 'pay per use')
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 3)
 
     def test_price_function_payment_renovation(self):
 
@@ -1787,8 +2184,8 @@ class PriceFunctionPaymentTestCase(TestCase):
         self.assertEqual(contract.charges[0]['cost'], 38.00)
         self.assertEqual(contract.charges[0]['concept'], 'Renovation')
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 3)
 
 
     def test_price_function_payment_deduction(self):
@@ -1846,8 +2243,8 @@ class PriceFunctionPaymentTestCase(TestCase):
         self.assertEqual(contract.charges[0]['cost'], 33.30)
         self.assertEqual(contract.charges[0]['concept'], 'Renovation')
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(_get_pending_sdrs(contract)), 0)
+        self.assertEqual(len(_get_applied_sdrs(contract)), 3)
 
     def test_price_function_payment_exception(self):
 
@@ -1889,3 +2286,279 @@ class PriceFunctionPaymentTestCase(TestCase):
 
             self.assertTrue(error)
             self.assertEquals(msg, err)
+
+    def test_price_function_evaluator(self):
+
+        from wstore.charging_engine import price_resolver
+
+        pricing_model = {
+            'pay_per_use': [{
+                'unit': 'Call',
+                'value': '0.5'
+            }, {
+                'price_function': {
+                    'variables': {
+                        'calls': {
+                            'type': 'usage',
+                            'label': 'Calls'
+                        },
+                        'messages': {
+                            'type': 'usage',
+                            'label': 'sms'
+                        },
+                        'calls_constant': {
+                            'type': 'constant',
+                            'label': 'multi constant',
+                            'value': '2'
+                        }
+                    },
+                    'function': {
+                        'arg1': {
+                            'arg1': 'calls',
+                            'arg2': 'calls_constant',
+                            'operation': '*'
+                        },
+                        'arg2': 'messages',
+                        'operation': '+'
+                    }
+                }
+            }]
+        }
+        sdrs = [{
+            'component_label': 'calls',
+            'unit': 'call',
+            'value': '10'
+        }, {
+            'component_label': 'SMS',
+            'unit': 'message',
+            'value': '3'
+        }, {
+            'component_label': 'calls',
+            'unit': 'call',
+            'value': '5'
+        }]
+
+        resolver = price_resolver.PriceResolver()
+        self.assertEquals(resolver.resolve_price(pricing_model, sdrs), 40.5)
+
+        applied = resolver.get_applied_sdr()['charges']
+        self.assertEquals(len(applied), 2)
+        self.assertEquals(applied[0]['accounting'], [sdrs[0], sdrs[2]])
+        self.assertEquals(applied[0]['price'], 7.5)
+        self.assertEquals(applied[1]['accounting'], sdrs)
+        self.assertEquals(applied[1]['price'], 40.5)
+
+        # The compiled evaluator is reused for equal pricing models
+        evaluator = price_resolver.get_evaluator(pricing_model['pay_per_use'])
+        other_model = json.loads(json.dumps(pricing_model['pay_per_use']))
+        self.assertTrue(price_resolver.get_evaluator(other_model) is evaluator)
+
+        # Invalid price functions are rejected when compiled
+        other_model[1]['price_function']['function']['operation'] = 'p'
+        error = False
+        try:
+            price_resolver.get_evaluator(other_model)
+        except Exception, e:
+            error = True
+            msg = e.message
+
+        self.assertTrue(error)
+        self.assertEquals(msg, 'Unsupported operation')
+
+    def test_usage_aggregation(self):
+
+        from wstore.charging_engine import price_resolver
+        from wstore.charging_engine.usage_aggregation import get_usage, format_usage
+
+        pricing_model = {
+            'pay_per_use': [{
+                'unit': 'Call',
+                'value': '0.5'
+            }, {
+                'unit': 'Megabyte',
+                'value': '2'
+            }]
+        }
+        sdrs = [{
+            'component_label': 'calls',
+            'unit': 'call',
+            'value': '10',
+            'time_stamp': datetime(2013, 5, 2, 10, 0, 0, 500)
+        }, {
+            'component_label': 'data',
+            'unit': 'megabyte',
+            'value': '2.5',
+            'time_stamp': datetime(2013, 5, 3, 10, 0, 0)
+        }, {
+            'component_label': 'calls',
+            'unit': 'call',
+            'value': '5',
+            'time_stamp': datetime(2013, 5, 4, 10, 0, 0)
+        }]
+
+        resolver = price_resolver.PriceResolver()
+        self.assertEquals(resolver.resolve_price(pricing_model, sdrs), 12.5)
+
+        calls, data = resolver.get_applied_sdr()['charges']
+        self.assertEquals(calls['usage'], {
+            'value': 15.0,
+            'count': 2,
+            'min': 5.0,
+            'max': 10.0,
+            'start': datetime(2013, 5, 2, 10, 0, 0, 500),
+            'end': datetime(2013, 5, 4, 10, 0, 0)
+        })
+        self.assertEquals(data['usage']['count'], 1)
+        self.assertEquals(format_usage(calls['usage']['value']), '15')
+        self.assertEquals(format_usage(data['usage']['value']), '2.5')
+
+        # Parts without usage summary are aggregated again
+        del calls['usage']
+        self.assertEquals(get_usage(calls)['value'], 15.0)
+        self.assertEquals(get_usage(calls)['end'], datetime(2013, 5, 4, 10, 0, 0))
+
+
+class InvoiceQueueTestCase(TestCase):
+
+    tags = ('invoice-queue',)
+
+    def setUp(self):
+        self._code = 0
+        self._generated = []
+        invoice_queue.subprocess = MagicMock()
+        invoice_queue.subprocess.call.side_effect = self._generate_invoice
+        invoice_queue.get_invoice_pool = MagicMock()
+        self.collection = invoice_queue._get_collection()
+
+        self.purchase = MagicMock()
+        self.purchase.ref = '61004aba5e05acc115f022f0'
+        self.purchase.bill = []
+
+    def tearDown(self):
+        self.collection.remove({})
+        reload(invoice_queue)
+
+        for name in self._generated:
+            path = os.path.join(settings.BILL_ROOT, name + '.pdf')
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _generate_invoice(self, args):
+        html_path, pdf_path = args[1:]
+
+        if not self._code:
+            open(pdf_path, 'wb').close()
+            self._generated.append(os.path.basename(pdf_path)[:-4])
+
+        return self._code
+
+    @override_settings(INVOICE_ASYNC=True)
+    def test_enqueue_invoice(self):
+        invoice_queue.enqueue_invoice(self.purchase, '61004aba5e05acc115f022f0_2013-05-02', '<html></html>')
+
+        # The job is persisted and generated by the workers
+        invoice_queue.get_invoice_pool().wake_up.assert_called_once_with()
+        self.assertFalse(invoice_queue.subprocess.call.called)
+
+        job = invoice_queue.get_invoice_job('61004aba5e05acc115f022f0_2013-05-02')
+        self.assertEquals(job['state'], invoice_queue.PENDING)
+        self.assertEquals(job['purchase'], '61004aba5e05acc115f022f0')
+
+        pool = invoice_queue.InvoicePool()
+        self.assertEquals(pool.drain(), 1)
+
+        # The PDF is generated in a temporal directory of the job
+        html_path, pdf_path = invoice_queue.subprocess.call.call_args[0][0][1:]
+        self.assertEquals(os.path.dirname(html_path), os.path.dirname(pdf_path))
+        self.assertNotEquals(os.path.dirname(pdf_path), settings.BILL_ROOT)
+        self.assertFalse(os.path.exists(os.path.dirname(pdf_path)))
+        self.assertTrue(os.path.isfile(os.path.join(settings.BILL_ROOT, '61004aba5e05acc115f022f0_2013-05-02.pdf')))
+
+        self.assertEquals(invoice_queue.get_invoice_job('61004aba5e05acc115f022f0_2013-05-02'), None)
+
+    @override_settings(INVOICE_ASYNC=True)
+    def test_invoice_retry(self):
+        self._code = 1
+        invoice_queue.enqueue_invoice(self.purchase, 'invoice', '<html></html>')
+
+        pool = invoice_queue.InvoicePool(max_attempts=2, retry_delay=30)
+
+        # The job is scheduled again with a delay
+        self.assertEquals(pool.drain(), 0)
+
+        job = self.collection.find_one()
+        self.assertEquals(job['state'], invoice_queue.PENDING)
+        self.assertEquals(job['attempts'], 1)
+        self.assertEquals(job['last_error'], 'The invoice generation script exited with code 1')
+        self.assertFalse('lease' in job)
+        self.assertTrue(job['next_attempt'] > datetime.now() + timedelta(seconds=20))
+
+        # The job fails when the maximum number of attempts is reached
+        self.collection.update({}, {'$set': {'next_attempt': datetime.now()}})
+        self.assertEquals(pool.drain(), 0)
+
+        job = self.collection.find_one()
+        self.assertEquals(job['state'], invoice_queue.FAILED)
+        self.assertEquals(job['attempts'], 2)
+        self.assertEquals(invoice_queue.get_queue_stats()[invoice_queue.FAILED], 1)
+
+        # Failed invoices are not waiting to be generated
+        self.assertEquals(invoice_queue.get_invoice_job('invoice'), None)
+
+        self.assertEquals(invoice_queue.retry_failed_jobs(), 1)
+        self._code = 0
+        self.assertEquals(pool.drain(), 1)
+        self.assertEquals(self.collection.find().count(), 0)
+
+    @override_settings(INVOICE_ASYNC=True)
+    def test_invoice_not_generated(self):
+        # The script exits without errors but the PDF does not exist
+        invoice_queue.subprocess.call.side_effect = None
+        invoice_queue.subprocess.call.return_value = 0
+        invoice_queue.enqueue_invoice(self.purchase, 'invoice', '<html></html>')
+
+        pool = invoice_queue.InvoicePool(max_attempts=2, retry_delay=30)
+        self.assertEquals(pool.drain(), 0)
+
+        job = self.collection.find_one()
+        self.assertEquals(job['state'], invoice_queue.PENDING)
+        self.assertEquals(job['attempts'], 1)
+        self.assertEquals(job['last_error'], 'The invoice generation script has not generated the PDF')
+
+    @override_settings(INVOICE_ASYNC=True)
+    def test_render_due_invoices(self):
+        invoice_queue.enqueue_invoice(self.purchase, 'invoice', '<html></html>')
+        invoice_queue.enqueue_invoice(self.purchase, 'invoice_1', '<html></html>')
+
+        # The due jobs are generated in the calling thread
+        self.assertEquals(invoice_queue.render_due_invoices(), 2)
+        self.assertEquals(self.collection.find().count(), 0)
+        self.assertEquals(sorted(self._generated), ['invoice', 'invoice_1'])
+
+        # Jobs left by previous processes are processed when the pool starts
+        invoice_queue.start_invoice_pool()
+        self.assertEquals(invoice_queue.get_invoice_pool().wake_up.call_count, 3)
+
+    def test_invoice_sync_error(self):
+        self._code = 1
+
+        error = False
+        try:
+            invoice_queue.enqueue_invoice(self.purchase, 'invoice', '<html></html>')
+        except Exception, e:
+            error = True
+            msg = e.message
+
+        self.assertTrue(error)
+        self.assertEquals(msg, 'Invoice generation problem')
+        self.assertEquals(self.collection.find().count(), 0)
+
+    def test_invoice_name(self):
+        self.purchase.bill = [
+            os.path.join(settings.MEDIA_URL, 'bills/61004aba5e05acc115f022f0_2013-05-02.pdf'),
+            os.path.join(settings.MEDIA_URL, 'bills/61004aba5e05acc115f022f0_2013-05-02_1.pdf')
+        ]
+
+        # Names of pending invoices are not reused
+        self.assertEquals(invoice_queue.get_invoice_name(self.purchase, '2013-05-02'), '61004aba5e05acc115f022f0_2013-05-02_2')
+        self.assertEquals(invoice_queue.get_invoice_name(self.purchase, '2013-05-03'), '61004aba5e05acc115f022f0_2013-05-03')
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+from array import array
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _get_time(time_stamp):
+    delta = time_stamp - _EPOCH
+    return delta.days * 86400.0 + delta.seconds + delta.microseconds / 1000000.0
+
+
+class UsageColumn():
+    """
+    Values and time stamps of the SDRs of a unit or a component label,
+    stored in arrays together with the position of each SDR in the
+    accounting info
+    """
+
+    def __init__(self):
+        self.values = array('d')
+        self.time_stamps = array('d')
+        self.positions = array('l')
+        self.sdrs = []
+
+    def append(self, position, sdr, value):
+        self.values.append(value)
+        self.positions.append(position)
+        self.sdrs.append(sdr)
+
+        if isinstance(sdr.get('time_stamp'), datetime):
+            self.time_stamps.append(_get_time(sdr['time_stamp']))
+
+    def get_summary(self):
+        return get_summary([self])
+
+
+def get_summary(columns):
+    """
+    Returns the total value, the number of SDRs and the min and max values
+    and time stamps of a set of usage columns
+    """
+    summary = {
+        'value': 0,
+        'count': 0,
+        'min': None,
+        'max': None,
+        'start': None,
+        'end': None
+    }
+
+    values = [column.values for column in columns if len(column.values)]
+    time_stamps = [column.time_stamps for column in columns if len(column.time_stamps)]
+
+    if len(values):
+        summary['value'] = sum([sum(v) for v in values])
+        summary['count'] = sum([len(v) for v in values])
+        summary['min'] = min([min(v) for v in values])
+        summary['max'] = max([max(v) for v in values])
+
+    if len(time_stamps):
+        summary['start'] = _EPOCH + timedelta(seconds=min([min(t) for t in time_stamps]))
+        summary['end'] = _EPOCH + timedelta(seconds=max([max(t) for t in time_stamps]))
+
+    return summary
+
+
+class UsageAggregation():
+    """
+    Groups the SDRs of a charge by unit and by component label
+    with a single pass over the accounting info
+    """
+
+    def __init__(self, accounting_info, units=True, labels=True):
+        self.units = {}
+        self.labels = {}
+
+        for position, sdr in enumerate(accounting_info):
+            value = float(sdr['value'])
+
+            if units:
+                self.units.setdefault(sdr['unit'].lower(), UsageColumn()).append(position, sdr, value)
+
+            if labels:
+                self.labels.setdefault(sdr['component_label'].lower(), UsageColumn()).append(position, sdr, value)
+
+    def get_unit(self, unit):
+        return self.units.get(unit.lower(), UsageColumn())
+
+    def get_label(self, label):
+        return self.labels.get(label.lower(), UsageColumn())
+
+
+def merge_columns(columns):
+    """
+    Returns the SDRs of a list of (column, repetitions) tuples in the
+    order they have in the accounting info
+    """
+    entries = []
+    for column, repetitions in columns:
+        for position, sdr in zip(column.positions, column.sdrs):
+            entries.extend([(position, sdr)] * repetitions)
+
+    entries.sort(key=itemgetter(0))
+    return [sdr for position, sdr in entries]
+
+
+def get_usage(part):
+    """
+    Returns the usage summary of an applied pay per use part. Parts
+    stored before including the summary are aggregated again
+    """
+    if 'usage' in part:
+        return part['usage']
+
+    column = UsageColumn()
+    for position, sdr in enumerate(part['accounting']):
+        column.append(position, sdr, float(sdr['value']))
+
+    return column.get_summary()
+
+
+def format_usage(value):
+    """
+    Returns the text of a consumption value, integer consumptions
+    are displayed without decimals
+    """
+    if float(value).is_integer():
+        return unicode(int(value))
+
+    return unicode(value)
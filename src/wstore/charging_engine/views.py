@@ -19,7 +19,6 @@
 # If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
 
 import json
-from pymongo import MongoClient
 from bson import ObjectId
 
 from django.conf import settings
@@ -28,7 +27,8 @@ from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 
 from wstore.store_commons.resource import Resource
-from wstore.store_commons.utils.http import build_response, supported_request_mime_types
+from wstore.store_commons.utils.http import build_response, supported_request_mime_types, get_content_type
+from wstore.store_commons.database import get_database_connection
 from wstore.models import Purchase
 from wstore.models import UserProfile
 from wstore.charging_engine.charging_engine import ChargingEngine
@@ -36,27 +36,53 @@ from wstore.contracting.purchase_rollback import rollback
 from wstore.contracting.notify_provider import notify_provider
 
 
+# Fields required in SDR documents
+SDR_FIELDS = ('offering', 'customer', 'time_stamp', 'correlation_number', 'record_type', 'unit', 'value', 'component_label')
+
+
+def _parse_sdrs(request):
+    """
+    Extracts the SDRs of the request, which can contain a single SDR,
+    an ordered array of SDRs or a NDJSON stream with a SDR per line
+    """
+    if get_content_type(request)[0] == 'application/x-ndjson':
+        sdrs = [json.loads(line) for line in request.raw_post_data.splitlines() if line.strip()]
+    else:
+        sdrs = json.loads(request.raw_post_data)
+
+        if not isinstance(sdrs, list):
+            sdrs = [sdrs]
+
+    if len(sdrs) > getattr(settings, 'SDR_BATCH_MAX_SIZE', 1000):
+        raise Exception('Too many SDRs in a single request')
+
+    # Validate SDR structure
+    for sdr in sdrs:
+        if not isinstance(sdr, dict):
+            raise Exception('Invalid JSON content')
+
+        for field in SDR_FIELDS:
+            if not field in sdr:
+                raise Exception('Invalid JSON content')
+
+    return sdrs
+
+
 class ServiceRecordCollection(Resource):
 
     # This method is used to load SDR documents and
     # start the charging process
-    @supported_request_mime_types(('application/json',))
+    @supported_request_mime_types(('application/json', 'application/x-ndjson'))
     def create(self, request, reference):
         try:
-            # Extract SDR document from the HTTP request
-            data = json.loads(request.raw_post_data)
-
-            # Validate SDR structure
-            if not 'offering' in data or not 'customer' in data or not 'time_stamp' in data \
-            or not 'correlation_number' in data or not 'record_type' in data or not 'unit' in data \
-            or not 'value' in data or not 'component_label' in data:
-                raise Exception('Invalid JSON content')
+            # Extract SDR documents from the HTTP request
+            sdrs = _parse_sdrs(request)
 
             # Get the purchase
             purchase = Purchase.objects.get(ref=reference)
-            # Call the charging engine core with the SDR
+            # Call the charging engine core with the SDRs
             charging_engine = ChargingEngine(purchase)
-            charging_engine.include_sdr(data)
+            charging_engine.include_sdrs(sdrs)
         except Exception, e:
             return build_response(request, 400, e.message)
 
@@ -74,8 +100,7 @@ class PayPalConfirmation(Resource):
             token = request.GET.get('token')
             payer_id = request.GET.get('PayerID', '')
 
-            connection = MongoClient()
-            db = connection[settings.DATABASES['default']['NAME']]
+            db = get_database_connection()
 
             # Uses an atomic operation to get and set the _lock value in the purchase
             # document
@@ -98,9 +98,6 @@ class PurchasesCreationTestCase(TestCase):
     def setUp(self):
         purchases_management.ChargingEngine.resolve_charging = MagicMock()
         purchases_management.ChargingEngine.resolve_charging.return_value = None
-        purchases_management.SearchEngine = MagicMock()
-        se_obj = MagicMock()
-        purchases_management.SearchEngine.return_value = se_obj
         usdl_info = {
             'name': 'test_offering',
             'base_uri': 'http://localhost',
@@ -520,11 +517,6 @@ class PurchaseRollbackTestCase(TestCase):
 
     fixtures = ['purch_rollback.json']
 
-    def setUp(self):
-        se_object = MagicMock()
-        purchase_rollback.SearchEngine = MagicMock()
-        purchase_rollback.SearchEngine.return_value = se_object
-
     def test_rollback_not_paid_exeption(self):
 
         user = User.objects.get(pk='51070aba8e05cc2115f022f9')
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from wstore.rss_adaptor.cdr_outbox import outbox, get_dispatcher
+from wstore.store_commons.queue_command import InspectQueueCommand, get_inspect_options
+
+
+class Command(InspectQueueCommand):
+
+    help = 'Shows the backlog of CDRs waiting to be sent to the RSS'
+
+    option_list = BaseCommand.option_list + get_inspect_options('CDRs', 'sent')
+
+    jobs_name = 'CDRs'
+    action = 'sent'
+    leased_label = 'Sending'
+    oldest_label = 'Oldest undelivered CDR'
+    group_by = 'rss'
+
+    def get_queue(self):
+        return outbox
+
+    def get_pool(self):
+        return get_dispatcher()
+
+    def describe_group(self, rss, count):
+        return 'RSS %s: %d undelivered CDRs' % (rss, count)
+
+    def describe_failed(self, doc):
+        return 'Failed CDR %d of RSS %s after %d attempts: %s' % (
+            doc['correlation'], doc['rss'], doc['attempts'], doc['last_error'])
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.invoice_queue import invoice_jobs, get_invoice_pool
+from wstore.store_commons.queue_command import InspectQueueCommand, get_inspect_options
+
+
+class Command(InspectQueueCommand):
+
+    help = 'Shows the invoices waiting to be generated'
+
+    option_list = BaseCommand.option_list + get_inspect_options('invoices', 'generated')
+
+    jobs_name = 'invoices'
+    action = 'generated'
+    leased_label = 'Rendering'
+    oldest_label = 'Oldest pending invoice'
+
+    def get_queue(self):
+        return invoice_jobs
+
+    def get_pool(self):
+        return get_invoice_pool()
+
+    def describe_failed(self, job):
+        return 'Failed invoice %s after %d attempts: %s' % (job['name'], job['attempts'], job['last_error'])
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wstore.store_commons.indexes import ensure_indexes, check_indexes
+
+
+class Command(BaseCommand):
+
+    help = 'Creates the database indexes required by the hot query shapes, or checks them using explain'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check',
+            action='store_true',
+            dest='check',
+            default=False,
+            help='Report the queries of the catalogue that are not served by an index instead of creating the indexes'),
+        make_option('--foreground',
+            action='store_true',
+            dest='foreground',
+            default=False,
+            help='Build the indexes in the foreground, which is faster but blocks the collections'),
+    )
+
+    def handle(self, *args, **options):
+
+        if options.get('check'):
+            missing = check_indexes()
+
+            for name, problems in missing:
+                self.stdout.write('Missing index: %s (%s)\n' % (name, ', '.join(problems)))
+
+            if len(missing):
+                raise CommandError('%d queries are not served by an index' % len(missing))
+
+            self.stdout.write('All the queries are served by an index.\n')
+            return
+
+        names = ensure_indexes(background=not options.get('foreground'))
+        for name in names:
+            self.stdout.write('Index ensured: %s\n' % name)
+
+        self.stdout.write('%d indexes ensured.\n' % len(names))
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import os
+import time
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from whoosh.index import create_in
+
+from wstore.models import Offering, Organization
+from wstore.search.index_journal import start_journal, read_journal, stop_journal
+from wstore.search.search_engine import SearchEngine, get_index_schema
+from wstore.search.usdl_text import extract_text
+from wstore.store_commons.database import get_database_connection
+
+
+# The index is built in a new directory named with this suffix and
+# index_path is a symbolic link to the directory of the live index
+VERSION_SUFFIX = '.v'
+
+
+def _extract_text(usdl_document):
+    # Top level function so it can be used by the process pool
+    return extract_text(usdl_document)
+
+
+def _swap_index(index_path, version_path):
+    """
+    Points index_path to the version directory of the new index replacing
+    a symbolic link, so the swap is atomic. Returns the directory of the
+    previous index, if any
+    """
+    parent, name = os.path.split(index_path)
+
+    previous_path = None
+    if os.path.islink(index_path):
+        previous_path = os.path.realpath(index_path)
+
+    elif os.path.isdir(index_path):
+        # Indexes created before using version directories are moved once,
+        # the index is not available until the link is created
+        previous_path = mkdtemp(prefix=name + VERSION_SUFFIX, dir=parent)
+        os.rmdir(previous_path)
+        os.rename(index_path, previous_path)
+
+    link_path = mkdtemp(prefix=name + '.link', dir=parent)
+    os.rmdir(link_path)
+    os.symlink(os.path.basename(version_path), link_path)
+
+    try:
+        os.rename(link_path, index_path)
+    except OSError:
+        os.remove(link_path)
+        raise CommandError('The index directory has been created while swapping the index, run the command again')
+
+    return previous_path
+
+
+def _remove_old_versions(index_path, keep):
+    """
+    Removes the version directories of the index except the given ones. The
+    previous version is kept since it may still be used by open searchers
+    """
+    parent, name = os.path.split(index_path)
+    keep = set([os.path.realpath(path) for path in keep if path is not None])
+
+    for filename in os.listdir(parent):
+        path = os.path.join(parent, filename)
+
+        if filename.startswith(name + VERSION_SUFFIX) and os.path.isdir(path) and not os.path.realpath(path) in keep:
+            rmtree(path, True)
+
+
+def _offering_batches(batch_size):
+    """
+    Stream the offerings from the database in batches, the ids are read
+    with a single cursor and each batch is loaded with one query
+    """
+    db = get_database_connection()
+
+    cursor = db.wstore_offering.find({}, {'_id': True}).batch_size(batch_size)
+
+    organizations = {}
+    batch = []
+    for raw in cursor:
+        batch.append(unicode(raw['_id']))
+
+        if len(batch) == batch_size:
+            yield _load_batch(batch, organizations)
+            batch = []
+
+    if len(batch):
+        yield _load_batch(batch, organizations)
+
+
+def _load_batch(batch, organizations):
+    offerings = list(Offering.objects.filter(pk__in=batch))
+
+    # Owner organizations are loaded once for the whole rebuild
+    missing = set([off.owner_organization_id for off in offerings if not off.owner_organization_id in organizations])
+    if len(missing):
+        for org in Organization.objects.filter(pk__in=list(missing)):
+            organizations[org.pk] = org
+
+    for off in offerings:
+        off.owner_organization = organizations[off.owner_organization_id]
+
+    return offerings
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds the offerings search index in a new directory and swaps it with the current one'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--procs',
+            action='store',
+            type='int',
+            dest='procs',
+            default=cpu_count(),
+            help='Number of processes used for extracting text and writing the index'),
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=500,
+            help='Number of offerings loaded from the database in each query'),
+    )
+
+    def handle(self, *args, **options):
+        procs = options.get('procs') or 1
+        batch_size = options.get('batch_size') or 500
+
+        if procs < 1 or batch_size < 1:
+            raise CommandError('The number of processes and the batch size must be positive')
+
+        index_path = settings.DATADIR
+        index_path = os.path.join(index_path, 'search')
+        index_path = os.path.join(index_path, 'indexes')
+
+        # Offerings written to the live index from now on are recorded, so
+        # the updates made while rebuilding are not lost
+        try:
+            start_journal(index_path)
+        except Exception as e:
+            raise CommandError(unicode(e))
+
+        try:
+            total, elapsed, version_path = self._build_index(index_path, procs, batch_size)
+
+            previous_path = _swap_index(index_path, version_path)
+
+            # Write again the offerings updated in the live index
+            replayed = read_journal(index_path)
+            if len(replayed):
+                SearchEngine(index_path).apply_updates([(offering_pk, 'update') for offering_pk in replayed])
+        finally:
+            stop_journal(index_path)
+
+        _remove_old_versions(index_path, [version_path, previous_path])
+
+        self.stdout.write('%d offerings updated while rebuilding have been written again.\n' % len(replayed))
+        self.stdout.write('The search index was rebuilt with %d offerings in %.2f seconds.\n' % (total, elapsed))
+
+    def _build_index(self, index_path, procs, batch_size):
+        """
+        Creates the new index in a version directory next to the live one
+        """
+        parent, name = os.path.split(index_path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        version_path = mkdtemp(prefix=name + VERSION_SUFFIX, dir=parent)
+        index = create_in(version_path, get_index_schema())
+
+        se = SearchEngine(version_path)
+        pool = None
+        if procs > 1:
+            pool = Pool(procs)
+            writer = index.writer(procs=procs, multisegment=True)
+        else:
+            writer = index.writer()
+
+        start = time.time()
+        total = 0
+
+        try:
+            for offerings in _offering_batches(batch_size):
+                descriptions = [off.offering_description for off in offerings]
+
+                # The USDL text extraction is the most expensive step
+                if pool is not None:
+                    texts = pool.map(_extract_text, descriptions)
+                else:
+                    texts = [_extract_text(desc) for desc in descriptions]
+
+                for offering, text in zip(offerings, texts):
+                    writer.add_document(**se.get_document(offering, text=text))
+
+                total += len(offerings)
+                self.stdout.write('%d offerings processed\n' % total)
+
+            writer.commit()
+        except:
+            writer.cancel()
+            rmtree(version_path, True)
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return total, time.time() - start, version_path
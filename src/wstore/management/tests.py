@@ -22,15 +22,20 @@
 from __future__ import unicode_literals
 
 import os
+from shutil import rmtree
 
 from mock import MagicMock
 from nose_parameterized import parameterized
+from whoosh.index import open_dir
 
 from django.test import TestCase
 from django.conf import settings
 from django.core.management import call_command
+from django.core.management.base import CommandError
 
-from wstore.management.commands import configureproject, createindexes, createtags
+from wstore.models import Offering
+from wstore.management.commands import configureproject, createindexes, createtags, rebuild_search_index
+from wstore.search.index_journal import get_journal_path, journal_updates, start_journal
 
 
 class ConfigureProjectTestCase(TestCase):
@@ -195,3 +200,90 @@ class CreateTagIndexesTestCase(IndexTestCase):
             'module': 'social'
         }
         self._index_tst(info, input_=input_, side_effect=side_effect, completed=completed)
+
+
+class RebuildSearchIndexTestCase(TestCase):
+
+    tags = ('management',)
+    fixtures = ['create_index.json']
+
+    def setUp(self):
+        self._datadir = os.path.join(settings.DATADIR, 'test', 'rebuild')
+        rebuild_search_index.settings = MagicMock()
+        rebuild_search_index.settings.DATADIR = self._datadir
+
+        # Mock the database cursor
+        offerings = list(Offering.objects.all())
+        rebuild_search_index._offering_batches = MagicMock()
+        rebuild_search_index._offering_batches.return_value = [offerings]
+        TestCase.setUp(self)
+
+    def tearDown(self):
+        reload(rebuild_search_index)
+        rmtree(self._datadir, True)
+        TestCase.tearDown(self)
+
+    def test_rebuild_search_index(self):
+        index_path = os.path.join(self._datadir, 'search', 'indexes')
+
+        # Create an old index that must be replaced
+        os.makedirs(index_path)
+        open(os.path.join(index_path, 'old_file'), 'w').close()
+
+        call_command('rebuild_search_index', procs=1)
+
+        # The index path is a link to the directory of the new index
+        self.assertTrue(os.path.islink(index_path))
+        self.assertFalse(os.path.exists(os.path.join(index_path, 'old_file')))
+        self.assertFalse(os.path.exists(get_journal_path(index_path)))
+
+        index = open_dir(index_path)
+        with index.searcher() as searcher:
+            docs = list(searcher.documents())
+
+            self.assertEquals(len(docs), 1)
+            self.assertEquals(docs[0]['name'], 'test_offering')
+
+        # Only the previous version is kept after rebuilding again
+        first_version = os.path.realpath(index_path)
+        call_command('rebuild_search_index', procs=1)
+
+        versions = [name for name in os.listdir(os.path.dirname(index_path)) if name.startswith('indexes.v')]
+        self.assertEquals(len(versions), 2)
+        self.assertTrue(os.path.basename(first_version) in versions)
+        self.assertNotEquals(os.path.realpath(index_path), first_version)
+
+    def test_rebuild_search_index_journal(self):
+        index_path = os.path.join(self._datadir, 'search', 'indexes')
+        offering = Offering.objects.all()[0]
+
+        def offering_batches(batch_size):
+            # The offering is written to the live index while rebuilding
+            journal_updates(index_path, [offering.pk])
+            return []
+
+        rebuild_search_index._offering_batches = offering_batches
+        call_command('rebuild_search_index', procs=1)
+
+        index = open_dir(index_path)
+        with index.searcher() as searcher:
+            docs = list(searcher.documents())
+
+            self.assertEquals(len(docs), 1)
+            self.assertEquals(docs[0]['id'], unicode(offering.pk))
+
+        self.assertFalse(os.path.exists(get_journal_path(index_path)))
+
+    def test_rebuild_search_index_running(self):
+        index_path = os.path.join(self._datadir, 'search', 'indexes')
+        os.makedirs(index_path)
+        start_journal(index_path)
+
+        error = None
+        try:
+            call_command('rebuild_search_index', procs=1)
+        except CommandError as e:
+            error = e
+
+        self.assertTrue(error is not None)
+        self.assertFalse(os.path.islink(index_path))
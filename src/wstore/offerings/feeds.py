@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import time
+
+from wstore.models import Context, UserProfile
+from wstore.store_commons.database import get_database_connection
+
+
+# Offering lists of the context that are materialized as feeds
+FEEDS = ('newest', 'top_rated')
+
+
+def _get_feed_id(context, name):
+    return '%s:%s' % (unicode(context.pk), name)
+
+
+def _get_collection():
+    return get_database_connection().wstore_offering_feed
+
+
+def _build_feed(context, name, stored=None, changed=None):
+    """
+    Materialize the info of the offerings included in a list of the context.
+    The info of the offerings already included in the stored feed is reused
+    unless they are in the changed list
+    """
+    # Imported here in order to avoid a cross-reference import error
+    from wstore.offerings.offerings_management import get_offerings_base_info, load_offerings
+
+    if changed is None:
+        changed = []
+
+    pks = list(getattr(context, name))
+
+    entries = {}
+    if stored is not None:
+        entries = dict((entry['pk'], entry) for entry in stored['entries'])
+
+    missing = [pk for pk in pks if not pk in entries or pk in changed]
+    if len(missing):
+        offerings = load_offerings(missing)
+
+        for offering, info in zip(offerings, get_offerings_base_info(offerings)):
+            entries[offering.pk] = {
+                'pk': offering.pk,
+                'state': offering.state,
+                'payload': json.dumps(info)
+            }
+
+    feed_entries = [entries[pk] for pk in pks if pk in entries]
+    etag = hashlib.sha1(json.dumps(feed_entries).encode('utf-8')).hexdigest()
+
+    if stored is not None and stored['offerings'] == pks and stored['etag'] == etag:
+        return stored
+
+    feed = {
+        '_id': _get_feed_id(context, name),
+        'offerings': pks,
+        'entries': feed_entries,
+        'etag': etag,
+        'last_modified': int(time.time())
+    }
+    _get_collection().save(feed)
+
+    return feed
+
+
+def update_feeds(context, changed=None):
+    """
+    Update the feeds of a context after its offering lists or the
+    offerings included in changed have been modified
+    """
+    collection = _get_collection()
+
+    for name in FEEDS:
+        stored = collection.find_one({'_id': _get_feed_id(context, name)})
+        _build_feed(context, name, stored=stored, changed=changed)
+
+
+def refresh_offering_feeds(offering):
+    """
+    Update the info of an offering in the feeds that include it
+    """
+    for context in Context.objects.all():
+        if offering.pk in context.newest or offering.pk in context.top_rated:
+            update_feeds(context, changed=[offering.pk])
+
+
+def get_feed(context, name, user):
+    """
+    Returns the info of the offerings of a feed for a given user together
+    with the ETag and the last modification time of the response. Offerings
+    purchased or rated by the user are loaded including the user info
+    """
+    # Imported here in order to avoid a cross-reference import error
+    from wstore.offerings.offerings_management import get_offerings_info, get_user_state, load_offerings
+
+    if not name in FEEDS:
+        raise ValueError('Invalid feed')
+
+    stored = _get_collection().find_one({'_id': _get_feed_id(context, name)})
+
+    # Build the feed if the offering list has been modified without updating it
+    if stored is None or stored['offerings'] != list(getattr(context, name)):
+        stored = _build_feed(context, name, stored=stored)
+
+    user_profile = UserProfile.objects.get(user=user)
+    user_org = user_profile.is_user_org()
+
+    result = []
+    states = []
+    personal = []
+    for entry in stored['entries']:
+        state = get_user_state(entry['pk'], entry['state'], user, user_profile, user_org)
+        states.append(state)
+
+        if state != entry['state']:
+            personal.append(entry['pk'])
+            result.append(entry['pk'])
+        else:
+            result.append(json.loads(entry['payload']))
+
+    if len(personal):
+        offerings = load_offerings(personal)
+        infos = dict(zip([off.pk for off in offerings], get_offerings_info(offerings, user)))
+
+        # Replace the pks of the user specific offerings with their info
+        result = [info if isinstance(info, dict) else infos[info] for info in result if isinstance(info, dict) or info in infos]
+
+    # The states of the offerings are the only user dependent info
+    etag = hashlib.sha1((stored['etag'] + ':' + ','.join(states)).encode('utf-8')).hexdigest()
+
+    return result, etag, stored['last_modified']
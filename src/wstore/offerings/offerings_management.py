@@ -30,11 +30,11 @@ import traceback
 
 from StringIO import StringIO
 from datetime import datetime
-from pymongo import MongoClient
 from bson.objectid import ObjectId
 from urlparse import urlparse
 
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.template import loader
 from django.template import Context as TmplContext
 from django.core.exceptions import PermissionDenied
@@ -43,50 +43,66 @@ from wstore.repository_adaptor.repositoryAdaptor import RepositoryAdaptor
 from wstore.market_adaptor.marketadaptor import MarketAdaptor
 from wstore.search.search_engine import SearchEngine
 from wstore.offerings.offering_rollback import OfferingRollback
+from wstore.offerings.feeds import update_feeds, refresh_offering_feeds
 from wstore.models import Offering, Repository, Resource
 from wstore.models import Marketplace
 from wstore.models import Purchase
-from wstore.models import UserProfile, Context
+from wstore.models import UserProfile, Context, Organization
 from wstore.store_commons.utils.usdlParser import USDLParser, validate_usdl
 from wstore.store_commons.utils.version import is_lower_version
 from wstore.store_commons.utils.name import is_valid_id
 from wstore.store_commons.utils.url import is_valid_url
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.utils.cursor import encode_cursor, decode_cursor
 from wstore.social.tagging.tag_manager import TagManager
 
 logger = logging.getLogger('wstore.offerings.offerings_management')
 
-####
-
-def get_offering_info(offering, user):
+# Types of the sort values included in the cursors, missing sort
+# values are included as None
+_CURSOR_TYPES = {
+    'publication_date': (datetime, type(None)),
+    'creation_date': (datetime, type(None)),
+    'rating': (int, long, float, type(None)),
+    'name': (unicode, type(None))
+}
 
-    user_profile = UserProfile.objects.get(user=user)
-
-    # Check if the user has purchased the offering
-    state = offering.state
+####
 
+def get_user_state(offering_pk, state, user, user_profile, user_org):
+    """
+    Get the state of an offering from the point of view of the user
+    """
     # Check if the current organization is the user organization
-    if user_profile.is_user_org():
+    if user_org:
 
-        if offering.pk in user_profile.offerings_purchased:
+        if offering_pk in user_profile.offerings_purchased:
             state = 'purchased'
-            purchase = Purchase.objects.get(offering=offering, customer=user, organization_owned=False)
 
-        if offering.pk in user_profile.rated_offerings:
+        if offering_pk in user_profile.rated_offerings:
             state = 'rated'
 
     else:
-        if offering.pk in user_profile.current_organization.offerings_purchased:
+        organization = user_profile.current_organization
+
+        if offering_pk in organization.offerings_purchased:
             state = 'purchased'
-            purchase = Purchase.objects.get(offering=offering, owner_organization=user_profile.current_organization)
 
-        if user_profile.current_organization.has_rated_offering(user, offering):
-            state = 'rated'
+        for rate in organization.rated_offerings:
+            if rate['user'] == user.pk and rate['offering'] == offering_pk:
+                state = 'rated'
+                break
+
+    return state
+
+
+def _build_offering_info(offering, state, owner_organization, owner_admin_user, resources, purchase, contract):
 
     # Load offering data
     result = {
         'name': offering.name,
-        'owner_organization': offering.owner_organization.name,
-        'owner_admin_user_id': offering.owner_admin_user.username,
+        'owner_organization': owner_organization.name,
+        'owner_admin_user_id': owner_admin_user.username,
         'version': offering.version,
         'state': state,
         'description_url': offering.description_url,
@@ -103,7 +119,7 @@ def get_offering_info(offering, user):
 
     # Load resources
     for res in offering.resources:
-        resource = Resource.objects.get(pk=res)
+        resource = resources[res]
         res_info = {
             'name': resource.name,
             'version': resource.version,
@@ -128,14 +144,14 @@ def get_offering_info(offering, user):
     parser = USDLParser(json.dumps(offering.offering_description), 'application/json')
     result['offering_description'] = parser.parse()
 
-    if not offering.open and (state == 'purchased' or state == 'rated'):
+    if not offering.open and purchase is not None and (state == 'purchased' or state == 'rated'):
         result['bill'] = purchase.bill
 
         # If the offering has been purchased the parsed pricing model is replaced
         # With the pricing model of the contract in order to included the extra info
         # needed such as renovation dates etc.
 
-        pricing_model = purchase.contract.pricing_model
+        pricing_model = contract.pricing_model
 
         if 'subscription' in pricing_model:
             result['offering_description']['pricing']['price_plans'][0]['price_components'] = []
@@ -154,7 +170,130 @@ def get_offering_info(offering, user):
     return result
 
 
-def _get_purchased_offerings(user, db, pagination=None, sort=None):
+def _load_offerings_relations(offerings):
+    """
+    Load the resources and owners of a list of offerings using a single
+    query for each model
+    """
+    resource_ids = set()
+    organization_ids = set()
+    user_ids = set()
+
+    for offering in offerings:
+        resource_ids.update(offering.resources)
+        organization_ids.add(offering.owner_organization_id)
+        user_ids.add(offering.owner_admin_user_id)
+
+    resources = {}
+    if len(resource_ids):
+        resources = dict((res.pk, res) for res in Resource.objects.filter(pk__in=list(resource_ids)))
+
+    organizations = {}
+    if len(organization_ids):
+        organizations = dict((org.pk, org) for org in Organization.objects.filter(pk__in=list(organization_ids)))
+
+    users = {}
+    if len(user_ids):
+        users = dict((usr.pk, usr) for usr in User.objects.filter(pk__in=list(user_ids)))
+
+    return resources, organizations, users
+
+
+def get_offerings_base_info(offerings):
+    """
+    Returns the info of a list of offerings as seen by users that have
+    neither purchased nor rated them
+    """
+    resources, organizations, users = _load_offerings_relations(offerings)
+
+    return [_build_offering_info(
+        offering,
+        offering.state,
+        organizations[offering.owner_organization_id],
+        users[offering.owner_admin_user_id],
+        resources,
+        None,
+        None
+    ) for offering in offerings]
+
+
+def get_offerings_info(offerings, user):
+    """
+    Returns the info of a list of offerings. The user profile is loaded once,
+    and the purchases, resources and owners of all the offerings are loaded
+    with a single query each
+    """
+    # Imported here in order to avoid a cross-reference import error
+    from wstore.charging_engine.models import Contract
+
+    user_profile = UserProfile.objects.get(user=user)
+    user_org = user_profile.is_user_org()
+
+    states = {}
+    purchased = []
+
+    for offering in offerings:
+        state = get_user_state(offering.pk, offering.state, user, user_profile, user_org)
+        states[offering.pk] = state
+
+        if (state == 'purchased' or state == 'rated') and not offering.open:
+            purchased.append(offering.pk)
+
+    # Load the purchases and contracts of the purchased offerings
+    purchases = {}
+    contracts = {}
+    if len(purchased):
+        if user_org:
+            purchase_query = Purchase.objects.filter(offering__in=purchased, customer=user, organization_owned=False)
+        else:
+            purchase_query = Purchase.objects.filter(offering__in=purchased, owner_organization=user_profile.current_organization)
+
+        for purchase in purchase_query:
+            purchases[purchase.offering_id] = purchase
+
+        if len(purchases):
+            for contract in Contract.objects.filter(purchase__in=[purchase.pk for purchase in purchases.values()]):
+                contracts[contract.purchase_id] = contract
+
+    resources, organizations, users = _load_offerings_relations(offerings)
+
+    result = []
+    for offering in offerings:
+        purchase = purchases.get(offering.pk)
+        contract = None
+        if purchase is not None:
+            contract = contracts.get(purchase.pk)
+
+        result.append(_build_offering_info(
+            offering,
+            states[offering.pk],
+            organizations[offering.owner_organization_id],
+            users[offering.owner_admin_user_id],
+            resources,
+            purchase,
+            contract
+        ))
+
+    return result
+
+
+def get_offering_info(offering, user):
+    return get_offerings_info([offering], user)[0]
+
+
+def load_offerings(pks):
+    """
+    Loads a list of offerings with a single query keeping the order of
+    the given pks, offerings that does not exist are not included
+    """
+    offerings = {}
+    if len(pks):
+        offerings = dict((off.pk, off) for off in Offering.objects.filter(pk__in=list(pks)))
+
+    return [offerings[pk] for pk in pks if pk in offerings]
+
+
+def _get_purchased_ids(user, db):
 
     # Get the user profile purchased offerings
     user_profile = db.wstore_userprofile.find_one({'user_id': ObjectId(user.pk)})
@@ -169,43 +308,74 @@ def _get_purchased_offerings(user, db, pagination=None, sort=None):
         # all user offerings
 
         user_purchased = user_profile['offerings_purchased']
+        included = set(user_purchased)
 
         # Append user offerings from organization offerings
         for offer in organization['offerings_purchased']:
-            if not offer in user_purchased:
+            if not offer in included:
                 user_purchased.append(offer)
+                included.add(offer)
+
+    return user_purchased
+
+
+def _get_purchased_offerings(user, db, pagination=None, sort=None):
+
+    user_purchased = _get_purchased_ids(user, db)
+
+    if sort is None:
+        # Keep the order of the purchase lists
+        if pagination:
+            skip = int(pagination['skip']) - 1
+            limit = int(pagination['limit'])
+            user_purchased = user_purchased[skip:(skip + limit)]
+
+        return user_purchased
 
-    # Check sorting
+    # Sort and paginate the purchased offerings in the database, the
+    # offering id is used for breaking ties so pages are stable
+    order = -1
+    if sort == 'name':
+        order = 1
 
-    if sort == 'creation_date':
-        user_purchased = sorted(user_purchased, key=lambda off: Offering.objects.get(pk=off).creation_date, reverse=True)
-    elif sort == 'publication_date':
-        user_purchased = sorted(user_purchased, key=lambda off: Offering.objects.get(pk=off).publication_date, reverse=True)
-    elif sort == 'name':
-        user_purchased = sorted(user_purchased, key=lambda off: Offering.objects.get(pk=off).name)
-    elif sort == 'rating':
-        user_purchased = sorted(user_purchased, key=lambda off: Offering.objects.get(pk=off).rating, reverse=True)
+    purchased = db.wstore_offering.find({
+        '_id': {'$in': [ObjectId(off) for off in user_purchased]}
+    }, {'_id': True}).sort([(sort, order), ('_id', order)])
 
     # If pagination has been defined take the offerings corresponding to the page
     if pagination:
-        skip = int(pagination['skip']) - 1
-        limit = int(pagination['limit'])
+        purchased = purchased.skip(int(pagination['skip']) - 1).limit(int(pagination['limit']))
 
-        if skip < len(user_purchased):
-            user_purchased = user_purchased[skip:(skip + limit)]
+    return purchased
+
+
+# Gets a set of offerings depending on filter value
+def _iter_offerings_info(prov_offerings, user, batch_size=50):
+
+    batch = []
+    for offer in prov_offerings:
+        if '_id' in offer:
+            pk = str(offer['_id'])
         else:
-            user_purchased = []
+            pk = offer
 
-    return user_purchased
+        batch.append(pk)
 
+        # Offerings are loaded and processed in batches while the cursor is read
+        if len(batch) == batch_size:
+            for info in get_offerings_info(load_offerings(batch), user):
+                yield info
+            batch = []
 
-# Gets a set of offerings depending on filter value
-def get_offerings(user, filter_='published', owned=False, pagination=None, sort=None):
+    if len(batch):
+        for info in get_offerings_info(load_offerings(batch), user):
+            yield info
 
-    if pagination and (not int(pagination['skip']) > 0 or not int(pagination['limit']) > 0):
-        raise Exception('Invalid pagination limits')
 
-    # Set sorting values
+def _get_sorting(filter_, owned, sort):
+    """
+    Returns the field and the order used for sorting the offerings
+    """
     order = -1
     if sort == None or sort == 'date':
         if not owned and  filter_ == 'published':
@@ -219,12 +389,13 @@ def get_offerings(user, filter_='published', owned=False, pagination=None, sort=
         if sorting == 'name':
             order = 1
 
-    # Get all the offerings owned by the provider using raw mongodb access
-    connection = MongoClient()
-    db = connection[settings.DATABASES['default']['NAME']]
-    offerings = db.wstore_offering
+    return sorting, order
 
-    # Pagination: define the first element and the number of elements
+
+def _get_offerings_query(user, db, filter_, owned):
+    """
+    Returns the raw query of the offerings included in a filter
+    """
     if owned and filter_ != 'purchased':
         current_organization = user.userprofile.current_organization
         query = {
@@ -237,9 +408,39 @@ def get_offerings(user, filter_='published', owned=False, pagination=None, sort=
         elif  filter_ == 'published':
             query['state'] = 'published'
 
-        prov_offerings = offerings.find(query).sort(sorting, order)
-
     elif owned and filter_ == 'purchased':
+        query = {
+            '_id': {'$in': [ObjectId(off) for off in _get_purchased_ids(user, db)]}
+        }
+
+    elif filter_ == 'published':
+        query = {'state': 'published'}
+
+    else:
+        raise ValueError('Invalid filter')
+
+    return query
+
+
+def iter_offerings(user, filter_='published', owned=False, pagination=None, sort=None):
+    """
+    Returns a generator of the info of the offerings. The query is validated
+    when this function is called, while the offerings are loaded from the
+    database cursor as the generator is consumed
+    """
+
+    if pagination and (not int(pagination['skip']) > 0 or not int(pagination['limit']) > 0):
+        raise Exception('Invalid pagination limits')
+
+    # Set sorting values
+    sorting, order = _get_sorting(filter_, owned, sort)
+
+    # Get all the offerings owned by the provider using raw mongodb access
+    db = get_database_connection()
+    offerings = db.wstore_offering
+
+    # Pagination: define the first element and the number of elements
+    if owned and filter_ == 'purchased':
         if pagination:
             prov_offerings = _get_purchased_offerings(user, db, pagination, sort=sorting)
             pagination = None
@@ -247,25 +448,77 @@ def get_offerings(user, filter_='published', owned=False, pagination=None, sort=
             prov_offerings = _get_purchased_offerings(user, db, sort=sorting)
 
     else:
-        if  filter_ == 'published':
-            prov_offerings = offerings.find({'state': 'published'}).sort(sorting, order)
+        prov_offerings = offerings.find(_get_offerings_query(user, db, filter_, owned)).sort(sorting, order)
 
     if pagination:
         prov_offerings = prov_offerings.skip(int(pagination['skip']) - 1).limit(int(pagination['limit']))
 
-    result = []
+    return _iter_offerings_info(prov_offerings, user)
 
-    for offer in prov_offerings:
-        if '_id' in offer:
-            pk = str(offer['_id'])
-        else:
-            pk = offer
 
-        offering = Offering.objects.get(pk=pk)
-        # Use get_offering_info to create the JSON with the offering info
-        result.append(get_offering_info(offering, user))
+def get_offerings_page(user, filter_='published', owned=False, cursor=None, limit=None, sort=None):
+    """
+    Returns a page of the info of the offerings placed after a cursor
+    together with the cursor of the next page, which is None if there are
+    not more offerings. The sort value and the id of the last offering are
+    used as cursor, so deep pages do not need to skip the previous ones
+    """
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid pagination limits')
+
+    if not limit > 0:
+        raise ValueError('Invalid pagination limits')
 
-    return result
+    sorting, order = _get_sorting(filter_, owned, sort)
+
+    db = get_database_connection()
+    query = _get_offerings_query(user, db, filter_, owned)
+
+    if cursor:
+        value, last_id = decode_cursor(cursor, types=(_CURSOR_TYPES.get(sorting, ()), ObjectId))
+        query['$or'] = _get_keyset_query(sorting, order, value, last_id)
+
+    # An extra offering is read to know if there is a next page
+    page = list(db.wstore_offering.find(query, {sorting: True}).sort([(sorting, order), ('_id', order)]).limit(limit + 1))
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1].get(sorting), page[-1]['_id'])
+
+    offerings = load_offerings([unicode(off['_id']) for off in page])
+
+    return get_offerings_info(offerings, user), next_cursor
+
+
+def _get_keyset_query(sorting, order, value, last_id):
+    """
+    Returns the conditions of the offerings placed after the given sort
+    value and id
+    """
+    operator = '$lt'
+    if order == 1:
+        operator = '$gt'
+
+    conditions = [{
+        sorting: value,
+        '_id': {operator: last_id}
+    }]
+
+    if value is not None:
+        conditions.append({sorting: {operator: value}})
+
+        # Missing values are placed at the end of descending sorts
+        if order == -1:
+            conditions.append({sorting: None})
+
+    return conditions
+
+
+def get_offerings(user, filter_='published', owned=False, pagination=None, sort=None):
+    return list(iter_offerings(user, filter_, owned=owned, pagination=pagination, sort=sort))
 
 
 def count_offerings(user, filter_='published', owned=False):
@@ -787,6 +1040,9 @@ def update_offering(offering, data):
     se = SearchEngine(index_path)
     se.update_index(offering)
 
+    # Open offerings can be updated while included in the home feeds
+    refresh_offering_feeds(offering)
+
 
 def publish_offering(offering, data):
 
@@ -908,6 +1164,8 @@ def delete_offering(offering):
             se.update_index(offering)
 
         context = Context.objects.all()[0]
+        in_feeds = offering.pk in context.newest or offering.pk in context.top_rated
+
         # Check if the offering is in the newest list
         if offering.pk in context.newest:
             # Remove the offering from the newest list
@@ -917,8 +1175,7 @@ def delete_offering(offering):
                 newest.remove(offering.pk)
             else:
                 # Get the 8 newest offerings using the publication date for sorting
-                connection = MongoClient()
-                db = connection[settings.DATABASES['default']['NAME']]
+                db = get_database_connection()
                 offerings = db.wstore_offering
                 newest_off = offerings.find({'state': 'published'}).sort('publication_date', -1).limit(8)
 
@@ -937,8 +1194,7 @@ def delete_offering(offering):
                 top_rated.remove(offering.pk)
             else:
                 # Get the 4 top rated offerings
-                connection = MongoClient()
-                db = connection[settings.DATABASES['default']['NAME']]
+                db = get_database_connection()
                 offerings = db.wstore_offering
                 top_off = offerings.find({'state': 'published', 'rating': {'$gt': 0}}).sort('rating', -1).limit(8)
 
@@ -949,6 +1205,9 @@ def delete_offering(offering):
             context.top_rated = top_rated
             context.save()
 
+        if in_feeds:
+            update_feeds(context)
+
         if offering.open:
             _remove_offering(offering, se)
 
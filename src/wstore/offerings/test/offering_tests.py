@@ -32,17 +32,20 @@ from bson.objectid import ObjectId
 
 from django.test import TestCase
 from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.test.utils import override_settings
 
 from wstore.offerings import offerings_management
+from wstore.offerings import feeds
 from wstore.store_commons.utils.usdlParser import USDLParser
 from wstore.models import UserProfile
 from wstore.models import Offering
 from wstore.models import Marketplace
 from wstore.models import Resource
 from wstore.models import Organization
+from wstore.models import Context
 
 from wstore.offerings.test.offering_test_data import *
 
@@ -854,6 +857,87 @@ class PurchasedOfferingRetrievingTestCase(TestCase):
                 self.assertEqual(components[1]['title'], 'price component 2')
                 self.assertEqual(components[1]['renovation_date'], '1990-02-05 17:06:46')
 
+    def test_get_offerings_info_batch(self):
+        user = User.objects.get(username='test_user2')
+        profile = UserProfile.objects.get(user=user)
+        org = Organization.objects.get(name='test_organization1')
+        org.offerings_purchased = ['21000aba8e05ac2115f022ff', '11000aba8e05ac2115f022f9']
+        org.save()
+        profile.current_organization = org
+        profile.organizations.append({
+            'organization': org.pk,
+            'roles': ['customer', 'provider']
+        })
+        profile.save()
+
+        pks = ['21000aba8e05ac2115f022ff', 'aaaaaaaaaaaaaaaaaaaaaaaa', '11000aba8e05ac2115f022f9']
+
+        # Offerings that does not exist are skipped keeping the order
+        offerings = offerings_management.load_offerings(pks)
+        self.assertEquals([off.pk for off in offerings], [pks[0], pks[2]])
+
+        result = offerings_management.get_offerings_info(offerings, user)
+
+        self.assertEquals([off['name'] for off in result], ['test_offering2', 'test_offering1'])
+        for off in result:
+            self.assertEqual(off['state'], 'purchased')
+            self.assertEqual(len(off['bill']), 1)
+
+        self.assertEquals(result[1]['bill'][0], '/media/bills/61005aba8e05ac2115f022f0.pdf')
+        self.assertEquals(result[0]['bill'][0], '/media/bills/61006aba8e05ac2115f022f0.pdf')
+
+    def test_get_newest_feed(self):
+        user = User.objects.get(username='test_user2')
+        profile = UserProfile.objects.get(user=user)
+        org = Organization.objects.get(name='test_organization1')
+        org.offerings_purchased = ['21000aba8e05ac2115f022ff']
+        org.save()
+        profile.current_organization = org
+        profile.organizations.append({
+            'organization': org.pk,
+            'roles': ['customer', 'provider']
+        })
+        profile.save()
+
+        context = Context.objects.get_or_create(site=Site.objects.all()[0])[0]
+        context.newest = ['31000aba8e05ac2115f022f0', '21000aba8e05ac2115f022ff', '11000aba8e05ac2115f022f9']
+        context.save()
+
+        feeds.update_feeds(context)
+
+        result, etag, last_modified = feeds.get_feed(context, 'newest', user)
+
+        self.assertEquals([off['name'] for off in result], ['test_offering3', 'test_offering2', 'test_offering1'])
+        self.assertEquals([off['state'] for off in result], ['published', 'purchased', 'published'])
+        self.assertEquals(result[1]['bill'][0], '/media/bills/61006aba8e05ac2115f022f0.pdf')
+
+        # The stored entries are reused while the offerings do not change
+        base_info = offerings_management.get_offerings_base_info
+        offerings_management.get_offerings_base_info = MagicMock(name='get_offerings_base_info')
+        try:
+            feeds.update_feeds(context)
+            second_result, second_etag, second_modified = feeds.get_feed(context, 'newest', user)
+            self.assertFalse(offerings_management.get_offerings_base_info.called)
+        finally:
+            offerings_management.get_offerings_base_info = base_info
+
+        self.assertEquals(second_result, result)
+        self.assertEquals(second_etag, etag)
+        self.assertEquals(second_modified, last_modified)
+
+        # The ETag depends on the states of the offerings for the user
+        org.offerings_purchased = []
+        org.save()
+
+        other_result, other_etag, other_modified = feeds.get_feed(context, 'newest', user)
+        self.assertEquals(other_result[1]['state'], 'published')
+        self.assertFalse('bill' in other_result[1])
+        self.assertNotEquals(other_etag, etag)
+        self.assertEquals(other_modified, last_modified)
+
+        # Invalid feed
+        self.assertRaises(ValueError, feeds.get_feed, context, 'invalid', user)
+
     def test_get_published_offerings(self):
         user = User.objects.get(username='test_user2')
         profile = UserProfile.objects.get(user=user)
@@ -982,6 +1066,58 @@ class OfferingPaginationTestCase(TestCase):
 
         self._check_offerings(offerings, ['test_offering7', 'test_offering8', 'test_offering9'])
 
+    def test_retrieving_cursor_pagination(self):
+        user = User.objects.get(username='test_user')
+        org = Organization.objects.get(name='test_organization')
+        user.userprofile.current_organization = org
+        user.userprofile.organizations.append({
+            'organization': org.pk,
+            'roles': ['customer', 'provider']
+        })
+        user.userprofile.save()
+
+        names = []
+        pages = 0
+        cursor = ''
+        while cursor is not None:
+            offerings, cursor = offerings_management.get_offerings_page(user, filter_='all', owned=True, cursor=cursor, limit='4', sort='name')
+            names.extend([off['name'] for off in offerings])
+            pages += 1
+
+        self.assertEquals(pages, 3)
+        self.assertEquals(names, sorted(['test_offering' + unicode(i) for i in range(1, 11)]))
+
+        # Pages are built using the sort value and the id of the last offering
+        offerings, cursor = offerings_management.get_offerings_page(user, filter_='all', owned=True, limit='3')
+        date_offerings = [off['name'] for off in offerings]
+
+        offerings, cursor = offerings_management.get_offerings_page(user, filter_='all', owned=True, cursor=cursor, limit='7')
+        date_offerings.extend([off['name'] for off in offerings])
+
+        self.assertEquals(cursor, None)
+        # All the offerings have the same creation date so the id is used
+        expected = sorted(Offering.objects.filter(owner_organization=org), key=lambda off: off.pk, reverse=True)
+        self.assertEquals(date_offerings, [off.name for off in expected])
+
+    @parameterized.expand([
+        ('invalid_cursor', 'invalid', '3', 'Invalid cursor'),
+        ('operator_cursor', offerings_management.encode_cursor({'$ne': None}, ObjectId('61000aba8e05ac2115f022f9')), '3', 'Invalid cursor'),
+        ('mismatched_cursor', offerings_management.encode_cursor('test_offering', ObjectId('61000aba8e05ac2115f022f9')), '3', 'Invalid cursor'),
+        ('invalid_id_cursor', offerings_management.encode_cursor(datetime(2013, 4, 1), '61000aba8e05ac2115f022f9'), '3', 'Invalid cursor'),
+        ('invalid_limit', '', '0', 'Invalid pagination limits'),
+        ('missing_limit', '', None, 'Invalid pagination limits')
+    ])
+    def test_retrieving_cursor_pagination_error(self, name, cursor, limit, msg):
+        user = User.objects.get(username='test_user')
+
+        error = None
+        try:
+            offerings_management.get_offerings_page(user, filter_='all', owned=True, cursor=cursor, limit=limit)
+        except ValueError as e:
+            error = e
+
+        self.assertEquals(unicode(error), msg)
+
     def test_retrieving_pagination_invalid_limit(self):
         pagination = {
             'skip': '1',
@@ -1060,6 +1196,29 @@ class PurchasedOfferingPaginationTestCase(TestCase):
         self.assertEqual(offerings[0]['name'], 'test_offering4')
         self.assertEqual(offerings[1]['name'], 'test_offering5')
 
+    def test_retrieving_pagination_purchased_user_org(self):
+
+        pagination = {
+            'skip': '2',
+            'limit': '2'
+        }
+        user = User.objects.get(username='test_user')
+        profile = UserProfile.objects.get(user=user)
+        profile.offerings_purchased = ['11000aba8e05ac2115f022f9', '21000aba8e05ac2115f022ff', '31000aba8e05ac2115f022f0']
+        profile.save()
+
+        org = profile.current_organization
+        org.offerings_purchased = ['21000aba8e05ac2115f022ff', '41000aba8e05ac2115f022f0']
+        org.save()
+
+        # User and organization purchases are merged, sorted and paginated in the database
+        purchased = ['11000aba8e05ac2115f022f9', '21000aba8e05ac2115f022ff', '31000aba8e05ac2115f022f0', '41000aba8e05ac2115f022f0']
+        expected = sorted(Offering.objects.filter(pk__in=purchased), key=lambda off: off.name)
+
+        offerings = offerings_management.get_offerings(user, filter_='purchased', owned=True, pagination=pagination, sort='name')
+
+        self.assertEqual([off['name'] for off in offerings], [off.name for off in expected[1:3]])
+
 
 class OfferingPublicationTestCase(TestCase):
 
@@ -1283,6 +1442,7 @@ class OfferingDeletionTestCase(TestCase):
         self.context_obj.newest = []
         self.context_obj.top_rated = []
         offerings_management.Context.objects.all.return_value = [self.context_obj]
+        offerings_management.update_feeds = MagicMock()
 
     def tearDown(self):
         reload(offerings_management)
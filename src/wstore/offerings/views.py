@@ -28,14 +28,16 @@ from urllib2 import HTTPError
 from django.http import HttpResponse
 from django.contrib.sites.models import get_current_site
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
+from django.utils.http import http_date
 
 from wstore.store_commons.resource import Resource
 from wstore.store_commons.utils.http import build_response, get_content_type, supported_request_mime_types, \
-authentication_required
+authentication_required, stream_json_list, StreamingHttpResponse
 from wstore.models import Offering, Organization, Resource as OfferingResource
 from wstore.models import Context
 from wstore.offerings.offerings_management import create_offering, get_offerings, get_offering_info, delete_offering,\
-publish_offering, bind_resources, count_offerings, update_offering
+publish_offering, bind_resources, count_offerings, update_offering, iter_offerings, get_offerings_page
+from wstore.offerings.feeds import get_feed, update_feeds
 from wstore.offerings.resources_management import register_resource, get_provider_resources, delete_resource,\
 update_resource, upgrade_resource
 from wstore.store_commons.utils.method_request import MethodRequest
@@ -110,9 +112,27 @@ class OfferingCollection(Resource):
                 'skip': request.GET.get('start', None),
                 'limit': request.GET.get('limit', None)
             }
+            cursor = request.GET.get('cursor', None)
+            stream = False
 
             if action != 'count':
-                if pagination['skip'] and pagination['limit']:
+                if cursor is not None:
+                    # Cursor pagination, an empty cursor requests the first page
+                    if filter_ == 'provided':
+                        result, next_cursor = get_offerings_page(user, request.GET.get('state'), owned=True, cursor=cursor, limit=pagination['limit'], sort=sort)
+
+                    elif filter_ == 'published':
+                        result, next_cursor = get_offerings_page(user, cursor=cursor, limit=pagination['limit'], sort=sort)
+
+                    elif filter_ == 'purchased':
+                        result, next_cursor = get_offerings_page(user, 'purchased', owned=True, cursor=cursor, limit=pagination['limit'], sort=sort)
+
+                    result = {
+                        'results': result,
+                        'next_cursor': next_cursor
+                    }
+
+                elif pagination['skip'] and pagination['limit']:
                     if filter_ == 'provided':
                         result = get_offerings(user, request.GET.get('state'), owned=True, pagination=pagination, sort=sort)
 
@@ -122,14 +142,16 @@ class OfferingCollection(Resource):
                     elif filter_ == 'purchased':
                         result = get_offerings(user, 'purchased', owned=True, pagination=pagination, sort=sort)
                 else:
+                    # Without pagination the offerings are streamed
+                    stream = True
                     if filter_ == 'provided':
-                        result = get_offerings(user, request.GET.get('state'), owned=True, sort=sort)
+                        result = iter_offerings(user, request.GET.get('state'), owned=True, sort=sort)
 
                     elif filter_ == 'published':
-                        result = get_offerings(user, sort=sort)
+                        result = iter_offerings(user, sort=sort)
 
                     elif filter_ == 'purchased':
-                        result = get_offerings(user, 'purchased', owned=True, sort=sort)
+                        result = iter_offerings(user, 'purchased', owned=True, sort=sort)
 
             else:
                 if filter_ == 'provided':
@@ -145,6 +167,9 @@ class OfferingCollection(Resource):
             return build_response(request, 400, unicode(e))
 
         mime_type = 'application/JSON; charset=UTF-8'
+        if stream:
+            return StreamingHttpResponse(stream_json_list(result), status=200, content_type=mime_type)
+
         return HttpResponse(json.dumps(result), status=200, mimetype=mime_type)
 
 
@@ -270,10 +295,23 @@ class PublishEntry(Resource):
             context.newest.insert(0, offering.pk)
 
         context.save()
+        update_feeds(context)
 
         return build_response(request, 200, 'OK')
 
 
+def _build_feed_response(response, etag, last_modified, mime_type):
+    """
+    Build the response of a feed including the headers used for
+    conditional requests
+    """
+    response = HttpResponse(json.dumps(response), status=200, mimetype=mime_type)
+    response['ETag'] = '"' + etag + '"'
+    response['Last-Modified'] = http_date(last_modified)
+
+    return response
+
+
 class NewestCollection(Resource):
 
     @authentication_required
@@ -282,12 +320,9 @@ class NewestCollection(Resource):
         site = get_current_site(request)
         context = Context.objects.get(site=site)
 
-        response = []
-        for off in context.newest:
-            offering = Offering.objects.get(pk=off)
-            response.append(get_offering_info(offering, request.user))
+        response, etag, last_modified = get_feed(context, 'newest', request.user)
 
-        return HttpResponse(json.dumps(response), status=200, mimetype='application/json')
+        return _build_feed_response(response, etag, last_modified, 'application/json')
 
 
 class TopRatedCollection(Resource):
@@ -298,12 +333,9 @@ class TopRatedCollection(Resource):
         site = get_current_site(request)
         context = Context.objects.get(site=site)
 
-        response = []
-        for off in context.top_rated:
-            offering = Offering.objects.get(pk=off)
-            response.append(get_offering_info(offering, request.user))
+        response, etag, last_modified = get_feed(context, 'top_rated', request.user)
 
-        return HttpResponse(json.dumps(response), status=200, mimetype='application/json;charset=UTF-8')
+        return _build_feed_response(response, etag, last_modified, 'application/json;charset=UTF-8')
 
 
 ####################################################################################################
@@ -547,6 +579,7 @@ class ReviewCollection(Resource):
         # Get pagination params
         start = request.GET.get('start', None)
         limit = request.GET.get('limit', None)
+        cursor = request.GET.get('cursor', None)
 
         # Get offering
         try:
@@ -559,7 +592,15 @@ class ReviewCollection(Resource):
         # Get reviews
         rm = ReviewManager()
         try:
-            response = rm.get_reviews(offering, start=start, limit=limit)
+            if cursor is not None:
+                # Cursor pagination, an empty cursor requests the first page
+                response, next_cursor = rm.get_reviews_page(offering, limit, cursor=cursor)
+                response = {
+                    'results': response,
+                    'next_cursor': next_cursor
+                }
+            else:
+                response = rm.get_reviews(offering, start=start, limit=limit)
         except PermissionDenied as e:
             return build_response(request, 403, unicode(e))
         except Exception as e:
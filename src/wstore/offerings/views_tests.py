@@ -81,13 +81,13 @@ class OfferingCollectionTestCase(TestCase):
 
         # Mock get offerings method
         offering_collection = views.OfferingCollection(permitted_methods=('GET', 'POST'))
-        views.get_offerings = MagicMock(name='get_offering')
+        views.iter_offerings = MagicMock(name='iter_offerings')
 
         # Not counting offerings
         #------------------------------------
         # Published
         #------------------------------------
-        views.get_offerings.return_value = return_value
+        views.iter_offerings.side_effect = lambda *args, **kwargs: iter(return_value)
         request = self.factory.get('/api/offering/offerings')
         request.user = self.user
 
@@ -95,11 +95,12 @@ class OfferingCollectionTestCase(TestCase):
         response = offering_collection.read(request)
 
         # Check correct call
-        views.get_offerings.assert_called_once_with(self.user, sort=None)
+        views.iter_offerings.assert_called_once_with(self.user, sort=None)
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get('Content-type'), 'application/JSON; charset=UTF-8')
-        body_response = json.loads(response.content)
+        # Unpaginated listings are streamed
+        body_response = json.loads(''.join(response))
 
         self.assertEqual(type(body_response), list)
         self.assertEqual(len(body_response), 1)
@@ -112,7 +113,7 @@ class OfferingCollectionTestCase(TestCase):
         # Provided
         #------------------------------------
 
-        views.get_offerings.reset_mock()
+        views.iter_offerings.reset_mock()
         request = self.factory.get('/api/offering/offerings?filter=provided')
         request.user = self.user
 
@@ -120,11 +121,11 @@ class OfferingCollectionTestCase(TestCase):
         response = offering_collection.read(request)
 
         # Check correct call
-        views.get_offerings.assert_called_once_with(self.user, None, sort=None, owned=True)
+        views.iter_offerings.assert_called_once_with(self.user, None, sort=None, owned=True)
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get('Content-type'), 'application/JSON; charset=UTF-8')
-        body_response = json.loads(response.content)
+        body_response = json.loads(''.join(response))
 
         self.assertEqual(type(body_response), list)
         self.assertEqual(len(body_response), 1)
@@ -136,7 +137,7 @@ class OfferingCollectionTestCase(TestCase):
         #--------------------------------------
         # Purchased
         #--------------------------------------
-        views.get_offerings.reset_mock()
+        views.iter_offerings.reset_mock()
         request = self.factory.get('/api/offering/offerings?filter=purchased')
         request.user = self.user
 
@@ -144,11 +145,11 @@ class OfferingCollectionTestCase(TestCase):
         response = offering_collection.read(request)
 
         # Check correct call
-        views.get_offerings.assert_called_once_with(self.user, 'purchased', sort=None, owned=True)
+        views.iter_offerings.assert_called_once_with(self.user, 'purchased', sort=None, owned=True)
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get('Content-type'), 'application/JSON; charset=UTF-8')
-        body_response = json.loads(response.content)
+        body_response = json.loads(''.join(response))
 
         self.assertEqual(type(body_response), list)
         self.assertEqual(len(body_response), 1)
@@ -221,6 +222,27 @@ class OfferingCollectionTestCase(TestCase):
         self.assertEqual(type(body_response), dict)
         self.assertEqual(body_response['number'], 3)
 
+    def test_get_offerings_cursor(self):
+        views.get_offerings_page = MagicMock(name='get_offerings_page')
+        views.get_offerings_page.return_value = ([{'name': 'test_offering'}], 'next')
+        offering_collection = views.OfferingCollection(permitted_methods=('GET', 'POST'))
+
+        request = self.factory.get('/api/offering/offerings?filter=purchased&cursor=abc&limit=1&sort=name')
+        request.user = self.user
+
+        # Call the view
+        response = offering_collection.read(request)
+
+        # Check correct call
+        views.get_offerings_page.assert_called_once_with(self.user, 'purchased', owned=True, cursor='abc', limit='1', sort='name')
+
+        self.assertEqual(response.status_code, 200)
+        body_response = json.loads(response.content)
+        self.assertEqual(body_response, {
+            'results': [{'name': 'test_offering'}],
+            'next_cursor': 'next'
+        })
+
     def test_create_offering_correct_request(self):
 
         data = {
@@ -1037,6 +1059,7 @@ class PublishEntryTestCase(TestCase):
 
         # Mock publish offering method
         views.publish_offering = MagicMock(name='publish_offering')
+        views.update_feeds = MagicMock(name='update_feeds')
         publish_entry = views.PublishEntry(permitted_methods=('POST',))
 
         offering = Offering.objects.create(
@@ -1066,6 +1089,10 @@ class PublishEntryTestCase(TestCase):
 
         views.publish_offering.assert_called_once_with(offering, self.data)
 
+        # The newest feed is updated with the published offering
+        context = views.update_feeds.call_args[0][0]
+        self.assertEqual(context.newest, [offering.pk])
+
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get('Content-type'), 'application/json; charset=utf-8')
         body_response = json.loads(response.content)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import logging
+import threading
+from datetime import datetime
+
+from django.conf import settings
+
+from wstore.models import RSS
+from wstore.rss_adaptor.rss_adaptor import RSSAdaptor
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.job_queue import JobQueue, WorkerPool, PENDING, FAILED
+
+
+logger = logging.getLogger('wstore.rss_adaptor.cdr_outbox')
+
+SENDING = 'sending'
+
+# Seconds a claimed batch is reserved for a worker, after that time its
+# CDRs are due again so a batch claimed by a dead process is not lost
+LEASE_TIME = 300
+
+# Maximum number of seconds between two retries of a CDR
+MAX_RETRY_DELAY = 3600
+
+outbox = JobQueue('wstore_cdr_outbox', SENDING, LEASE_TIME, max_retry_delay=MAX_RETRY_DELAY)
+
+
+def _get_collection():
+    return outbox.get_collection()
+
+
+def enqueue_cdrs(rss, cdrs):
+    """
+    Persists the CDRs of a charge in the outbox with a single bulk write.
+    CDRs are identified by the RSS and its correlation number, so enqueueing
+    a CDR again has no effect. If asynchronous delivery is disabled the due
+    CDRs are sent before returning
+    """
+    if not len(cdrs):
+        return
+
+    now = datetime.now()
+    bulk = _get_collection().initialize_unordered_bulk_op()
+
+    for cdr in cdrs:
+        doc = outbox.get_initial_fields(now)
+        doc['cdr'] = cdr
+
+        bulk.find({
+            'rss': unicode(rss.pk),
+            'correlation': int(cdr['correlation'])
+        }).upsert().update_one({
+            '$setOnInsert': doc
+        })
+
+    bulk.execute()
+
+    if getattr(settings, 'CDR_OUTBOX_ASYNC', True):
+        get_dispatcher().wake_up()
+    else:
+        deliver_due_cdrs()
+
+
+def record_reservation(rss, first, count, purchase):
+    """
+    Persists a block of correlation numbers reserved for the CDRs of a
+    charge, so numbers reserved by a charge whose CDRs never reached the
+    outbox can be audited
+    """
+    get_database_connection().wstore_cdr_reservation.insert({
+        'rss': unicode(rss.pk),
+        'first': first,
+        'count': count,
+        'purchase': unicode(purchase),
+        'created': datetime.now()
+    })
+
+
+def claim_batch(batch_size):
+    """
+    Reserves a batch of due CDRs of a single RSS, returns the claimed
+    outbox documents sorted by correlation number
+    """
+    return sorted(outbox.claim(batch_size, group_by='rss'), key=lambda doc: doc['correlation'])
+
+
+def deliver_batch(batch, max_attempts=10, retry_delay=30):
+    """
+    Sends a claimed batch to its RSS in a single CDR document. Delivered
+    CDRs are removed from the outbox, otherwise they are scheduled again
+    with an exponential backoff until max_attempts is reached. Returns
+    whether the batch has been delivered
+    """
+    if not len(batch):
+        return True
+
+    try:
+        rss = RSS.objects.get(pk=batch[0]['rss'])
+        RSSAdaptor(rss).send_cdr([doc['cdr'] for doc in batch])
+    except Exception as e:
+        error = unicode(e) or e.__class__.__name__
+        outbox.fail(batch, error, max_attempts, retry_delay)
+
+        logger.warning('Error sending %d CDRs to the RSS %s: %s' % (len(batch), batch[0]['rss'], error))
+        return False
+
+    outbox.complete(batch)
+    logger.debug('Sent %d CDRs to the RSS %s' % (len(batch), batch[0]['rss']))
+
+    return True
+
+
+def deliver_due_cdrs():
+    """
+    Sends the due CDRs of the outbox in the current thread, CDRs whose
+    delivery fails are left in the outbox waiting for their retry. Returns
+    the number of delivered CDRs
+    """
+    batch_size = getattr(settings, 'CDR_OUTBOX_BATCH_SIZE', 100)
+    max_attempts = getattr(settings, 'CDR_OUTBOX_MAX_ATTEMPTS', 10)
+    retry_delay = getattr(settings, 'CDR_OUTBOX_RETRY_DELAY', 30)
+
+    delivered = 0
+    batch = claim_batch(batch_size)
+
+    while len(batch):
+        if deliver_batch(batch, max_attempts, retry_delay):
+            delivered += len(batch)
+
+        batch = claim_batch(batch_size)
+
+    return delivered
+
+
+def get_outbox_stats():
+    """
+    Returns the backlog of the outbox, the number of CDRs in each state,
+    the creation date of the oldest undelivered CDR and the number of
+    undelivered CDRs of each RSS
+    """
+    return outbox.get_stats(group_by='rss')
+
+
+def get_failed_cdrs(limit=20):
+    """
+    Returns the outbox documents of the CDRs that could not be delivered
+    """
+    return outbox.get_failed(limit)
+
+
+def retry_failed_cdrs():
+    """
+    Schedules the failed CDRs to be delivered again, returns the number
+    of scheduled CDRs
+    """
+    return outbox.retry_failed()
+
+
+class CDRDispatcher(WorkerPool):
+    """
+    Bounded pool of workers draining the CDR outbox in batches of CDRs
+    of the same RSS
+    """
+
+    def __init__(self, workers=2, batch_size=100, max_attempts=10, retry_delay=30, poll_interval=10):
+        WorkerPool.__init__(self, workers=workers, poll_interval=poll_interval)
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+
+    def process(self):
+        batch = claim_batch(self._batch_size)
+
+        if not len(batch):
+            return None
+
+        if deliver_batch(batch, self._max_attempts, self._retry_delay):
+            return len(batch)
+
+        return 0
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """
+    Returns the CDR dispatcher of the process
+    """
+    global _dispatcher
+
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = CDRDispatcher(
+                workers=getattr(settings, 'CDR_OUTBOX_WORKERS', 2),
+                batch_size=getattr(settings, 'CDR_OUTBOX_BATCH_SIZE', 100),
+                max_attempts=getattr(settings, 'CDR_OUTBOX_MAX_ATTEMPTS', 10),
+                retry_delay=getattr(settings, 'CDR_OUTBOX_RETRY_DELAY', 30),
+                poll_interval=getattr(settings, 'CDR_OUTBOX_POLL_INTERVAL', 10)
+            )
+
+    return _dispatcher
+
+
+def start_dispatcher():
+    """
+    Starts the workers of the dispatcher if asynchronous delivery is
+    enabled, so the CDRs left in the outbox by previous processes are
+    sent without waiting for a new charge
+    """
+    if getattr(settings, 'CDR_OUTBOX_ASYNC', True):
+        get_dispatcher().wake_up()
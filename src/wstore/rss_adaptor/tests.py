@@ -19,14 +19,17 @@
 # If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
 
 import json
+from datetime import datetime, timedelta
 from mock import MagicMock
 from urllib2 import HTTPError
 from nose_parameterized import parameterized
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.conf import settings
 
-from wstore.rss_adaptor import rss_adaptor, expenditure_manager, rss_manager, model_manager
+from wstore.models import RSS
+from wstore.rss_adaptor import rss_adaptor, expenditure_manager, rss_manager, model_manager, cdr_outbox
 from wstore.store_commons.utils.testing import mock_request
 
 
@@ -176,6 +179,145 @@ class RSSAdaptorTestCase(TestCase):
         self.assertEqual(expected_xml, body)
 
 
+def _build_cdr(correlation, value):
+    return {
+        'provider': 'test_provider',
+        'service': 'test_service',
+        'defined_model': 'Single payment event',
+        'correlation': unicode(correlation),
+        'purchase': '1234567890',
+        'offering': 'test_offering',
+        'product_class': 'SaaS',
+        'description': 'The description',
+        'cost_currency': 'EUR',
+        'cost_value': value,
+        'tax_currency': 'EUR',
+        'tax_value': '0.0',
+        'source': 'WStore',
+        'operator': '1',
+        'country': 'SP',
+        'time_stamp': '10-05-13 10:00:00',
+        'customer': 'test_customer',
+    }
+
+
+@override_settings(CDR_OUTBOX_ASYNC=True)
+class CDROutboxTestCase(TestCase):
+
+    tags = ('cdr-outbox',)
+
+    def setUp(self):
+        self.rss = RSS.objects.create(
+            name='testrss',
+            host='http://examplerss/fiware_rss/',
+            access_token='accesstoken'
+        )
+        cdr_outbox.RSSAdaptor = MagicMock()
+        # The CDRs are delivered by the tests instead of by background workers
+        cdr_outbox.get_dispatcher = MagicMock()
+        self.collection = cdr_outbox._get_collection()
+
+    def tearDown(self):
+        self.collection.remove({})
+        reload(cdr_outbox)
+
+    def test_enqueue_is_idempotent(self):
+        cdr_outbox.enqueue_cdrs(self.rss, [_build_cdr(0, '1'), _build_cdr(1, '2')])
+        cdr_outbox.enqueue_cdrs(self.rss, [_build_cdr(1, '2')])
+
+        docs = list(self.collection.find().sort('correlation', 1))
+        self.assertEqual(len(docs), 2)
+        self.assertEqual([doc['correlation'] for doc in docs], [0, 1])
+
+        for doc in docs:
+            self.assertEqual(doc['state'], cdr_outbox.PENDING)
+            self.assertEqual(doc['attempts'], 0)
+            self.assertEqual(doc['rss'], unicode(self.rss.pk))
+
+        self.assertEqual(cdr_outbox.get_dispatcher().wake_up.call_count, 2)
+        self.assertFalse(cdr_outbox.RSSAdaptor.called)
+
+    def test_enqueue_sync_delivery(self):
+        # Without background workers the CDRs are sent before returning
+        with self.settings(CDR_OUTBOX_ASYNC=False):
+            cdr_outbox.enqueue_cdrs(self.rss, [_build_cdr(0, '1'), _build_cdr(1, '2')])
+
+        cdr_outbox.RSSAdaptor.assert_called_once_with(self.rss)
+        cdr_outbox.RSSAdaptor().send_cdr.assert_called_once_with([
+            _build_cdr(0, '1'),
+            _build_cdr(1, '2')
+        ])
+        self.assertEqual(self.collection.find().count(), 0)
+
+        # CDRs that cannot be delivered wait for their retry in the outbox
+        cdr_outbox.RSSAdaptor().send_cdr.side_effect = Exception('RSS error')
+
+        with self.settings(CDR_OUTBOX_ASYNC=False):
+            cdr_outbox.enqueue_cdrs(self.rss, [_build_cdr(2, '3')])
+
+        doc = self.collection.find_one()
+        self.assertEqual(doc['correlation'], 2)
+        self.assertEqual(doc['state'], cdr_outbox.PENDING)
+        self.assertEqual(doc['attempts'], 1)
+        self.assertFalse(cdr_outbox.get_dispatcher.called)
+
+    def test_deliver_merged_batch(self):
+        # The CDRs of several charges are sent in a single document
+        cdr_outbox.enqueue_cdrs(self.rss, [_build_cdr(0, '1'), _build_cdr(1, '2')])
+        cdr_outbox.enqueue_cdrs(self.rss, [_build_cdr(2, '3')])
+
+        dispatcher = cdr_outbox.CDRDispatcher(batch_size=10)
+        self.assertEqual(dispatcher.drain(), 3)
+
+        cdr_outbox.RSSAdaptor.assert_called_once_with(self.rss)
+        cdr_outbox.RSSAdaptor().send_cdr.assert_called_once_with([
+            _build_cdr(0, '1'),
+            _build_cdr(1, '2'),
+            _build_cdr(2, '3')
+        ])
+
+        self.assertEqual(self.collection.find().count(), 0)
+
+    def test_deliver_retry(self):
+        cdr_outbox.RSSAdaptor().send_cdr.side_effect = Exception('RSS error')
+        cdr_outbox.enqueue_cdrs(self.rss, [_build_cdr(0, '1')])
+
+        dispatcher = cdr_outbox.CDRDispatcher(max_attempts=2, retry_delay=30)
+
+        # The CDR is scheduled again with a delay
+        self.assertEqual(dispatcher.drain(), 0)
+
+        doc = self.collection.find_one()
+        self.assertEqual(doc['state'], cdr_outbox.PENDING)
+        self.assertEqual(doc['attempts'], 1)
+        self.assertEqual(doc['last_error'], 'RSS error')
+        self.assertFalse('lease' in doc)
+        self.assertTrue(doc['next_attempt'] > datetime.now() + timedelta(seconds=20))
+
+        # The CDR is not due yet
+        self.assertEqual(cdr_outbox.claim_batch(10), [])
+
+        # Reaching the maximum number of attempts the CDR is failed
+        self.collection.update({'_id': doc['_id']}, {'$set': {'next_attempt': datetime.now()}})
+        self.assertEqual(dispatcher.drain(), 0)
+
+        doc = self.collection.find_one()
+        self.assertEqual(doc['state'], cdr_outbox.FAILED)
+        self.assertEqual(doc['attempts'], 2)
+
+        stats = cdr_outbox.get_outbox_stats()
+        self.assertEqual(stats[cdr_outbox.PENDING], 0)
+        self.assertEqual(stats[cdr_outbox.FAILED], 1)
+        self.assertEqual(stats['oldest'], None)
+
+        # Failed CDRs can be scheduled again
+        self.assertEqual(cdr_outbox.retry_failed_cdrs(), 1)
+
+        doc = self.collection.find_one()
+        self.assertEqual(doc['state'], cdr_outbox.PENDING)
+        self.assertEqual(doc['attempts'], 0)
+
+
 class ExpenditureManagerTestCase(TestCase):
 
     tags = ('exp-manager', 'fiware-ut-31')
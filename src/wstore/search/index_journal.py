@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import errno
+import os
+
+
+# While an index is being rebuilt, the offerings written to the live index
+# are recorded in a journal, so they can be written again to the rebuilt
+# index once it replaces the live one. The journal file is also used as
+# the mark of a running rebuild
+
+
+def get_journal_path(index_path):
+    return index_path.rstrip(os.sep) + '.journal'
+
+
+def start_journal(index_path):
+    """
+    Creates the journal of an index, raising an exception
+    if other rebuild of the index is running
+    """
+    try:
+        os.close(os.open(get_journal_path(index_path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            raise Exception('The index is already being rebuilt, remove ' + get_journal_path(index_path) + ' if the rebuild is not running')
+        raise
+
+
+def journal_updates(index_path, offering_pks):
+    """
+    Records the offerings written to an index if it is being rebuilt. It
+    must be called before opening the index for writing
+    """
+    try:
+        # The journal is not created again if the rebuild has just finished
+        fd = os.open(get_journal_path(index_path), os.O_WRONLY | os.O_APPEND)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+
+    try:
+        # Appends of a single write are not interleaved
+        os.write(fd, ''.join([unicode(pk) + '\n' for pk in offering_pks]).encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def read_journal(index_path):
+    """
+    Returns the ids of the offerings recorded in the journal of an index
+    """
+    try:
+        with open(get_journal_path(index_path), 'rb') as f:
+            lines = f.read().decode('utf-8').split('\n')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+    offering_pks = []
+    seen = set()
+    for line in lines:
+        if line and not line in seen:
+            seen.add(line)
+            offering_pks.append(line)
+
+    return offering_pks
+
+
+def stop_journal(index_path):
+    try:
+        os.remove(get_journal_path(index_path))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
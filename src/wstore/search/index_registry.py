@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import os
+import re
+import threading
+from itertools import count
+
+from whoosh import query
+from whoosh.index import open_dir
+
+
+_TOC_PATTERN = re.compile(r'^_MAIN_(\d+)\.toc$')
+
+# Opened FileIndex objects of the current process, keyed by index path
+_indexes = {}
+_indexes_lock = threading.Lock()
+_pid = None
+
+# Every opened index gets a new epoch so searchers created for a removed
+# index are never reused
+_epochs = count()
+
+# Maximum number of filter docsets cached for each searcher
+_MAX_FILTERS = 256
+
+# Whoosh readers are not safe to be shared among threads, so searchers
+# are kept per thread
+_local = threading.local()
+
+
+def _toc_signature(index_path):
+    """
+    Returns a tuple identifying the latest TOC of the index stored in
+    index_path, or None if there is not an index in that directory. The
+    stat info of the TOC file is included so an index that has been
+    removed and created again is not confused with the cached one.
+    """
+    try:
+        filenames = os.listdir(index_path)
+    except OSError:
+        return None
+
+    generation = -1
+    for filename in filenames:
+        match = _TOC_PATTERN.match(filename)
+        if match:
+            generation = max(generation, int(match.group(1)))
+
+    if generation == -1:
+        return None
+
+    try:
+        toc_stat = os.stat(os.path.join(index_path, '_MAIN_%d.toc' % generation))
+    except OSError:
+        return None
+
+    return (generation, toc_stat.st_ino, toc_stat.st_mtime)
+
+
+def _check_process():
+    """
+    Drops the handles inherited from a parent process, since open files
+    cannot be shared safely after a fork
+    """
+    global _pid
+
+    if _pid != os.getpid():
+        _indexes.clear()
+        _local.__dict__.clear()
+        _pid = os.getpid()
+
+
+def get_index(index_path):
+    """
+    Returns the cached index stored in index_path opening it if needed,
+    None is returned if the index does not exist. The index is opened in
+    the directory index_path points to, so a rebuilt index swapped in using
+    a symbolic link is opened again while writers of the previous one keep
+    using its directory
+    """
+    with _indexes_lock:
+        _check_process()
+
+        real_path = os.path.realpath(index_path)
+        signature = _toc_signature(real_path)
+
+        if signature is None:
+            _indexes.pop(index_path, None)
+            return None
+
+        entry = _indexes.get(index_path)
+
+        if entry is None or entry['path'] != real_path or \
+                (entry['signature'][1:] != signature[1:] and entry['signature'][0] >= signature[0]):
+            # The index has not been opened yet or it has been created again
+            entry = {
+                'index': open_dir(real_path),
+                'path': real_path,
+                'signature': signature,
+                'epoch': next(_epochs)
+            }
+            _indexes[index_path] = entry
+        else:
+            entry['signature'] = signature
+
+        return entry['index'], signature, entry['epoch']
+
+
+def register_index(index_path, index):
+    """
+    Stores a just created index in the registry
+    """
+    with _indexes_lock:
+        _check_process()
+
+        real_path = os.path.realpath(index_path)
+
+        _indexes[index_path] = {
+            'index': index,
+            'path': real_path,
+            'signature': _toc_signature(real_path),
+            'epoch': next(_epochs)
+        }
+
+
+def get_searcher(index_path):
+    """
+    Returns a searcher of the index stored in index_path. The searcher is
+    reused between calls and refreshed only when the TOC generation of the
+    index changes. The returned searcher must not be closed by the caller.
+    """
+    cached = get_index(index_path)
+
+    if cached is None:
+        return None
+
+    index, signature, epoch = cached
+
+    searchers = _local.__dict__.setdefault('searchers', {})
+    entry = searchers.get(index_path)
+
+    if entry is not None and entry['epoch'] == epoch:
+        if entry['signature'] != signature:
+            # Reuse the segments that have not changed
+            entry['searcher'] = entry['searcher'].refresh()
+            entry['signature'] = signature
+            # Document numbers change between searcher generations
+            entry['filters'] = {}
+    else:
+        if entry is not None:
+            entry['searcher'].close()
+
+        entry = {
+            'searcher': index.searcher(),
+            'signature': signature,
+            'epoch': epoch,
+            'filters': {}
+        }
+        searchers[index_path] = entry
+
+    return entry['searcher']
+
+
+def get_searcher_signature(index_path):
+    """
+    Returns the TOC signature of the searcher last returned to the
+    current thread for index_path, or None if there is not such searcher
+    """
+    entry = _local.__dict__.get('searchers', {}).get(index_path)
+
+    if entry is None:
+        return None
+
+    return entry['signature']
+
+
+def get_filter_docs(index_path, field, value):
+    """
+    Returns the set of document numbers matching field:value in the searcher
+    last returned to the current thread for index_path. Docsets are cached
+    until the searcher is refreshed and must not be modified by the caller.
+    """
+    entry = _local.__dict__['searchers'][index_path]
+    filters = entry['filters']
+    key = (field, value)
+
+    if not key in filters:
+        if len(filters) >= _MAX_FILTERS:
+            filters.clear()
+
+        filters[key] = set(entry['searcher'].docs_for_query(query.Term(field, value)))
+
+    return filters[key]
+
+
+def clear_registry(index_path=None):
+    """
+    Removes the cached handles of index_path, or all of them
+    if no path is provided
+    """
+    with _indexes_lock:
+        searchers = _local.__dict__.get('searchers', {})
+
+        if index_path is None:
+            paths = list(set(_indexes.keys()) | set(searchers.keys()))
+        else:
+            paths = [index_path]
+
+        for path in paths:
+            _indexes.pop(path, None)
+            entry = searchers.pop(path, None)
+            if entry is not None:
+                entry['searcher'].close()
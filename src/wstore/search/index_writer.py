@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+logger = logging.getLogger('wstore.search.index_writer')
+
+# Maximum number of seconds between two retries of a failed update
+MAX_RETRY_DELAY = 300
+
+
+class IndexWriterThread(threading.Thread):
+    """
+    Background thread that commits the pending updates of a queue
+    """
+
+    _queue = None
+
+    def __init__(self, queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._queue = queue
+
+    def run(self):
+        while True:
+            batch = self._queue.wait_batch()
+            self._queue.commit_batch(batch)
+
+
+class IndexUpdateQueue():
+    """
+    Queue of pending search index updates. Updates of the same offering
+    are merged and committed in batches by a single writer thread, when
+    the batch size is reached or when the oldest update has waited more
+    than the commit delay. Updates of a failed commit are queued again with
+    an exponential backoff until max_attempts is reached. A warning is logged
+    when the lag of a commit exceeds lag_warning seconds
+    """
+
+    _pending = None
+    _condition = None
+    _thread = None
+    _pid = None
+
+    def __init__(self, batch_size=50, commit_delay=2.0, max_attempts=5, retry_delay=5.0, lag_warning=60):
+        self._batch_size = batch_size
+        self._commit_delay = commit_delay
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._lag_warning = lag_warning
+        self._pending = OrderedDict()
+        # Failed updates waiting for their next attempt
+        self._retries = OrderedDict()
+        self._condition = threading.Condition()
+        self._last_commit = None
+        self._committed = 0
+        self._failed = 0
+        self._dropped = 0
+        # Queue time of the oldest update of the batch being committed
+        self._in_flight = None
+
+    def _ensure_worker(self):
+        # Threads are not inherited by forked processes
+        if self._pid != os.getpid():
+            self._pending.clear()
+            self._retries.clear()
+            self._thread = None
+            self._pid = os.getpid()
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = IndexWriterThread(self)
+            self._thread.start()
+
+    def put(self, index_path, offering_pk, action='update'):
+        """
+        Queue an update (or removal) of the document of an offering
+        """
+        if action != 'update' and action != 'remove':
+            raise ValueError('Invalid index action')
+
+        with self._condition:
+            self._ensure_worker()
+
+            key = (index_path, unicode(offering_pk))
+
+            if key in self._retries:
+                # A new update of a failed one does not wait for the
+                # backoff, but it keeps the number of attempts
+                self._pending[key] = self._retries.pop(key)
+
+            if key in self._pending:
+                # Merge with the pending update, the document is built when
+                # committing so only the last action is relevant
+                self._pending[key]['action'] = action
+            else:
+                self._pending[key] = {
+                    'action': action,
+                    'queued': time.time()
+                }
+
+            # Wake up the writer, it waits for more updates if the
+            # batch is not complete
+            self._condition.notify()
+
+    def wait_batch(self):
+        """
+        Block until a batch of updates is ready to be committed
+        """
+        with self._condition:
+            while True:
+                self._move_due_retries()
+
+                if len(self._pending):
+                    break
+
+                self._condition.wait(self._get_retry_wait())
+
+            while len(self._pending) < self._batch_size:
+                oldest = next(self._pending.itervalues())['queued']
+                remaining = (oldest + self._commit_delay) - time.time()
+
+                if remaining <= 0:
+                    break
+
+                self._condition.wait(remaining)
+
+            batch = self._pending
+            self._pending = OrderedDict()
+            self._in_flight = min([update['queued'] for update in batch.itervalues()])
+
+        return batch
+
+    def commit_batch(self, batch):
+        """
+        Write a batch of updates using a single writer for each index
+        """
+        # Imported here to avoid a cross-reference import error
+        from wstore.search.search_engine import SearchEngine
+
+        indexes = OrderedDict()
+        for (index_path, offering_pk), update in batch.iteritems():
+            indexes.setdefault(index_path, []).append((offering_pk, update['action']))
+
+        failed = []
+        for index_path, updates in indexes.iteritems():
+            try:
+                SearchEngine(index_path).apply_updates(updates)
+            except:
+                logger.exception('Error committing %d updates of the index %s' % (len(updates), index_path))
+                failed.extend([(index_path, offering_pk) for offering_pk, action in updates])
+
+        lag = self.get_lag()
+
+        with self._condition:
+            self._last_commit = time.time()
+            self._committed += len(batch) - len(failed)
+            self._in_flight = None
+
+            for key in failed:
+                self._retry(key, batch[key])
+
+            if len(failed):
+                self._condition.notify()
+
+            pending = len(self._pending)
+            retrying = len(self._retries)
+
+        if self._lag_warning is not None and lag >= self._lag_warning:
+            logger.warning('The search index is %.2f seconds behind, %d updates pending and %d retrying' % (lag, pending, retrying))
+
+        logger.debug('Committed %d search index updates, lag %.2f seconds' % (len(batch) - len(failed), lag))
+
+    def _retry(self, key, update):
+        """
+        Queue again a failed update, it must be called holding the condition
+        """
+        attempts = update.get('attempts', 0) + 1
+        self._failed += 1
+
+        if attempts >= self._max_attempts:
+            self._dropped += 1
+            logger.error('Discarding the update of the offering %s in the index %s after %d attempts' % (key[1], key[0], attempts))
+            return
+
+        if key in self._pending:
+            # The offering has been updated again while committing
+            self._pending[key]['attempts'] = attempts
+            self._pending[key]['queued'] = min(self._pending[key]['queued'], update['queued'])
+            return
+
+        self._retries[key] = {
+            'action': update['action'],
+            'queued': update['queued'],
+            'attempts': attempts,
+            'retry_at': time.time() + min(self._retry_delay * (2 ** (attempts - 1)), MAX_RETRY_DELAY)
+        }
+
+    def _move_due_retries(self):
+        """
+        Move the failed updates whose backoff has expired to the pending
+        updates, it must be called holding the condition
+        """
+        now = time.time()
+
+        for key, update in self._retries.items():
+            if update['retry_at'] <= now:
+                del self._retries[key]
+                self._pending[key] = update
+
+    def _get_retry_wait(self):
+        """
+        Returns the seconds until the next failed update is due, or None
+        if there are no failed updates
+        """
+        if not len(self._retries):
+            return None
+
+        return max(min([update['retry_at'] for update in self._retries.itervalues()]) - time.time(), 0)
+
+    def flush(self):
+        """
+        Commit all the pending and failed updates in the calling thread
+        """
+        with self._condition:
+            # Failed updates are not left waiting for their backoff
+            for key, update in self._retries.iteritems():
+                if not key in self._pending:
+                    self._pending[key] = update
+
+            self._retries.clear()
+
+            batch = self._pending
+            self._pending = OrderedDict()
+
+            if len(batch):
+                self._in_flight = min([update['queued'] for update in batch.itervalues()])
+
+        if len(batch):
+            self.commit_batch(batch)
+
+    def get_lag(self):
+        """
+        Returns the number of seconds the oldest not committed update has
+        been waiting, 0 if there are no pending updates
+        """
+        with self._condition:
+            oldest = self._in_flight
+
+            for updates in (self._pending, self._retries):
+                if len(updates):
+                    queued = min([update['queued'] for update in updates.itervalues()])
+                    if oldest is None or queued < oldest:
+                        oldest = queued
+
+        if oldest is None:
+            return 0
+
+        return time.time() - oldest
+
+    def get_stats(self):
+        """
+        Returns the status of the queue
+        """
+        lag = self.get_lag()
+
+        with self._condition:
+            return {
+                'pending': len(self._pending),
+                'retrying': len(self._retries),
+                'lag': lag,
+                'committed': self._committed,
+                'failed': self._failed,
+                'dropped': self._dropped,
+                'last_commit': self._last_commit
+            }
+
+
+_update_queue = None
+_update_queue_lock = threading.Lock()
+
+
+def get_update_queue():
+    """
+    Returns the index update queue of the process
+    """
+    global _update_queue
+
+    with _update_queue_lock:
+        if _update_queue is None:
+            _update_queue = IndexUpdateQueue(
+                batch_size=getattr(settings, 'SEARCH_INDEX_BATCH_SIZE', 50),
+                commit_delay=getattr(settings, 'SEARCH_INDEX_COMMIT_DELAY', 2.0),
+                max_attempts=getattr(settings, 'SEARCH_INDEX_MAX_ATTEMPTS', 5),
+                retry_delay=getattr(settings, 'SEARCH_INDEX_RETRY_DELAY', 5.0),
+                lag_warning=getattr(settings, 'SEARCH_INDEX_LAG_WARNING', 60)
+            )
+            # Do not lose pending updates when the process ends
+            atexit.register(_update_queue.flush)
+
+    return _update_queue
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import threading
+
+from django.conf import settings
+
+from wstore.store_commons.utils.cache import LRUCache
+
+
+class DjangoResultCache():
+    """
+    Result cache stored in a Django cache backend, so it can be
+    shared among processes
+    """
+
+    def __init__(self, alias='default', ttl=300):
+        from django.core.cache import get_cache
+        self._cache = get_cache(alias)
+        self._ttl = ttl
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value, self._ttl)
+
+    def clear(self):
+        # Entries are invalidated by the index generation included
+        # in the keys, so old ones just expire
+        pass
+
+
+def get_result_key(index_path, generation, text, state, organization, sort, pagination, count, facets=False):
+    """
+    Build the cache key of a search. The generation of the index is
+    included so every index commit invalidates the cached results
+    """
+    params = {
+        'index': index_path,
+        'generation': list(generation),
+        'text': text,
+        'state': state,
+        'organization': organization,
+        'sort': sort,
+        'pagination': pagination,
+        'count': count,
+        'facets': facets
+    }
+    return 'wstore.search:' + hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """
+    Returns the search result cache configured in the settings, None
+    if the cache is disabled
+    """
+    global _result_cache
+
+    conf = getattr(settings, 'SEARCH_RESULT_CACHE', {})
+    backend = conf.get('BACKEND', 'local')
+
+    if backend is None:
+        return None
+
+    with _result_cache_lock:
+        if _result_cache is None:
+            ttl = conf.get('TTL', 300)
+
+            if backend == 'local':
+                _result_cache = LRUCache(conf.get('SIZE', 1000), ttl=ttl)
+            elif backend == 'django':
+                _result_cache = DjangoResultCache(alias=conf.get('CACHE_ALIAS', 'default'), ttl=ttl)
+            else:
+                raise ValueError('Invalid search result cache backend')
+
+    return _result_cache
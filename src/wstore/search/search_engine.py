@@ -21,15 +21,67 @@
 from __future__ import unicode_literals
 
 import os
-import json
-import rdflib
+from datetime import datetime
 from decimal import Decimal
-from whoosh.fields import Schema, TEXT, NUMERIC, DATETIME, KEYWORD
-from whoosh.index import create_in, open_dir
+from whoosh.fields import Schema, TEXT, NUMERIC, DATETIME, KEYWORD, STORED
+from whoosh.index import create_in
 from whoosh.qparser import QueryParser
-from whoosh import query
-
-from wstore.models import Offering, Purchase
+from whoosh import query, sorting
+
+from django.conf import settings
+
+from wstore.models import Offering, Organization, UserProfile
+from wstore.search.index_journal import journal_updates
+from wstore.search.index_registry import get_filter_docs, get_index, get_searcher, get_searcher_signature, register_index
+from wstore.search.index_writer import get_update_queue
+from wstore.search.result_cache import get_result_cache, get_result_key
+from wstore.search.usdl_text import get_usdl_text
+from wstore.store_commons.utils.cursor import encode_cursor, decode_cursor
+
+
+# Stored fields needed for building offering cards from search hits
+CARD_FIELDS = ('name', 'organization', 'version', 'image_url', 'rating', 'state', 'short_description')
+
+# Types of the sort value and the offering id included in the cursors
+# of each sorting
+CURSOR_TYPES = {
+    'popularity': ((Decimal, int, long), unicode),
+    'date': (datetime, unicode),
+    'name': (unicode, unicode)
+}
+
+
+def decode_search_cursor(cursor, sort):
+    """
+    Returns the sort value and the offering id of a search cursor, raises
+    a ValueError if the cursor does not match the sorting
+    """
+    if sort not in CURSOR_TYPES:
+        raise ValueError('Undefined sorting')
+
+    return decode_cursor(cursor, types=CURSOR_TYPES[sort])
+
+
+
+def get_index_schema():
+    """
+    Returns the schema of the offerings index
+    """
+    return Schema(
+        id=KEYWORD(stored=True, unique=True, sortable=True),
+        owner=KEYWORD(sortable=True),
+        content=TEXT,
+        name=KEYWORD(sortable=True, stored=True),
+        popularity=NUMERIC(int, decimal_places=2, sortable=True, signed=False),
+        date=DATETIME(sortable=True),
+        state=KEYWORD(stored=True, sortable=True),
+        tags=KEYWORD,
+        organization=STORED,
+        version=STORED,
+        image_url=STORED,
+        rating=STORED,
+        short_description=STORED
+    )
 
 
 class SearchEngine():
@@ -39,33 +91,109 @@ class SearchEngine():
     def __init__(self, index_path):
         self._index_path = index_path
 
+    def _get_index(self):
+        """
+        Returns the cached index handle, raising an exception if
+        the index does not exist
+        """
+        cached = get_index(self._index_path)
+
+        if cached is None:
+            raise Exception('The index does not exist')
+
+        return cached[0]
+
     def _aggregate_text(self, offering):
         """
         Create a single string for creating the index by extracting text fields
-        from the USDL document of the offering
+        from the USDL document of the offering. The text is cached by content
+        hash so unchanged descriptions are not processed again
+        """
+        return get_usdl_text(offering.offering_description)
+
+    def _get_purchased_query(self, user):
+        """
+        Build a query matching the offerings purchased by the current
+        organization of the user
         """
+        user_profile = user.userprofile
+        purchased = list(user_profile.current_organization.offerings_purchased)
+
+        # If the current organization is the user organization
+        # include the offerings purchased by the user
+        if user_profile.is_user_org():
+            for offering_pk in user_profile.offerings_purchased:
+                if not offering_pk in purchased:
+                    purchased.append(offering_pk)
+
+        if not len(purchased):
+            return query.NullQuery
 
-        usdl_document = offering.offering_description
-        graph = rdflib.ConjunctiveGraph()
+        return query.Or([query.Term('id', unicode(offering_pk)) for offering_pk in purchased])
 
-        graph.parse(data=json.dumps(usdl_document), format='json-ld')
+    def _get_short_description(self, offering):
+        """
+        Get the abstract of the services included in the offering directly
+        from the JSON-LD document of its USDL description
+        """
+        graph = offering.offering_description.get('@graph', [])
 
-        text = ''
+        for node in graph:
+            abstract = node.get('dcterms:abstract', node.get('http://purl.org/dc/terms/abstract'))
 
-        for s, p, o in graph:
-            if isinstance(o, rdflib.Literal):
-                text += ' ' + unicode(o)
+            if abstract is None:
+                continue
 
-        return text
+            if isinstance(abstract, list):
+                abstract = abstract[0]
 
-    def _aggregate_purchasers(self, offering):
-        purchases = Purchase.objects.filter(offering=offering)
+            if isinstance(abstract, dict):
+                abstract = abstract.get('@value', '')
 
-        result = ''
-        for p in purchases:
-            result += p.owner_organization.pk + ','
+            return unicode(abstract)
 
-        return result[:-1]
+        return ''
+
+    def _build_document(self, offering, date, text=None):
+        """
+        Build the fields of the index document of an offering, including
+        the stored fields used to render offering cards from search hits
+        """
+        # Aggregate all the information included in the USDL document in
+        # a single string in order to add a new document to the index
+        if text is None:
+            text = self._aggregate_text(offering)
+
+        return {
+            'id': unicode(offering.pk),
+            'owner': unicode(offering.owner_organization.pk),
+            'content': unicode(text),
+            'name': unicode(offering.name),
+            'popularity': Decimal(offering.rating),
+            'date': date,
+            'state': unicode(offering.state),
+            'tags': ' '.join(offering.tags),
+            'organization': unicode(offering.owner_organization.name),
+            'version': unicode(offering.version),
+            'image_url': unicode(offering.image_url),
+            'rating': offering.rating,
+            'short_description': self._get_short_description(offering)
+        }
+
+    def get_document(self, offering, text=None):
+        """
+        Returns the fields of the index document of an offering, the
+        text of the USDL description can be provided if already extracted
+        """
+        return self._build_document(offering, self._get_index_date(offering), text=text)
+
+    def _filter_schema_fields(self, index, document):
+        """
+        Remove the fields not included in the schema of the index, so indexes
+        created before the stored card fields were added can still be updated
+        """
+        names = index.schema.names()
+        return dict((name, value) for name, value in document.iteritems() if name in names)
 
     def create_index(self, offering):
         """
@@ -73,81 +201,103 @@ class SearchEngine():
         search index
         """
 
+        # Record the write if the index is being rebuilt
+        journal_updates(self._index_path, [offering.pk])
+
         # Check if the index already exists to avoid overwrite it
-        if not os.path.exists(self._index_path) or os.listdir(self._index_path) == []:
+        cached = get_index(self._index_path)
+
+        if cached is None:
             # Create dir if needed
             if not os.path.exists(self._index_path):
                 os.makedirs(self._index_path)
 
-            # Create schema
-            schema = Schema(
-                id=KEYWORD(stored=True, unique=True),
-                owner=KEYWORD,
-                content=TEXT,
-                name=KEYWORD(sortable=True),
-                popularity=NUMERIC(int, decimal_places=2, sortable=True, signed=False),
-                date=DATETIME(sortable=True),
-                state=KEYWORD,
-                purchaser=KEYWORD(stored=True, commas=True)
-            )
             # Create index
-            index = create_in(self._index_path, schema)
+            index = create_in(self._index_path, get_index_schema())
+            register_index(self._index_path, index)
         else:
-            index = open_dir(self._index_path)
-
-        # Open the index
-        index_writer = index.writer()
-
-        # Aggregate all the information included in the USDL document in
-        # a single string in order to add a new document to the index
-        text = self._aggregate_text(offering)
+            index = cached[0]
 
-        purchasers_text = self._aggregate_purchasers(offering)
+        document = self._build_document(offering, offering.creation_date)
 
         # Add the new document
-        index_writer.add_document(
-            id=unicode(offering.pk),
-            owner=unicode(offering.owner_organization.pk),
-            content=unicode(text),
-            name=unicode(offering.name),
-            popularity=Decimal(offering.rating),
-            date=offering.creation_date,
-            state=unicode(offering.state),
-            purchaser=purchasers_text
-        )
+        index_writer = self._get_writer(index)
+        index_writer.add_document(**self._filter_schema_fields(index, document))
         index_writer.commit()
 
-    def update_index(self, offering):
+    def _get_writer(self, index):
         """
-        Update the document of a concrete offering in the search index
+        Get a writer for the index waiting for the lock if another
+        writer, such as the index update queue, is committing
         """
+        return index.writer(timeout=getattr(settings, 'SEARCH_INDEX_LOCK_TIMEOUT', 10.0))
 
-        if not os.path.exists(self._index_path) or os.listdir(self._index_path) == []:
-            raise Exception('The index does not exist')
+    def _get_index_date(self, offering):
+        """
+        Uploaded offerings are indexed by creation date, other
+        offerings by publication date
+        """
+        if offering.state == 'uploaded':
+            return offering.creation_date
 
-        index = open_dir(self._index_path)
+        return offering.publication_date
 
-        index_writer = index.writer()
-        text = self._aggregate_text(offering)
-        purchasers_text = self._aggregate_purchasers(offering)
+    def update_index(self, offering, deferred=False):
+        """
+        Update the document of a concrete offering in the search index. If
+        deferred is True the update is queued and committed in background
+        together with other pending updates
+        """
 
-        in_date = None
-        if offering.state == 'uploaded':
-            in_date = offering.creation_date
-        else:
-            in_date = offering.publication_date
+        if deferred and getattr(settings, 'SEARCH_INDEX_ASYNC', True):
+            get_update_queue().put(self._index_path, offering.pk)
+            return
+
+        journal_updates(self._index_path, [offering.pk])
+
+        index = self._get_index()
+        document = self._build_document(offering, self._get_index_date(offering))
 
         # Get the document
-        index_writer.update_document(
-            id=unicode(offering.pk),
-            owner=unicode(offering.owner_organization.pk),
-            content=unicode(text),
-            name=unicode(offering.name),
-            popularity=Decimal(offering.rating),
-            date=in_date,
-            state=unicode(offering.state),
-            purchaser=purchasers_text
-        )
+        index_writer = self._get_writer(index)
+        index_writer.update_document(**self._filter_schema_fields(index, document))
+        index_writer.commit()
+
+    def apply_updates(self, updates):
+        """
+        Write a list of (offering pk, action) updates with a single commit,
+        documents are built using the current state of the offerings
+        """
+        journal_updates(self._index_path, [offering_pk for offering_pk, action in updates])
+
+        index = self._get_index()
+
+        documents = []
+        for offering_pk, action in updates:
+            offering = None
+
+            if action == 'update':
+                try:
+                    offering = Offering.objects.get(pk=offering_pk)
+                except Offering.DoesNotExist:
+                    pass
+
+            if offering is None:
+                documents.append((offering_pk, None))
+            else:
+                document = self._build_document(offering, self._get_index_date(offering))
+                documents.append((offering_pk, self._filter_schema_fields(index, document)))
+
+        index_writer = self._get_writer(index)
+        try:
+            for offering_pk, document in documents:
+                if document is None:
+                    index_writer.delete_by_term('id', unicode(offering_pk))
+                else:
+                    index_writer.update_document(**document)
+        except:
+            index_writer.cancel()
+            raise
 
         index_writer.commit()
 
@@ -155,111 +305,390 @@ class SearchEngine():
         """
         Remove the document associated with an offering
         """
-        if not os.path.exists(self._index_path) or os.listdir(self._index_path) == []:
-            raise Exception('The index does not exist')
+        journal_updates(self._index_path, [offering.pk])
 
-        index = open_dir(self._index_path)
-        index_writer = index.writer()
+        index = self._get_index()
+        index_writer = self._get_writer(index)
 
         index_writer.delete_by_term('id', unicode(offering.pk))
         index_writer.commit()
 
-    def full_text_search(self, user, text, state=None, count=False, pagination=None, sort=None):
+    def _build_cards(self, hits, user):
         """
-        Performs a full text search over the search index allowing for counting, filtering
-        by state, paginating and sorting.
+        Build the card info of the offerings using the fields stored in the
+        index. Offerings whose document does not include all the card fields
+        are loaded using a single query
         """
+        # Imported here in order to avoid a cross-reference import error
+        from wstore.offerings.offerings_management import get_user_state
+
+        missing = [hit['id'] for hit in hits if not all(field in hit for field in CARD_FIELDS)]
+        offerings = {}
+
+        if len(missing):
+            for offering in Offering.objects.filter(pk__in=missing):
+                offerings[offering.pk] = offering
+
+        user_profile = UserProfile.objects.get(user=user)
+        user_org = user_profile.is_user_org()
+
+        result = []
+        for hit in hits:
+            if hit['id'] in offerings:
+                offering = offerings[hit['id']]
+                card = {
+                    'name': offering.name,
+                    'organization': offering.owner_organization.name,
+                    'version': offering.version,
+                    'image_url': offering.image_url,
+                    'rating': offering.rating,
+                    'state': offering.state,
+                    'short_description': self._get_short_description(offering)
+                }
+            elif hit['id'] in missing:
+                # The offering has been removed from the database
+                continue
+            else:
+                card = hit
+
+            result.append({
+                'name': card['name'],
+                'owner_organization': card['organization'],
+                'version': card['version'],
+                'state': get_user_state(hit['id'], card['state'], user, user_profile, user_org),
+                'rating': "{:.2f}".format(card['rating']),
+                'image_url': card['image_url'],
+                'short_description': card['short_description']
+            })
 
-        if not os.path.exists(self._index_path) or os.listdir(self._index_path) == []:
-            raise Exception('The index does not exist')
+        return result
 
-        # Get the index reader
-        index = open_dir(self._index_path)
+    def _get_filter(self, terms):
+        """
+        Build a filter intersecting the cached docsets of the
+        given (field, value) terms
+        """
+        filter_ = None
+        for field, value in terms:
+            docs = get_filter_docs(self._index_path, field, value)
 
-        with index.searcher() as searcher:
+            if filter_ is None:
+                filter_ = docs
+            else:
+                filter_ = filter_ & docs
 
-            # Create the query
-            query_ = QueryParser('content', index.schema).parse(unicode(text))
+        return filter_
 
-            # If an state has been defined filter the result
-            if state:
-                if state == 'all':  # All user owned offerings
-                    filter_ = query.Term('owner', unicode(user.userprofile.current_organization.pk))
-                elif state == 'purchased':  # Purchased offerings
-                    filter_ = query.Term('purchaser', user.userprofile.current_organization.pk)
-                elif state == 'uploaded' or state == 'deleted':  # Uploaded or deleted offerings owned by the user
-                    filter_ = query.Term('state', state) & query.Term('owner', unicode(user.userprofile.current_organization.pk))
-                else:
-                    raise ValueError('Invalid state')
+    def _get_facets(self, searcher):
+        """
+        Returns the facets used for counting the hits, indexes created
+        before the tags were included are not faceted by tag
+        """
+        facets = {
+            'state': sorting.FieldFacet('state'),
+            'owner': sorting.FieldFacet('owner')
+        }
+
+        if 'tags' in searcher.schema:
+            facets['tag'] = sorting.FieldFacet('tags', allow_overlap=True)
+
+        return facets
+
+    def _get_facet_counts(self, search_result, groupedby):
+        """
+        Get the number of hits of each facet value, owners are
+        identified by the name of the organization
+        """
+        counts = dict((name, {}) for name in groupedby)
+
+        if search_result is not None:
+            for name in groupedby:
+                # Documents without a value are grouped under None
+                counts[name] = dict((value, number) for value, number in search_result.groups(name).iteritems() if value is not None)
+
+        owners = counts['owner']
+        counts['owner'] = {}
+
+        if len(owners):
+            for org in Organization.objects.filter(pk__in=owners.keys()):
+                counts['owner'][org.name] = owners[unicode(org.pk)]
+
+        return counts
+
+    def _get_range(self, schema, field, start=None, end=None, startexcl=False, endexcl=False):
+        fieldtype = schema[field]
+
+        if isinstance(fieldtype, NUMERIC):
+            # Numeric ranges are matched using the full precision terms since
+            # the tiered ranges of whoosh miss low values of unsigned fields
+            if start is None:
+                start = fieldtype.sortable_to_bytes(0)
             else:
-                # If state is not included the default behaviour is returning
-                # published offerings
-                filter_ = query.Term('state', 'published')
+                start = fieldtype.to_bytes(start)
 
-            # Create sorting params if needed
-            if sort:
-                if sort == 'popularity' or sort == 'date':
-                    reverse = True
-                elif sort == 'name':
-                    reverse = False
-                else:
-                    raise ValueError('Undefined sorting')
+            if end is None:
+                end = fieldtype.sortable_to_bytes(2 ** fieldtype.bits - 1)
+            else:
+                end = fieldtype.to_bytes(end)
 
-            # If pagination has been defined, limit the results
-            if pagination:
-                # Validate pagination fields
-                if not isinstance(pagination, dict):
-                    raise TypeError('Invalid pagination type')
+        return query.TermRange(field, start, end, startexcl=startexcl, endexcl=endexcl)
 
-                if not 'start' in pagination or not 'limit' in pagination:
-                    raise ValueError('Missing required field in pagination')
+    def _get_after_query(self, schema, sort, reverse, value, last_id):
+        """
+        Builds a range query matching the documents placed after the given
+        sort value and offering id, so they are found using the terms of
+        the index instead of reading every document
+        """
+        if reverse:
+            after = self._get_range(schema, sort, end=value, endexcl=True)
+            after_id = self._get_range(schema, 'id', end=last_id, endexcl=True)
+        else:
+            after = self._get_range(schema, sort, start=value, startexcl=True)
+            after_id = self._get_range(schema, 'id', start=last_id, startexcl=True)
 
-                if not isinstance(pagination['start'], int) or not isinstance(pagination['limit'], int):
-                    raise TypeError('Invalid pagination params type')
+        # Documents with the same sort value are placed after the
+        # cursor depending on their offering id
+        same = self._get_range(schema, sort, start=value, end=value)
+        return query.Or([after, query.And([same, after_id])])
 
-                if pagination['start'] < 1:
-                    raise ValueError('Start param must be higher than 0')
+    def _search_after_cursor(self, searcher, query_, filter_, sort, reverse, pagination, groupedby):
+        """
+        Search the hits placed after the cursor of the pagination. Hits before
+        the cursor are excluded by the query so they are neither scored nor sorted
+        """
+        if pagination['cursor']:
+            value, last_id = decode_search_cursor(pagination['cursor'], sort)
+            query_ = query.And([query_, self._get_after_query(searcher.schema, sort, reverse, value, last_id)])
 
-                if pagination['limit'] < 0:
-                    raise ValueError('Limit param must be positive')
+        if filter_ is not None and not len(filter_):
+            return None, [], 0, None
 
-                search_params = (query_, )
-                search_kwparams = {
-                    'filter': filter_,
-                }
+        # The offering id breaks ties, an extra hit is read to know if
+        # there is a next page
+        search_result = searcher.search(query_, filter=filter_, limit=pagination['limit'] + 1, sortedby=[sort, 'id'], reverse=reverse, groupedby=groupedby, maptype=sorting.Count)
+        hits = [hit for hit in search_result]
 
-                if sort:
-                    search_kwparams['sortedby'] = sort
-                    search_kwparams['reverse'] = reverse
+        next_cursor = None
+        if len(hits) > pagination['limit']:
+            hits = hits[:pagination['limit']]
+            last_hit = hits[-1]
+            next_cursor = encode_cursor(searcher.reader().column_reader(sort)[last_hit.docnum], last_hit['id'])
 
-                # Check limits
-                search_len = len(searcher.search(*search_params, **search_kwparams))
+        return search_result, [hit.fields() for hit in hits], len(search_result), next_cursor
 
-                if pagination['start'] > search_len:
-                    search_result = []
-                else:
-                    search_params = (query_, pagination['start'])
-                    search_kwparams['pagelen'] = pagination['limit']
-                    search_result = searcher.search_page(*search_params, **search_kwparams)
+    def full_text_search(self, user, text, state=None, count=False, pagination=None, sort=None, mode='full', with_count=False, facets=False):
+        """
+        Performs a full text search over the search index allowing for counting, filtering
+        by state, paginating and sorting. If mode is card, the result is built using the
+        fields stored in the index instead of loading every offering. If with_count is
+        True the total number of hits is returned together with the results. If facets
+        is True the number of hits by state, owner organization and tag is included.
+
+        If the pagination includes a cursor instead of a start, the hits after the cursor
+        are returned together with the cursor of the next page. The count and the facets
+        of a cursor page refer to the hits after its cursor.
+        """
+
+        if mode != 'full' and mode != 'card':
+            raise ValueError('Invalid result mode')
+
+        # Get the cached searcher, it is refreshed if the index has changed
+        searcher = get_searcher(self._index_path)
+
+        if searcher is None:
+            raise Exception('The index does not exist')
+
+        # Create the query
+        query_ = QueryParser('content', searcher.schema).parse(unicode(text))
+
+        # If an state has been defined filter the result. Filters are built
+        # from docsets cached with the searcher, so they are not computed
+        # again until the index changes
+        if state:
+            if state == 'all':  # All user owned offerings
+                filter_ = self._get_filter([('owner', unicode(user.userprofile.current_organization.pk))])
+            elif state == 'purchased':  # Purchased offerings
+                # Purchased offerings are taken from the user and organization models,
+                # which are updated with each purchase, instead of from the index. Only
+                # the scores of the text query are used
+                query_ = query.Require(query_, self._get_purchased_query(user))
+                filter_ = None
+            elif state == 'uploaded' or state == 'published' or state == 'deleted':  # Offerings owned by the user in a given state
+                filter_ = self._get_filter([
+                    ('state', state),
+                    ('owner', unicode(user.userprofile.current_organization.pk))
+                ])
             else:
-                if sort:
-                    search_result = searcher.search(query_, filter=filter_, limit=None, sortedby=sort, reverse=reverse)
-                else:
-                    search_result = searcher.search(query_, filter=filter_, limit=None)
-                
+                raise ValueError('Invalid state')
+        else:
+            # If state is not included the default behaviour is returning
+            # published offerings
+            filter_ = self._get_filter([('state', 'published')])
+
+        # Facet counts are computed in the same query
+        groupedby = None
+        if facets:
+            groupedby = self._get_facets(searcher)
+
+        # Create sorting params if needed
+        if sort:
+            if sort == 'popularity' or sort == 'date':
+                reverse = True
+            elif sort == 'name':
+                reverse = False
+            else:
+                raise ValueError('Undefined sorting')
+
+        # If pagination has been defined, limit the results
+        if pagination:
+            # Validate pagination fields
+            if not isinstance(pagination, dict):
+                raise TypeError('Invalid pagination type')
+
+            if not ('start' in pagination or 'cursor' in pagination) or not 'limit' in pagination:
+                raise ValueError('Missing required field in pagination')
+
+            if not isinstance(pagination.get('start', 1), int) or not isinstance(pagination['limit'], int):
+                raise TypeError('Invalid pagination params type')
+
+            if pagination.get('start', 1) < 1:
+                raise ValueError('Start param must be higher than 0')
+
+            if pagination['limit'] < 0:
+                raise ValueError('Limit param must be positive')
 
-            result = []
-            # The get_offering_info method is imported inside this method in order to avoid a cross-reference import error
-            from wstore.offerings.offerings_management import get_offering_info
+            if 'cursor' in pagination:
+                if not sort:
+                    raise ValueError('Cursor pagination requires a sorting')
 
+                if pagination['limit'] < 1:
+                    raise ValueError('Limit param must be higher than 0')
 
-            if not count:
-                for hit in search_result:
+            search_kwparams = {
+                'filter': filter_,
+                'groupedby': groupedby,
+                'maptype': sorting.Count
+            }
 
-                    # Get the offerings
-                    offering = Offering.objects.get(pk=hit['id'])
-                    result.append(get_offering_info(offering, user))
+            if sort:
+                search_kwparams['sortedby'] = sort
+                search_kwparams['reverse'] = reverse
+
+        # Purchased offerings are not cached since they depend on the
+        # user models and not only on the index
+        cache = None
+        if state != 'purchased':
+            cache = get_result_cache()
+
+        if cache is not None:
+            organization = None
+            if state:
+                organization = unicode(user.userprofile.current_organization.pk)
+
+            cache_key = get_result_key(
+                self._index_path,
+                get_searcher_signature(self._index_path),
+                unicode(text),
+                state,
+                organization,
+                sort,
+                pagination,
+                count,
+                facets
+            )
+            cached = cache.get(cache_key)
+        else:
+            cached = None
+
+        search_result = None
+        next_cursor = None
+        if cached is not None:
+            hits = cached['hits']
+            total = cached['total']
+            facet_counts = cached['facets']
+            next_cursor = cached.get('next_cursor')
+
+        elif pagination and 'cursor' in pagination and not count:
+            search_result, hits, total, next_cursor = self._search_after_cursor(searcher, query_, filter_, sort, reverse, pagination, groupedby)
+
+        elif filter_ is not None and not len(filter_):
+            # Whoosh does not filter with empty docsets
+            hits = []
+            total = 0
+
+        elif count or (pagination and pagination['limit'] == 0):
+            # Only the number of matching documents is needed, so
+            # do not score more hits than required
+            search_result = searcher.search(query_, filter=filter_, limit=1, groupedby=groupedby, maptype=sorting.Count)
+            hits = []
+            total = len(search_result)
+
+        elif pagination:
+            # A single query returns the page and the total number of hits
+            search_kwparams['pagelen'] = pagination['limit']
+            page = searcher.search_page(query_, pagination['start'], **search_kwparams)
+            search_result = page.results
+            total = page.total
+
+            # Pages after the last one return the last page, as long as
+            # the start is not greater than the number of hits
+            if total == 0 or pagination['start'] > total:
+                hits = []
+            else:
+                hits = [hit.fields() for hit in page]
+        else:
+            if sort:
+                search_result = searcher.search(query_, filter=filter_, limit=None, sortedby=sort, reverse=reverse, groupedby=groupedby, maptype=sorting.Count)
             else:
-                result = {'number': len(search_result)}
+                search_result = searcher.search(query_, filter=filter_, limit=None, groupedby=groupedby, maptype=sorting.Count)
+
+            hits = [hit.fields() for hit in search_result]
+            total = len(hits)
+
+        if cached is None:
+            facet_counts = None
+            if facets:
+                facet_counts = self._get_facet_counts(search_result, groupedby)
+
+        if cache is not None and cached is None:
+            cache.set(cache_key, {
+                'hits': hits,
+                'total': total,
+                'facets': facet_counts,
+                'next_cursor': next_cursor
+            })
+
+        result = []
+        # The get_offerings_info method is imported inside this method in order to avoid a cross-reference import error
+        from wstore.offerings.offerings_management import get_offerings_info, load_offerings
+
+        if count:
+            result = {'number': total}
+
+            if facets:
+                result['facets'] = facet_counts
+
+            return result
+
+        if mode == 'card':
+            result = self._build_cards(hits, user)
+        else:
+            # Get the offerings
+            result = get_offerings_info(load_offerings([hit['id'] for hit in hits]), user)
+
+        # Include the total number of hits so a count request is not needed
+        if with_count or facets or (pagination and 'cursor' in pagination):
+            result = {
+                'results': result
+            }
+
+            if pagination and 'cursor' in pagination:
+                result['next_cursor'] = next_cursor
+
+            if with_count:
+                result['count'] = total
+
+            if facets:
+                result['facets'] = facet_counts
 
         return result
@@ -21,9 +21,12 @@
 from __future__ import unicode_literals
 
 import os
+import json
+import rdflib
+from copy import deepcopy
 from decimal import Decimal
 from datetime import datetime
-from mock import MagicMock
+from mock import MagicMock, patch
 from whoosh.fields import Schema, TEXT, KEYWORD, NUMERIC, DATETIME
 from whoosh.index import create_in, open_dir
 from whoosh.qparser import QueryParser
@@ -34,7 +37,14 @@ from django.test import TestCase
 from django.contrib.auth.models import User
 from django.conf import settings
 
+from wstore.search import index_registry
+from wstore.search import index_writer
+from wstore.search import usdl_text
+from wstore.search import search_engine
+from wstore.search.index_writer import IndexUpdateQueue
 from wstore.search.search_engine import SearchEngine
+from wstore.store_commons.utils.cache import LRUCache
+from wstore.store_commons.utils.cursor import encode_cursor
 from wstore.models import Offering
 from wstore.contracting.models import Purchase
 
@@ -70,7 +80,6 @@ QUERY_PUB = (query.Term('id', '61000aba8e05ac2115155555') & query.Term('state',
 QUERY_DEL = (query.Term('id', '61000aba8e05ac2115144444') & query.Term('state', 'deleted'))
 QUERY_RATED = (query.Term('id', '61000aba8e05ac2115122222') & query.Term('popularity', Decimal(3)))
 QUERY_CONTENT = (query.Term('id', '61000aba8e05ac2115166666') & query.Term('content', 'updated'))
-QUERY_PURCH = (query.Term('id', '61000aba8e05ac2115122222'))
 
 
 class IndexCreationTestCase(TestCase):
@@ -105,6 +114,13 @@ class IndexCreationTestCase(TestCase):
             doc = total_hits[0]
             self.assertEqual(offering.pk, doc['id'])
 
+            # Check card fields
+            self.assertEqual(doc['name'], offering.name)
+            self.assertEqual(doc['organization'], offering.owner_organization.name)
+            self.assertEqual(doc['version'], offering.version)
+            self.assertEqual(doc['state'], offering.state)
+            self.assertTrue('short_description' in doc)
+
 
 def _create_index(user):
 
@@ -257,6 +273,194 @@ class FullTextSearchTestCase(TestCase):
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(unicode(e), err_msg)
 
+    def test_search_purchased_offerings_updated(self):
+
+        user = User.objects.get(username='test_user')
+        se = SearchEngine(settings.DATADIR + '/test/test_index')
+
+        user.userprofile.offerings_purchased = []
+        user.userprofile.save()
+
+        result = se.full_text_search(user, 'offering', state='purchased')
+        self.assertEquals(result, [])
+
+        # A new purchase is found without updating the index
+        user.userprofile.offerings_purchased.append('61000aba8e05ac2115133333')
+        user.userprofile.save()
+
+        result = se.full_text_search(user, 'offering', state='purchased')
+        self.assertEquals([res['name'] for res in result], ['test_offering3'])
+
+    def test_search_offerings_card_mode(self):
+
+        user = User.objects.get(username='test_user')
+        se = SearchEngine(settings.DATADIR + '/test/test_index')
+
+        # The test index does not store card fields so offerings are loaded in bulk
+        result = se.full_text_search(user, 'offering', sort='name', mode='card')
+
+        self.assertEquals([res['name'] for res in result], RESULT_PUBLISHED)
+        for res in result:
+            self.assertEquals(set(res.keys()), set(['name', 'owner_organization', 'version', 'state', 'rating', 'image_url', 'short_description']))
+
+    def test_search_offerings_with_count(self):
+
+        user = User.objects.get(username='test_user')
+        se = SearchEngine(settings.DATADIR + '/test/test_index')
+
+        result = se.full_text_search(user, 'offering', pagination={'start': 2, 'limit': 2}, sort='name', with_count=True)
+
+        self.assertEquals(result['count'], len(RESULT_PUBLISHED))
+        self.assertEquals([res['name'] for res in result['results']], RESULT_PUBLISHED[2:4])
+
+        # Pages after the last one return the last page
+        result = se.full_text_search(user, 'offering', pagination={'start': 3, 'limit': 2}, sort='name', with_count=True)
+
+        self.assertEquals(result['count'], len(RESULT_PUBLISHED))
+        self.assertEquals([res['name'] for res in result['results']], RESULT_PUBLISHED[2:4])
+
+        # Starts greater than the number of hits are empty but include the total
+        result = se.full_text_search(user, 'offering', pagination={'start': 5, 'limit': 2}, with_count=True)
+
+        self.assertEquals(result['count'], len(RESULT_PUBLISHED))
+        self.assertEquals(result['results'], [])
+
+    def test_search_offerings_cursor(self):
+
+        user = User.objects.get(username='test_user')
+        se = SearchEngine(settings.DATADIR + '/test/test_index')
+
+        # Walk all the pages using the cursor of the previous one
+        names = []
+        cursor = ''
+        while cursor is not None:
+            result = se.full_text_search(user, 'offering', pagination={'cursor': cursor, 'limit': 2}, sort='name')
+            self.assertTrue(len(result['results']) <= 2)
+
+            names.extend([res['name'] for res in result['results']])
+            cursor = result['next_cursor']
+
+        self.assertEquals(names, RESULT_PUBLISHED)
+
+        # Hits with the same sort value are not repeated nor skipped
+        names = []
+        cursor = ''
+        while cursor is not None:
+            result = se.full_text_search(user, 'offering', pagination={'cursor': cursor, 'limit': 1}, sort='popularity')
+            names.extend([res['name'] for res in result['results']])
+            cursor = result['next_cursor']
+
+        self.assertEquals(sorted(names), sorted(RESULT_PUBLISHED))
+
+        # Crafted cursors are reported as invalid
+        error = None
+        try:
+            cursor = encode_cursor({'$oid': 'invalid'}, '61000aba8e05ac2115155555')
+            se.full_text_search(user, 'offering', pagination={'cursor': cursor, 'limit': 2}, sort='name')
+        except Exception as e:
+            error = e
+
+        self.assertTrue(isinstance(error, ValueError))
+        self.assertEquals(unicode(error), 'Invalid cursor')
+
+        # Cursors whose values do not match the sorting are reported as invalid
+        crafted = [
+            ('popularity', encode_cursor('name', '61000aba8e05ac2115155555')),
+            ('popularity', encode_cursor(True, '61000aba8e05ac2115155555')),
+            ('date', encode_cursor(Decimal('2.5'), '61000aba8e05ac2115155555')),
+            ('name', encode_cursor(datetime(2013, 4, 1), '61000aba8e05ac2115155555')),
+            ('name', encode_cursor({'$ne': None}, '61000aba8e05ac2115155555')),
+            ('name', encode_cursor('name', ['61000aba8e05ac2115155555']))
+        ]
+        for sort, cursor in crafted:
+            error = None
+            try:
+                se.full_text_search(user, 'offering', pagination={'cursor': cursor, 'limit': 2}, sort=sort)
+            except Exception as e:
+                error = e
+
+            self.assertTrue(isinstance(error, ValueError))
+            self.assertEquals(unicode(error), 'Invalid cursor')
+
+        # Cursor pagination needs the sort values of the last hit
+        error = None
+        try:
+            se.full_text_search(user, 'offering', pagination={'cursor': '', 'limit': 2})
+        except Exception as e:
+            error = e
+
+        self.assertTrue(isinstance(error, ValueError))
+        self.assertEquals(unicode(error), 'Cursor pagination requires a sorting')
+
+    def test_search_offerings_invalid_mode(self):
+
+        user = User.objects.get(username='test_user')
+        se = SearchEngine(settings.DATADIR + '/test/test_index')
+
+        error = None
+        try:
+            se.full_text_search(user, 'offering', mode='invalid')
+        except Exception as e:
+            error = e
+
+        self.assertTrue(isinstance(error, ValueError))
+        self.assertEquals(unicode(error), 'Invalid result mode')
+
+
+    def test_search_offerings_facets(self):
+
+        user = User.objects.get(username='test_user')
+        se = SearchEngine(settings.DATADIR + '/test/test_index')
+
+        result = se.full_text_search(user, 'offering', state='all', facets=True)
+
+        self.assertEquals(sorted([res['name'] for res in result['results']]), RESULT_ALL)
+
+        # Facet counts include all the hits of the query
+        states = {}
+        for name in RESULT_ALL:
+            state = Offering.objects.get(name=name).state
+            states[state] = states.get(state, 0) + 1
+
+        self.assertEquals(result['facets']['state'], states)
+        self.assertEquals(result['facets']['owner'], {
+            user.userprofile.current_organization.name: len(RESULT_ALL)
+        })
+
+        # The index was created without tags
+        self.assertFalse('tag' in result['facets'])
+
+        result = se.full_text_search(user, 'offering', count=True, facets=True)
+        self.assertEquals(result['number'], len(RESULT_PUBLISHED))
+        self.assertEquals(result['facets']['state'], {'published': len(RESULT_PUBLISHED)})
+
+    def test_search_offerings_cached(self):
+
+        user = User.objects.get(username='test_user')
+        se = SearchEngine(settings.DATADIR + '/test/test_index')
+
+        cache = LRUCache(10, ttl=60)
+        search_engine.get_result_cache = MagicMock(return_value=cache)
+        try:
+            result = se.full_text_search(user, 'offering', sort='name', mode='card')
+            self.assertEquals(len(cache), 1)
+
+            # The second search is served from the cache
+            self.assertEquals(se.full_text_search(user, 'offering', sort='name', mode='card'), result)
+            self.assertEquals(len(cache), 1)
+
+            # Purchased offerings are not cached
+            se.full_text_search(user, 'offering', state='purchased')
+            self.assertEquals(len(cache), 1)
+
+            # An index commit invalidates the cached results
+            se._aggregate_text = MagicMock(return_value='offering')
+            se.update_index(Offering.objects.get(name='test_offering1'))
+            se.full_text_search(user, 'offering', sort='name', mode='card')
+            self.assertEquals(len(cache), 2)
+        finally:
+            reload(search_engine)
+
 
 class UpdateIndexTestCase(TestCase):
 
@@ -312,33 +516,95 @@ class UpdateIndexTestCase(TestCase):
         sa._aggregate_text = MagicMock()
         sa._aggregate_text.return_value = "updated"
 
-    def _update_purchased(self, offering, sa=None):
-        user = User.objects.get(pk="51000aba8e05ac2115f022f9")
-
-        Purchase.objects.create(
-            customer=user,
-            date=self.date,
-            offering=offering,
-            organization_owned=False,
-            state='pending',
-            tax_address={},
-            owner_organization = user.userprofile.current_organization
-        )
+    def test_update_index_queue(self):
+
+        off = Offering.objects.get(pk='61000aba8e05ac2115155555')
+        self._update_published(off)
+
+        queue = IndexUpdateQueue(batch_size=10, commit_delay=60)
+        queue.put(settings.DATADIR + '/test/test_index', off.pk)
+        queue.put(settings.DATADIR + '/test/test_index', off.pk)
+
+        # Updates of the same offering are merged
+        stats = queue.get_stats()
+        self.assertEquals(stats['pending'], 1)
+        self.assertTrue(stats['lag'] >= 0)
+
+        queue.flush()
+
+        stats = queue.get_stats()
+        self.assertEquals(stats['pending'], 0)
+        self.assertEquals(stats['committed'], 1)
+        self.assertEquals(stats['lag'], 0)
+
+        index = open_dir(settings.DATADIR + '/test/test_index')
+        with index.searcher() as searcher:
+            self.assertEquals(len(searcher.search(QUERY_PUB)), 1)
+
+    def test_update_index_queue_retry(self):
+
+        off = Offering.objects.get(pk='61000aba8e05ac2115155555')
+        self._update_published(off)
+
+        queue = IndexUpdateQueue(batch_size=10, commit_delay=60, max_attempts=2, retry_delay=60)
+        queue.put(settings.DATADIR + '/test/test_index', off.pk)
+
+        with patch.object(SearchEngine, 'apply_updates', side_effect=Exception('Locked index')):
+            queue.flush()
+
+            # The failed update is kept waiting for its backoff
+            stats = queue.get_stats()
+            self.assertEquals(stats['pending'], 0)
+            self.assertEquals(stats['retrying'], 1)
+            self.assertEquals(stats['committed'], 0)
+            self.assertEquals(stats['failed'], 1)
+            self.assertTrue(stats['lag'] >= 0)
+
+            # The update is discarded when the maximum number of attempts is reached
+            queue.flush()
+
+            stats = queue.get_stats()
+            self.assertEquals(stats['retrying'], 0)
+            self.assertEquals(stats['failed'], 2)
+            self.assertEquals(stats['dropped'], 1)
+
+        queue.put(settings.DATADIR + '/test/test_index', off.pk)
+
+        with patch.object(SearchEngine, 'apply_updates', side_effect=[Exception('Locked index'), None]):
+            queue.flush()
+            queue.flush()
+
+        stats = queue.get_stats()
+        self.assertEquals(stats['retrying'], 0)
+        self.assertEquals(stats['committed'], 1)
+        self.assertEquals(stats['lag'], 0)
+
+    def test_update_index_queue_lag_warning(self):
+
+        off = Offering.objects.get(pk='61000aba8e05ac2115155555')
+        self._update_published(off)
+
+        queue = IndexUpdateQueue(batch_size=10, commit_delay=60, lag_warning=0)
+        queue.put(settings.DATADIR + '/test/test_index', off.pk)
+
+        # Commits lagging behind the threshold are logged as warnings
+        with patch.object(index_writer.logger, 'warning') as warning:
+            queue.flush()
+
+        self.assertEquals(warning.call_count, 1)
+        self.assertTrue(warning.call_args[0][0].startswith('The search index is '))
 
     @parameterized.expand([
         (_update_published, '61000aba8e05ac2115155555', QUERY_PUB),
         (_update_deleted, '61000aba8e05ac2115144444', QUERY_DEL),
         (_update_rated, '61000aba8e05ac2115111111', QUERY_RATED),
         (_update_content, '61000aba8e05ac2115166666', QUERY_CONTENT),
-        (_update_purchased, '61000aba8e05ac2115122222', QUERY_PURCH, True),
-        (_remove_index, '', None, False, Exception, 'The index does not exist')
+        (_remove_index, '61000aba8e05ac2115155555', None, Exception, 'The index does not exist')
     ])
-    def test_update_index(self, update_method, offering, query_, owned=False, err_type=None, err_msg=None):
+    def test_update_index(self, update_method, offering, query_, err_type=None, err_msg=None):
 
         # Get the offering
-        off = None
-        if not err_type:
-            off = Offering.objects.get(pk=offering)
+        off = Offering.objects.get(pk=offering)
 
         # Create the search engine
         se = SearchEngine(settings.DATADIR + '/test/test_index')
@@ -358,14 +624,163 @@ class UpdateIndexTestCase(TestCase):
             index = open_dir(settings.DATADIR + '/test/test_index')
 
             with index.searcher() as searcher:
-                if owned:
-                    user = User.objects.get(pk="51000aba8e05ac2115f022f9")
-                    pk = user.userprofile.current_organization.pk
-                    query_ = query_ & query.Term('purchaser', pk)
-
                 search_result = searcher.search(query_)
 
                 self.assertEquals(len(search_result), 1)
         else:
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(unicode(error), err_msg)
+
+
+class IndexRegistryTestCase(TestCase):
+
+    tags = ('fiware-ut-6',)
+
+    def setUp(self):
+        self._index_path = settings.DATADIR + '/test/test_index'
+        if os.path.exists(self._index_path):
+            _remove_index(self)
+
+        os.makedirs(self._index_path)
+        schema = Schema(id=KEYWORD(stored=True, unique=True), content=TEXT)
+        index = create_in(self._index_path, schema)
+
+        index_writer = index.writer()
+        index_writer.add_document(id=unicode('1'), content=unicode('an offering'))
+        index_writer.commit()
+
+    def tearDown(self):
+        index_registry.clear_registry()
+        try:
+            _remove_index(self)
+        except:
+            pass
+
+    def test_index_handles_reused(self):
+        index = index_registry.get_index(self._index_path)[0]
+        searcher = index_registry.get_searcher(self._index_path)
+
+        self.assertTrue(index is index_registry.get_index(self._index_path)[0])
+        self.assertTrue(searcher is index_registry.get_searcher(self._index_path))
+        self.assertEquals(searcher.doc_count(), 1)
+
+    def test_searcher_refreshed_on_commit(self):
+        searcher = index_registry.get_searcher(self._index_path)
+        self.assertEquals(searcher.doc_count(), 1)
+
+        index_writer = index_registry.get_index(self._index_path)[0].writer()
+        index_writer.add_document(id=unicode('2'), content=unicode('another offering'))
+        index_writer.commit()
+
+        searcher = index_registry.get_searcher(self._index_path)
+        self.assertEquals(searcher.doc_count(), 2)
+
+    def test_recreated_index_reopened(self):
+        index_registry.get_searcher(self._index_path)
+
+        _remove_index(self)
+        self.assertEquals(index_registry.get_searcher(self._index_path), None)
+
+        os.makedirs(self._index_path)
+        schema = Schema(id=KEYWORD(stored=True, unique=True), content=TEXT)
+        index = create_in(self._index_path, schema)
+
+        index_writer = index.writer()
+        index_writer.add_document(id=unicode('3'), content=unicode('an offering'))
+        index_writer.commit()
+
+        searcher = index_registry.get_searcher(self._index_path)
+        self.assertEquals([doc['id'] for doc in searcher.documents()], ['3'])
+
+    def test_filter_docs_cached(self):
+        index_registry.get_searcher(self._index_path)
+
+        docs = index_registry.get_filter_docs(self._index_path, 'id', '1')
+        self.assertEquals(len(docs), 1)
+        self.assertTrue(docs is index_registry.get_filter_docs(self._index_path, 'id', '1'))
+
+        # Docsets are computed again when the searcher is refreshed
+        index_writer = index_registry.get_index(self._index_path)[0].writer()
+        index_writer.add_document(id=unicode('1'), content=unicode('another offering'))
+        index_writer.commit()
+
+        index_registry.get_searcher(self._index_path)
+        self.assertEquals(len(index_registry.get_filter_docs(self._index_path, 'id', '1')), 2)
+
+
+class USDLTextTestCase(TestCase):
+
+    tags = ('fiware-ut-6',)
+    fixtures = ['create_index.json']
+
+    def setUp(self):
+        usdl_text._cache.clear()
+
+    def test_text_extraction(self):
+        offering = Offering.objects.get(name='test_offering')
+        description = deepcopy(offering.offering_description)
+
+        # Values of context terms typed as @id are IRIs and not literals
+        description['@context']['image'] = {
+            '@id': 'http://xmlns.com/foaf/0.1/depiction',
+            '@type': '@id'
+        }
+        description['@graph'][0]['image'] = 'http://example.com/image.png'
+
+        # The extracted literals must be the same as the ones of the RDF graph
+        graph = rdflib.ConjunctiveGraph()
+        graph.parse(data=json.dumps(description), format='json-ld')
+        expected = set([unicode(o) for s, p, o in graph if isinstance(o, rdflib.Literal)])
+
+        id_terms = usdl_text._get_id_terms(description['@context'])
+        self.assertEquals(id_terms, set(['image']))
+
+        literals = []
+        usdl_text._walk_literals(description, id_terms, literals)
+        self.assertEquals(set(literals), expected)
+        self.assertFalse('http://example.com/image.png' in literals)
+
+    def test_text_cached(self):
+        offering = Offering.objects.get(name='test_offering')
+
+        with patch.object(usdl_text, 'extract_text', wraps=usdl_text.extract_text) as extract_text:
+            text = usdl_text.get_usdl_text(offering.offering_description)
+            self.assertEquals(usdl_text.get_usdl_text(offering.offering_description), text)
+            self.assertEquals(extract_text.call_count, 1)
+
+            # A modified description is extracted again
+            offering.offering_description['@graph'].append({'dcterms:title': 'updated'})
+            self.assertTrue('updated' in usdl_text.get_usdl_text(offering.offering_description))
+            self.assertEquals(extract_text.call_count, 2)
+
+    def test_stemmed_tokens(self):
+        tokens = usdl_text.get_stemmed_tokens('Map viewer description')
+
+        self.assertEquals(tokens, set(['map', 'viewer', 'descript']))
+        tokens.add('other')
+        self.assertEquals(usdl_text.get_stemmed_tokens('Map viewer description'), set(['map', 'viewer', 'descript']))
+
+
+class ResultCacheTestCase(TestCase):
+
+    tags = ('fiware-ut-6',)
+
+    def test_result_cache_size(self):
+        cache = LRUCache(2, ttl=60)
+
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        # The least recently used entry is removed
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('c'), 3)
+
+    def test_result_cache_ttl(self):
+        cache = LRUCache(2, ttl=-1)
+
+        cache.set('a', 1)
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(len(cache), 0)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.conf import settings
+from whoosh.analysis import StemmingAnalyzer
+
+from wstore.store_commons.utils.cache import LRUCache
+
+
+_cache = LRUCache(getattr(settings, 'USDL_TEXT_CACHE_SIZE', 512))
+
+
+def _get_id_terms(context):
+    """
+    Get the terms of a JSON-LD context whose values are IRIs and not literals
+    """
+    id_terms = set()
+
+    if isinstance(context, list):
+        for ctx in context:
+            id_terms |= _get_id_terms(ctx)
+
+    elif isinstance(context, dict):
+        for term, definition in context.iteritems():
+            if isinstance(definition, dict) and definition.get('@type') == '@id':
+                id_terms.add(term)
+
+    return id_terms
+
+
+def _walk_literals(node, id_terms, literals, key=None):
+    """
+    Collect the literal values of a JSON-LD node
+    """
+    if isinstance(node, list):
+        for item in node:
+            _walk_literals(item, id_terms, literals, key)
+
+    elif isinstance(node, dict):
+        if '@value' in node:
+            _walk_literals(node['@value'], id_terms, literals)
+            return
+
+        for k, value in node.iteritems():
+            # Keywords such as @id, @type or @context are not literals, while
+            # @graph, @list and @set contain nodes or values
+            if k.startswith('@') and k not in ('@graph', '@list', '@set'):
+                continue
+
+            _walk_literals(value, id_terms, literals, k)
+
+    elif isinstance(node, bool):
+        literals.append('true' if node else 'false')
+
+    elif isinstance(node, basestring):
+        if not key in id_terms:
+            literals.append(node)
+
+    elif node is not None:
+        literals.append(unicode(node))
+
+
+def extract_text(usdl_document):
+    """
+    Extract the literals of a JSON-LD USDL document walking its nodes
+    without building an RDF graph
+    """
+    literals = []
+    _walk_literals(usdl_document, _get_id_terms(usdl_document.get('@context')), literals)
+
+    text = ''
+    for literal in literals:
+        text += ' ' + unicode(literal)
+
+    return text
+
+
+def _get_hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_usdl_text(usdl_document):
+    """
+    Get the text of a USDL document, the extracted text is cached using the
+    hash of the document content
+    """
+    key = 'text:' + _get_hash(usdl_document)
+
+    text = _cache.get(key)
+    if text is None:
+        text = extract_text(usdl_document)
+        _cache.set(key, text)
+
+    return text
+
+
+def get_stemmed_tokens(text):
+    """
+    Get the set of stemmed tokens of a text, the tokens are cached
+    using the hash of the text
+    """
+    key = 'tokens:' + _get_hash(text)
+
+    tokens = _cache.get(key)
+    if tokens is None:
+        analyzer = StemmingAnalyzer()
+        tokens = frozenset([token.text for token in analyzer(unicode(text))])
+        _cache.set(key, tokens)
+
+    return set(tokens)
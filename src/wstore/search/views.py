@@ -28,10 +28,10 @@ from django.conf import settings
 
 from wstore.store_commons.utils.http import build_response, authentication_required
 from wstore.store_commons.resource import Resource
-from wstore.search.search_engine import SearchEngine
+from wstore.search.search_engine import SearchEngine, decode_search_cursor
 from wstore.models import Resource as WStore_resource
-from wstore.models import Organization, Offering
-from wstore.offerings.offerings_management import get_offering_info
+from wstore.models import Organization
+from wstore.offerings.offerings_management import get_offerings_info, load_offerings
 
 
 class SearchEntry(Resource):
@@ -49,12 +49,20 @@ class SearchEntry(Resource):
         action = request.GET.get('action', None)
         start = request.GET.get('start', None)
         limit = request.GET.get('limit', None)
+        cursor = request.GET.get('cursor', None)
         sort = request.GET.get('sort', None)
+        mode = request.GET.get('mode', 'full')
+        with_count = request.GET.get('with_count', 'false').lower() == 'true'
+        facets = request.GET.get('facets', 'false').lower() == 'true'
 
         # Check the filter value
         if filter_ and filter_ != 'published' and filter_ != 'provided' and filter_ != 'purchased':
             return build_response(request, 400, 'Invalid filter')
 
+        # Check the result mode, card mode returns the offering info stored in the index
+        if mode != 'full' and mode != 'card':
+            return build_response(request, 400, 'Invalid mode')
+
         count = False
         pagination = None
         # Check if the action is count
@@ -64,8 +72,26 @@ class SearchEntry(Resource):
             else:
                 return build_response(request, 400, 'Invalid action')
         else:
-            # Check pagination params (Only when action is none)
-            if start != None and limit != None:
+            # Check pagination params (Only when action is none), an
+            # empty cursor requests the first page of a cursor pagination
+            if cursor != None:
+                if limit == None:
+                    return build_response(request, 400, 'Missing pagination param')
+
+                if sort == None:
+                    return build_response(request, 400, 'Cursor pagination requires a sorting')
+
+                if cursor:
+                    try:
+                        decode_search_cursor(cursor, sort)
+                    except ValueError as e:
+                        return build_response(request, 400, unicode(e))
+
+                pagination = {
+                    'cursor': cursor,
+                    'limit': int(limit)
+                }
+            elif start != None and limit != None:
                 pagination = {
                     'start': int(start),
                     'limit': int(limit)
@@ -79,7 +105,7 @@ class SearchEntry(Resource):
                     return build_response(request, 400, 'Invalid sorting')
 
         if not filter_:
-            response = search_engine.full_text_search(request.user, text, count=count, pagination=pagination, sort=sort)
+            response = search_engine.full_text_search(request.user, text, count=count, pagination=pagination, sort=sort, mode=mode, with_count=with_count, facets=facets)
 
         elif filter_ == 'provided':
 
@@ -90,10 +116,10 @@ class SearchEntry(Resource):
 
                 return build_response(request, 400, 'Invalid state')
 
-            response = search_engine.full_text_search(request.user, text, state=state, count=count, pagination=pagination, sort=sort)
+            response = search_engine.full_text_search(request.user, text, state=state, count=count, pagination=pagination, sort=sort, mode=mode, with_count=with_count, facets=facets)
 
         elif filter_ == 'purchased':
-            response = search_engine.full_text_search(request.user, text, state='purchased', count=count, pagination=pagination, sort=sort)
+            response = search_engine.full_text_search(request.user, text, state='purchased', count=count, pagination=pagination, sort=sort, mode=mode, with_count=with_count, facets=facets)
 
         return HttpResponse(json.dumps(response), status=200, mimetype='application/json')
 
@@ -114,12 +140,8 @@ class SearchByResourceEntry(Resource):
             return build_response(request, 404, 'Resource not found')
 
         # Get offering where the resource is included
-        response = []
-
         try:
-            for off in resource.offerings:
-                offering = Offering.objects.get(pk=off)
-                response.append(get_offering_info(offering, request.user))
+            response = get_offerings_info(load_offerings(resource.offerings), request.user)
         except Exception as e:
             return build_response(request, 400, unicode(e))
 
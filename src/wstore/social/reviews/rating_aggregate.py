@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+from pymongo.errors import DuplicateKeyError
+
+from wstore.social.reviews.models import Review
+from wstore.store_commons.database import get_database_connection
+
+
+STARS = (1, 2, 3, 4, 5)
+
+
+def _get_collection():
+    return get_database_connection().wstore_offering_rating
+
+
+def get_average(aggregate):
+    """
+    Returns the average rating of a rating aggregate
+    """
+    if aggregate is None or aggregate['count'] <= 0:
+        return 0
+
+    return float(aggregate['sum']) / aggregate['count']
+
+
+def ensure_rating_aggregate(offering):
+    """
+    Creates the rating aggregate of an offering from its stored reviews if
+    it does not exist. It must be called before modifying the reviews of
+    the offering so the modification is not counted twice
+    """
+    collection = _get_collection()
+    pk = unicode(offering.pk)
+
+    if collection.find_one({'_id': pk}, {'_id': True}) is not None:
+        return
+
+    aggregate = {
+        '_id': pk,
+        'sum': 0,
+        'count': 0,
+        'histogram': dict((unicode(star), 0) for star in STARS)
+    }
+
+    for review in Review.objects.filter(offering=offering):
+        aggregate['sum'] += review.rating
+        aggregate['count'] += 1
+        aggregate['histogram'][unicode(review.rating)] += 1
+
+    try:
+        collection.insert(aggregate)
+    except DuplicateKeyError:
+        # The aggregate has been created by a concurrent request
+        pass
+
+
+def update_rating_aggregate(offering, add=None, remove=None):
+    """
+    Atomically adds and/or removes a rating from the aggregate of an
+    offering, returns the new average rating
+    """
+    inc = {}
+    for rating, delta in ((add, 1), (remove, -1)):
+        if rating is None:
+            continue
+
+        star = 'histogram.%d' % rating
+        inc['sum'] = inc.get('sum', 0) + (rating * delta)
+        inc['count'] = inc.get('count', 0) + delta
+        inc[star] = inc.get(star, 0) + delta
+
+    aggregate = _get_collection().find_and_modify(
+        {'_id': unicode(offering.pk)},
+        {'$inc': inc},
+        new=True
+    )
+
+    return get_average(aggregate)
+
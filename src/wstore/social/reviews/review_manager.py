@@ -21,14 +21,24 @@
 from __future__ import unicode_literals
 
 import os
+from bson import ObjectId
 from datetime import datetime
 
 from django.core.exceptions import PermissionDenied
+from django.db.models import Q
 from django.conf import settings
 
 from wstore.models import Offering, Context, Purchase
 from wstore.social.reviews.models import Review, Response
+from wstore.social.reviews.rating_aggregate import ensure_rating_aggregate, update_rating_aggregate
 from wstore.search.search_engine import SearchEngine
+from wstore.offerings.feeds import update_feeds
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.utils.cursor import encode_cursor, decode_cursor
+
+
+# Number of offerings included in the top rated list
+TOP_RATED_SIZE = 8
 
 
 class ReviewManager():
@@ -67,15 +77,40 @@ class ReviewManager():
 
         return exception
 
-    def _update_top_rated(self):
+    def _update_top_rated(self, offering, old_rating):
         """
-        Updates top rated list to new rating
+        Updates top rated list to the new rating of an offering. The list is
+        only modified when the offering enters or leaves it or when its
+        position changes
         """
-        # Check the top rated structure
         context = Context.objects.all()[0]
+        top_rated = list(context.top_rated)
+
+        ratings = {}
+        if len(top_rated):
+            ratings = dict((off.pk, off.rating) for off in Offering.objects.filter(pk__in=top_rated))
 
-        context.top_rated = [off.pk for off in Offering.objects.filter(state="published").order_by('-rating')[:8]]
-        context.save()
+        ranking = [pk for pk in top_rated if pk in ratings and pk != offering.pk]
+        if offering.state == 'published':
+            ratings[offering.pk] = offering.rating
+            ranking.append(offering.pk)
+
+        ranking.sort(key=lambda pk: ratings[pk], reverse=True)
+
+        if offering.pk in top_rated and (len(ranking) < TOP_RATED_SIZE or
+                (offering.rating < old_rating and ranking[-1] == offering.pk)):
+            # An offering out of the list may have a higher rating
+            ranking = [off.pk for off in Offering.objects.filter(state='published').order_by('-rating')[:TOP_RATED_SIZE]]
+        else:
+            ranking = ranking[:TOP_RATED_SIZE]
+
+        if ranking != top_rated:
+            context.top_rated = ranking
+            context.save()
+
+        # The rating of the offering is included in the feed entries
+        if ranking != top_rated or offering.pk in ranking or offering.pk in context.newest:
+            update_feeds(context, changed=[offering.pk])
 
     def _get_and_validate_review(self, user, review_id, owner=False):
         """
@@ -126,6 +161,8 @@ class ReviewManager():
         if validation:
             raise validation
 
+        ensure_rating_aggregate(offering)
+
         # Create the review
         rev = Review.objects.create(
             user=user,
@@ -137,17 +174,20 @@ class ReviewManager():
             rating=review['rating']
         )
 
+        # Include the review in the offering, only the comments and rating
+        # fields are written so concurrent updates are not overwritten.
+        # Reviews are listed from the newest one
+        db = get_database_connection()
+        db.wstore_offering.update(
+            {'_id': ObjectId(offering.pk)},
+            {'$push': {'comments': {'$each': [rev.pk], '$position': 0}}}
+        )
         offering.comments.insert(0, rev.pk)
 
         # Calculate new offering rate
         old_rate = offering.rating
-
-        if old_rate == 0:
-            offering.rating = review['rating']
-        else:
-            offering.rating = ((old_rate * (len(offering.comments) - 1)) + review['rating']) / len(offering.comments)
-
-        offering.save()
+        offering.rating = update_rating_aggregate(offering, add=review['rating'])
+        Offering.objects.filter(pk=offering.pk).update(rating=offering.rating)
 
         # Update offering indexes
         index_path = settings.DATADIR
@@ -155,7 +195,7 @@ class ReviewManager():
         index_path = os.path.join(index_path, 'indexes')
 
         se = SearchEngine(index_path)
-        se.update_index(offering)
+        se.update_index(offering, deferred=True)
 
         # Save the offering as rated
         if user.userprofile.is_user_org():
@@ -169,7 +209,31 @@ class ReviewManager():
             user.userprofile.current_organization.save()
 
         # Update top rated list
-        self._update_top_rated()
+        self._update_top_rated(offering, old_rate)
+
+    def _get_review_info(self, review):
+        """
+        Returns the JSON structure of a review
+        """
+        review_data = {
+            'id': review.pk,
+            'user': review.user.username,
+            'organization': review.organization.name,
+            'timestamp': unicode(review.timestamp),
+            'title': review.title,
+            'comment': review.comment,
+            'rating': review.rating,
+        }
+        if review.response:
+            review_data['response'] = {
+                'user': review.response.user.username,
+                'organization': review.response.organization.name,
+                'timestamp': unicode(review.response.timestamp),
+                'title': review.response.title,
+                'response': review.response.response,
+            }
+
+        return review_data
 
     def get_reviews(self, offering, start=None, limit=None):
         """
@@ -194,29 +258,36 @@ class ReviewManager():
         else:
             reviews = Review.objects.filter(offering=offering).order_by('-timestamp')
 
-        # Create JSON structure
-        result = []
-        for review in reviews:
-            review_data = {
-                'id': review.pk,
-                'user': review.user.username,
-                'organization': review.organization.name,
-                'timestamp': unicode(review.timestamp),
-                'title': review.title,
-                'comment': review.comment,
-                'rating': review.rating,
-            }
-            if review.response:
-                review_data['response'] = {
-                    'user': review.response.user.username,
-                    'organization': review.response.organization.name,
-                    'timestamp': unicode(review.response.timestamp),
-                    'title': review.response.title,
-                    'response': review.response.response,
-                }
-            result.append(review_data)
-
-        return result
+        return [self._get_review_info(review) for review in reviews]
+
+    def get_reviews_page(self, offering, limit, cursor=None):
+        """
+        Gets the reviews of a given offering placed after a cursor, the
+        cursor of the next page is returned together with the reviews
+        """
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise TypeError('Invalid pagination params')
+
+        if not limit > 0:
+            raise ValueError('Limit parameter should be higher than 0')
+
+        reviews = Review.objects.filter(offering=offering)
+
+        if cursor:
+            timestamp, last_id = decode_cursor(cursor, types=(datetime, (unicode, ObjectId)))
+            reviews = reviews.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=last_id))
+
+        # An extra review is read to know if there is a next page
+        reviews = list(reviews.order_by('-timestamp', '-pk')[:limit + 1])
+
+        next_cursor = None
+        if len(reviews) > limit:
+            reviews = reviews[:limit]
+            next_cursor = encode_cursor(reviews[-1].timestamp, reviews[-1].pk)
+
+        return [self._get_review_info(review) for review in reviews], next_cursor
 
     def update_review(self, user, review, review_data):
         """
@@ -229,9 +300,11 @@ class ReviewManager():
             raise validation
 
         rev = self._get_and_validate_review(user, review)
+        ensure_rating_aggregate(rev.offering)
 
         # Calculate new rating
-        rate = ((rev.offering.rating * len(rev.offering.comments)) - rev.rating + review_data['rating']) / len(rev.offering.comments)
+        old_rate = rev.offering.rating
+        rate = update_rating_aggregate(rev.offering, add=review_data['rating'], remove=rev.rating)
 
         # update review
         rev.title = review_data['title']
@@ -241,9 +314,10 @@ class ReviewManager():
 
         rev.save()
 
-        # Update offering rating
+        # Update offering rating, only the rating field is written so
+        # concurrent updates of the offering are not overwritten
         rev.offering.rating = rate
-        rev.offering.save()
+        Offering.objects.filter(pk=rev.offering.pk).update(rating=rate)
 
         # Update offering indexes
         index_path = settings.DATADIR
@@ -251,10 +325,10 @@ class ReviewManager():
         index_path = os.path.join(index_path, 'indexes')
 
         se = SearchEngine(index_path)
-        se.update_index(rev.offering)
+        se.update_index(rev.offering, deferred=True)
 
         # Update top rated offerings
-        self._update_top_rated()
+        self._update_top_rated(rev.offering, old_rate)
 
     def _remove_review_from_org(self, user, offering, org):
         old_rate = None
@@ -270,17 +344,21 @@ class ReviewManager():
         Removes a given review
         """
         rev = self._get_and_validate_review(user, review)
+        ensure_rating_aggregate(rev.offering)
 
         # Remove review from offering
-        rev.offering.comments.remove(review)
+        db = get_database_connection()
+        db.wstore_offering.update(
+            {'_id': ObjectId(rev.offering.pk)},
+            {'$pull': {'comments': review}}
+        )
+        if review in rev.offering.comments:
+            rev.offering.comments.remove(review)
 
         # Update offering rating
-        if len(rev.offering.comments):
-            rev.offering.rating = ((rev.offering.rating * (len(rev.offering.comments) + 1)) - rev.rating) / len(rev.offering.comments)
-        else:
-            rev.offering.rating = 0
-
-        rev.offering.save()
+        old_rate = rev.offering.rating
+        rev.offering.rating = update_rating_aggregate(rev.offering, remove=rev.rating)
+        Offering.objects.filter(pk=rev.offering.pk).update(rating=rev.offering.rating)
 
         # Update offering indexes
         index_path = settings.DATADIR
@@ -288,10 +366,10 @@ class ReviewManager():
         index_path = os.path.join(index_path, 'indexes')
 
         se = SearchEngine(index_path)
-        se.update_index(rev.offering)
+        se.update_index(rev.offering, deferred=True)
 
         # Update top rated offerings
-        self._update_top_rated()
+        self._update_top_rated(rev.offering, old_rate)
 
         # Update user info to allow her to create a new review
         if rev.user == user:
@@ -20,6 +20,7 @@
 
 from __future__ import unicode_literals
 
+from bson import ObjectId
 from datetime import datetime
 
 from mock import MagicMock
@@ -29,6 +30,7 @@ from django.test import TestCase
 from django.core.exceptions import PermissionDenied
 
 from wstore.social.reviews import review_manager
+from wstore.social.reviews import rating_aggregate
 
 
 ##########################################################################
@@ -194,6 +196,14 @@ class ReviewTestCase(TestCase):
         cont = MagicMock()
         context_object.objects.all.return_value = [cont]
         review_manager.Context = context_object
+        review_manager.update_feeds = MagicMock()
+
+        # Mock rating aggregates
+        review_manager.ensure_rating_aggregate = MagicMock()
+        review_manager.update_rating_aggregate = MagicMock()
+        review_manager.Offering = MagicMock()
+        review_manager.get_database_connection = MagicMock()
+        self.db = review_manager.get_database_connection.return_value
 
         # Mock datetime
         self.datetime = datetime.now()
@@ -205,7 +215,7 @@ class ReviewTestCase(TestCase):
 
         # Create test offering mock
         self.offering = MagicMock()
-        self.offering.pk = '222222'
+        self.offering.pk = '61000aba8e05ac2115222222'
         self.offering.comments = ['333333', '444444', '555555']
         self.offering.rating = 5.0
         self.offering.open = False
@@ -294,6 +304,8 @@ class ReviewTestCase(TestCase):
         if side_effect:
             side_effect(self)
 
+        review_manager.update_rating_aggregate.return_value = exp_rating
+
         exception = None
         try:
             rm.create_review(self.user, self.offering, review)
@@ -319,9 +331,20 @@ class ReviewTestCase(TestCase):
                 comment=review['comment'],
                 rating=review['rating']
             )
+            review_manager.ensure_rating_aggregate.assert_called_once_with(self.offering)
+            review_manager.update_rating_aggregate.assert_called_once_with(self.offering, add=review['rating'])
             self.assertEquals(self.offering.rating, exp_rating)
             self.assertEquals(self.offering.comments[0], rev.pk)
 
+            # Only the comments and rating of the offering are written
+            self.db.wstore_offering.update.assert_called_once_with(
+                {'_id': ObjectId(self.offering.pk)},
+                {'$push': {'comments': {'$each': [rev.pk], '$position': 0}}}
+            )
+            review_manager.Offering.objects.filter.assert_called_once_with(pk=self.offering.pk)
+            review_manager.Offering.objects.filter().update.assert_called_once_with(rating=exp_rating)
+            self.assertFalse(self.offering.save.called)
+
             if not org_comment:
                 self.assertTrue(self.offering.pk in self.user.userprofile.rated_offerings)
                 self.user.userprofile.save.assert_called_once_with()
@@ -418,6 +441,76 @@ class ReviewTestCase(TestCase):
             self.assertTrue(isinstance(excp, err_type))
             self.assertEquals(unicode(excp), err_msg)
 
+    @parameterized.expand([
+        ('first_page', '', '2', RESULT_REVIEWS[:2], True),
+        ('last_page', 'cursor', '2', RESULT_REVIEWS[2:], False),
+        ('invalid_limit', '', '2b', None, False, TypeError, 'Invalid pagination params'),
+        ('negative_limit', '', '-2', None, False, ValueError, 'Limit parameter should be higher than 0')
+    ])
+    def test_get_reviews_page(self, name, cursor, limit, expected_result, has_next, err_type=None, err_msg=None):
+        reviews = [self._create_review_mock(REVIEW1), self._create_review_mock(REVIEW2), self._create_review_mock(REVIEW3)]
+
+        # The cursor of the last page is the one of the second review
+        if cursor:
+            cursor = review_manager.encode_cursor(reviews[1].timestamp, reviews[1].pk)
+            reviews = reviews[2:]
+
+        review_manager.Review = MagicMock()
+        query = MagicMock()
+        review_manager.Review.objects.filter.return_value = query
+        query.filter.return_value = query
+        query.order_by.return_value = reviews
+        review_manager.Q = MagicMock()
+
+        excp = None
+        rm = review_manager.ReviewManager()
+        try:
+            response, next_cursor = rm.get_reviews_page(self.offering, limit, cursor=cursor)
+        except Exception as e:
+            excp = e
+
+        if not err_type:
+            self.assertEquals(excp, None)
+            review_manager.Review.objects.filter.assert_called_once_with(offering=self.offering)
+            query.order_by.assert_called_once_with('-timestamp', '-pk')
+            self.assertEquals(response, expected_result)
+
+            if cursor:
+                # Reviews older than the cursor or with the same timestamp and a lower id
+                timestamp = datetime.strptime(REVIEW2['timestamp'], '%Y-%m-%d %H:%M:%S.%f')
+                self.assertEquals(review_manager.Q.call_args_list[0][1], {'timestamp__lt': timestamp})
+                self.assertEquals(review_manager.Q.call_args_list[1][1], {'timestamp': timestamp, 'pk__lt': REVIEW2['id']})
+            else:
+                self.assertFalse(query.filter.called)
+
+            if has_next:
+                self.assertEquals(review_manager.decode_cursor(next_cursor), [reviews[1].timestamp, reviews[1].pk])
+            else:
+                self.assertEquals(next_cursor, None)
+        else:
+            self.assertTrue(isinstance(excp, err_type))
+            self.assertEquals(unicode(excp), err_msg)
+
+    @parameterized.expand([
+        ('operator', {'$ne': None}, '888888'),
+        ('invalid_timestamp', '2014-04-01 18:02:00.100000', '888888'),
+        ('invalid_id', datetime(2014, 4, 1), 888888)
+    ])
+    def test_get_reviews_page_invalid_cursor(self, name, timestamp, last_id):
+        review_manager.Review = MagicMock()
+
+        excp = None
+        rm = review_manager.ReviewManager()
+        try:
+            rm.get_reviews_page(self.offering, '2', cursor=review_manager.encode_cursor(timestamp, last_id))
+        except Exception as e:
+            excp = e
+
+        # Crafted cursors are rejected before querying the reviews
+        self.assertTrue(isinstance(excp, ValueError))
+        self.assertEquals(unicode(excp), 'Invalid cursor')
+        self.assertFalse(review_manager.Review.objects.filter.return_value.filter.called)
+
     @parameterized.expand([
         (EXAMPLE_REVIEW, '999999', 3.5),
         (EXAMPLE_REVIEW, 999999, 0, None, TypeError, 'The review id must be an string'),
@@ -441,6 +534,8 @@ class ReviewTestCase(TestCase):
         if side_effect:
             side_effect(self, rev_object)
 
+        review_manager.update_rating_aggregate.return_value = exp_rate
+
         # Call the method
         error = None
         try:
@@ -461,9 +556,13 @@ class ReviewTestCase(TestCase):
             rev_object.save.assert_called_once_with()
 
             # Check new offering rating
+            review_manager.update_rating_aggregate.assert_called_once_with(self.offering, add=review_data['rating'], remove=4)
             self.assertEquals(self.offering.rating, exp_rate)
 
-            self.offering.save.assert_called_once_with()
+            # Only the rating is written
+            review_manager.Offering.objects.filter.assert_called_once_with(pk=self.offering.pk)
+            review_manager.Offering.objects.filter().update.assert_called_once_with(rating=exp_rate)
+            self.assertFalse(self.offering.save.called)
         else:
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(unicode(error), err_msg)
@@ -487,6 +586,7 @@ class ReviewTestCase(TestCase):
 
     def _last_review(self, rev):
         self.offering.comments = ['333333']
+        review_manager.update_rating_aggregate.return_value = 0
         self.user.userprofile.is_user_org.return_value = False
         self.org.name = 'test_organization'
         self.org.rated_offerings = [{
@@ -528,6 +628,7 @@ class ReviewTestCase(TestCase):
         rev_object.rating = 3
         review_manager.Review = MagicMock()
         review_manager.Review.objects.get.return_value = rev_object
+        review_manager.update_rating_aggregate.return_value = 4.0
 
         if side_effect:
             side_effect(self, rev_object)
@@ -543,7 +644,13 @@ class ReviewTestCase(TestCase):
         self.assertFalse(error)
         self.assertFalse('333333' in self.offering)
 
-        self.offering.save.assert_called_once_with()
+        review_manager.update_rating_aggregate.assert_called_once_with(self.offering, remove=3)
+        self.db.wstore_offering.update.assert_called_once_with(
+            {'_id': ObjectId(self.offering.pk)},
+            {'$pull': {'comments': '333333'}}
+        )
+        review_manager.Offering.objects.filter().update.assert_called_once_with(rating=self.offering.rating)
+        self.assertFalse(self.offering.save.called)
         rev_object.delete.assert_called_once_with()
         # Check user or organization models
         user_check(self)
@@ -638,3 +745,170 @@ class ReviewTestCase(TestCase):
         else:
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(unicode(error), err_msg)
+
+
+class TopRatedTestCase(TestCase):
+
+    tags = ('reviews',)
+
+    @classmethod
+    def tearDownClass(cls):
+        reload(review_manager)
+        super(TopRatedTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        self.context = MagicMock()
+        self.context.newest = []
+        review_manager.Context = MagicMock()
+        review_manager.Context.objects.all.return_value = [self.context]
+        review_manager.update_feeds = MagicMock()
+
+        self.offerings = {}
+        self.published = []
+        review_manager.Offering = MagicMock()
+        review_manager.Offering.objects.filter.side_effect = self._filter
+
+    def _create_offering(self, pk, rating, state='published'):
+        offering = MagicMock()
+        offering.pk = pk
+        offering.rating = rating
+        offering.state = state
+        self.offerings[pk] = offering
+        return offering
+
+    def _filter(self, pk__in=None, state=None):
+        if pk__in is not None:
+            return [self.offerings[pk] for pk in pk__in if pk in self.offerings]
+
+        query = MagicMock()
+        query.order_by.return_value = self.published
+        return query
+
+    def _fill_top_rated(self):
+        self.context.top_rated = []
+        for i in range(review_manager.TOP_RATED_SIZE):
+            self._create_offering('off' + unicode(i), 5.0 - (i * 0.5))
+            self.context.top_rated.append('off' + unicode(i))
+
+    def test_offering_enters_top_rated(self):
+        self._fill_top_rated()
+        top_rated = list(self.context.top_rated)
+        offering = self._create_offering('new', 4.75)
+
+        review_manager.ReviewManager()._update_top_rated(offering, 0)
+
+        self.assertEquals(self.context.top_rated, top_rated[:1] + ['new'] + top_rated[1:-1])
+        self.context.save.assert_called_once_with()
+        review_manager.update_feeds.assert_called_once_with(self.context, changed=['new'])
+
+    def test_offering_below_threshold(self):
+        self._fill_top_rated()
+        top_rated = list(self.context.top_rated)
+        offering = self._create_offering('new', 1.0)
+
+        review_manager.ReviewManager()._update_top_rated(offering, 0)
+
+        # Nothing changes when the rating does not cross the threshold
+        self.assertEquals(self.context.top_rated, top_rated)
+        self.assertFalse(self.context.save.called)
+        self.assertFalse(review_manager.update_feeds.called)
+
+    def test_offering_moves_in_top_rated(self):
+        self._fill_top_rated()
+        top_rated = list(self.context.top_rated)
+        self.offerings['off3'].rating = 5.0
+
+        review_manager.ReviewManager()._update_top_rated(self.offerings['off3'], 3.5)
+
+        self.assertEquals(self.context.top_rated, ['off0', 'off3'] + top_rated[1:3] + top_rated[4:])
+        self.context.save.assert_called_once_with()
+
+        # Only the published offerings of the list are loaded
+        review_manager.Offering.objects.filter.assert_called_once_with(pk__in=top_rated)
+
+    def test_offering_leaves_top_rated(self):
+        self._fill_top_rated()
+        top_rated = list(self.context.top_rated)
+        self.offerings['off7'].rating = 0.5
+        self.published = [self.offerings[pk] for pk in top_rated[:-1]] + [self._create_offering('other', 1.25)]
+
+        review_manager.ReviewManager()._update_top_rated(self.offerings['off7'], 1.5)
+
+        # The list is completed with the published offerings
+        self.assertEquals(self.context.top_rated, top_rated[:-1] + ['other'])
+        self.context.save.assert_called_once_with()
+        review_manager.update_feeds.assert_called_once_with(self.context, changed=['off7'])
+
+
+class RatingAggregateTestCase(TestCase):
+
+    tags = ('reviews',)
+
+    @classmethod
+    def tearDownClass(cls):
+        reload(rating_aggregate)
+        super(RatingAggregateTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        self.collection = MagicMock()
+        rating_aggregate.get_database_connection = MagicMock()
+        rating_aggregate.get_database_connection.return_value.wstore_offering_rating = self.collection
+
+        self.offering = MagicMock()
+        self.offering.pk = '222222'
+
+    @parameterized.expand([
+        ({'add': 4}, {'sum': 4, 'count': 1, 'histogram.4': 1}),
+        ({'remove': 2}, {'sum': -2, 'count': -1, 'histogram.2': -1}),
+        ({'add': 5, 'remove': 3}, {'sum': 2, 'count': 0, 'histogram.5': 1, 'histogram.3': -1}),
+        ({'add': 3, 'remove': 3}, {'sum': 0, 'count': 0, 'histogram.3': 0})
+    ])
+    def test_update_rating_aggregate(self, change, inc):
+        self.collection.find_and_modify.return_value = {
+            'sum': 7,
+            'count': 2
+        }
+
+        rating = rating_aggregate.update_rating_aggregate(self.offering, **change)
+
+        self.assertEquals(rating, 3.5)
+        self.collection.find_and_modify.assert_called_once_with({'_id': '222222'}, {'$inc': inc}, new=True)
+
+    def test_update_rating_no_reviews(self):
+        self.collection.find_and_modify.return_value = {
+            'sum': 0,
+            'count': 0
+        }
+
+        self.assertEquals(rating_aggregate.update_rating_aggregate(self.offering, remove=2), 0)
+
+    def test_ensure_rating_aggregate(self):
+        self.collection.find_one.return_value = None
+
+        reviews = []
+        for rating in (2, 5, 5):
+            review = MagicMock()
+            review.rating = rating
+            reviews.append(review)
+
+        rating_aggregate.Review = MagicMock()
+        rating_aggregate.Review.objects.filter.return_value = reviews
+
+        rating_aggregate.ensure_rating_aggregate(self.offering)
+
+        rating_aggregate.Review.objects.filter.assert_called_once_with(offering=self.offering)
+        self.collection.insert.assert_called_once_with({
+            '_id': '222222',
+            'sum': 12,
+            'count': 3,
+            'histogram': {'1': 0, '2': 1, '3': 0, '4': 0, '5': 2}
+        })
+
+    def test_ensure_existing_rating_aggregate(self):
+        self.collection.find_one.return_value = {'_id': '222222'}
+        rating_aggregate.Review = MagicMock()
+
+        rating_aggregate.ensure_rating_aggregate(self.offering)
+
+        self.assertFalse(rating_aggregate.Review.objects.filter.called)
+        self.assertFalse(self.collection.insert.called)
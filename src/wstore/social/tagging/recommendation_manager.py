@@ -23,10 +23,10 @@ import json
 import decimal
 from threading import Thread
 from stemming.porter2 import stem
-from whoosh.analysis import StemmingAnalyzer
 
 from wstore.social.tagging.tag_manager import TagManager
 from wstore.search.search_engine import SearchEngine
+from wstore.search.usdl_text import get_stemmed_tokens
 
 
 class RecommendationManager():
@@ -209,7 +209,5 @@ class USDLEntitiesRetrieving(Thread):
         # Get usdl text
         text = se._aggregate_text(self._offering)
 
-        # Get stemmed tokens
-        analyzer = StemmingAnalyzer()
-        named_entities = set([token.text for token in analyzer(unicode(text))])
-        return named_entities
+        # Get stemmed tokens, cached by text hash
+        return get_stemmed_tokens(text)
@@ -369,6 +369,8 @@ class TagViewTestCase(TestCase):
         views.Offering = offering
         views.Organization = Organization
         views.TagManager = tag_manager
+        views.SearchEngine = MagicMock()
+        views.refresh_offering_feeds = MagicMock()
 
         # Create the view
         tag_collection = views.TagCollection(permitted_methods=('GET', 'PUT'))
@@ -388,6 +390,10 @@ class TagViewTestCase(TestCase):
 
         # Check response
         self.assertEqual(response.status_code, code)
+
+        if code == 200:
+            self.assertTrue(views.SearchEngine().update_index.called)
+            self.assertTrue(views.refresh_offering_feeds.called)
         self.assertEqual(parsed_response['message'], response_content)
         self.assertEqual(parsed_response['result'], result)
 
@@ -20,16 +20,20 @@
 
 from __future__ import unicode_literals
 
+import os
 import json
 
 from django.http import HttpResponse
+from django.conf import settings
 
 from wstore.store_commons.utils.http import build_response, authentication_required, supported_request_mime_types
 from wstore.store_commons.resource import Resource
 from wstore.social.tagging.recommendation_manager import RecommendationManager
 from wstore.social.tagging.tag_manager import TagManager
+from wstore.search.search_engine import SearchEngine
 from wstore.models import Offering, Organization
-from wstore.offerings.offerings_management import get_offering_info
+from wstore.offerings.offerings_management import get_offerings_info
+from wstore.offerings.feeds import refresh_offering_feeds
 
 
 class TagCollection(Resource):
@@ -91,6 +95,14 @@ class TagCollection(Resource):
             data = json.loads(request.raw_post_data)
             manager = TagManager()
             manager.update_tags(offering, data['tags'])
+
+            # Update the tags included in the search index
+            index_path = os.path.join(settings.DATADIR, 'search')
+            index_path = os.path.join(index_path, 'indexes')
+            SearchEngine(index_path).update_index(offering, deferred=True)
+
+            # The tags are included in the offering feeds
+            refresh_offering_feeds(offering)
         except Exception, e:
             return build_response(request, 400, e.message)
 
@@ -157,8 +169,7 @@ class SearchTagEntry(Resource):
 
                 response = []
                 # Get offering info
-                for off in offerings:
-                    offering_info = get_offering_info(off, request.user)
+                for offering_info in get_offerings_info(offerings, request.user):
 
                     if not state and offering_info['state'] != 'published'\
                     and offering_info['state'] != 'purchased' and offering_info['state'] != 'rated':
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import os
+import threading
+from pymongo import MongoClient
+
+from django.conf import settings
+
+
+# Options of django_mongodb_engine that are not MongoClient options
+_ENGINE_OPTIONS = ('operations',)
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_authenticated = set()
+
+
+def _get_client_params():
+    """
+    Get the host, port and options of the client from the default
+    database settings. OPTIONS such as REPLICASET or MAX_POOL_SIZE are
+    passed to the client the same way django_mongodb_engine does
+    """
+    db_settings = settings.DATABASES['default']
+
+    host = db_settings.get('HOST') or 'localhost'
+    port = int(db_settings.get('PORT') or 27017)
+
+    options = {}
+    for option, value in db_settings.get('OPTIONS', {}).iteritems():
+        if not option.lower() in _ENGINE_OPTIONS:
+            options[str(option.lower())] = value
+
+    return host, port, options
+
+
+def get_client():
+    """
+    Returns the MongoClient of the current process. The client is created
+    the first time it is needed and created again after a fork, since the
+    sockets of its pool cannot be shared between processes
+    """
+    global _client, _client_pid
+
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            host, port, options = _get_client_params()
+
+            _client = MongoClient(host, port, **options)
+            _client_pid = os.getpid()
+            _authenticated.clear()
+
+        return _client
+
+
+def get_database_connection():
+    """
+    Returns the WStore database for raw access using the shared client
+    """
+    db_settings = settings.DATABASES['default']
+
+    # The name is read in each call since it is changed when testing
+    db_name = db_settings['NAME']
+    db = get_client()[db_name]
+
+    if db_settings.get('USER') and not db_name in _authenticated:
+        db.authenticate(db_settings['USER'], db_settings.get('PASSWORD', ''))
+        _authenticated.add(db_name)
+
+    return db
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+from wstore.store_commons.database import get_database_connection
+
+
+# Indexes required by the hot query shapes, declared as the raw collection,
+# the list of (field, direction) keys of the index and optionally the
+# options used for creating it
+INDEXES = (
+    ('wstore_offering', [('owner_organization_id', ASCENDING), ('name', ASCENDING), ('version', ASCENDING)]),
+    ('wstore_offering', [('owner_organization_id', ASCENDING), ('creation_date', DESCENDING), ('_id', DESCENDING)]),
+    ('wstore_offering', [('owner_organization_id', ASCENDING), ('state', ASCENDING), ('creation_date', DESCENDING), ('_id', DESCENDING)]),
+    ('wstore_offering', [('state', ASCENDING), ('publication_date', DESCENDING), ('_id', DESCENDING)]),
+    ('wstore_offering', [('state', ASCENDING), ('rating', DESCENDING), ('_id', DESCENDING)]),
+    ('wstore_offering', [('state', ASCENDING), ('name', ASCENDING), ('_id', ASCENDING)]),
+    ('wstore_offering', [('description_url', ASCENDING)]),
+    ('wstore_offering', [('tags', ASCENDING)]),
+    ('wstore_purchase', [('offering_id', ASCENDING), ('owner_organization_id', ASCENDING)]),
+    ('wstore_purchase', [('customer_id', ASCENDING), ('offering_id', ASCENDING), ('organization_owned', ASCENDING)]),
+    ('wstore_purchase', [('ref', ASCENDING)]),
+    ('wstore_resource', [('provider_id', ASCENDING), ('name', ASCENDING), ('version', ASCENDING)]),
+    ('wstore_review', [('offering_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ('charging_engine_contract', [('purchase_id', ASCENDING)]),
+    ('charging_engine_contract', [('oldest_pending_ts', ASCENDING)]),
+    ('charging_engine_servicerecord', [('contract_id', ASCENDING), ('correlation_number', ASCENDING)], {'unique': True}),
+    ('wstore_cdr_outbox', [('next_attempt', ASCENDING), ('state', ASCENDING)]),
+    ('wstore_cdr_outbox', [('rss', ASCENDING), ('correlation', ASCENDING)]),
+    ('wstore_invoice_job', [('next_attempt', ASCENDING), ('state', ASCENDING)]),
+    ('wstore_invoice_job', [('name', ASCENDING)]),
+)
+
+
+# Catalogue of the hot query shapes checked using explain, declared as a
+# name, the raw collection, a sample query and the sorting if any. The
+# values are only used for building the query plans
+QUERY_CATALOGUE = (
+    ('offering by owner, name and version', 'wstore_offering', {
+        'owner_organization_id': ObjectId(),
+        'name': 'name',
+        'version': '1.0'
+    }, None),
+    ('offerings by owner', 'wstore_offering', {
+        'owner_organization_id': ObjectId()
+    }, [('creation_date', DESCENDING), ('_id', DESCENDING)]),
+    ('offerings by owner and state', 'wstore_offering', {
+        'owner_organization_id': ObjectId(),
+        'state': 'uploaded'
+    }, [('creation_date', DESCENDING), ('_id', DESCENDING)]),
+    ('published offerings by date', 'wstore_offering', {
+        'state': 'published'
+    }, [('publication_date', DESCENDING), ('_id', DESCENDING)]),
+    ('published offerings by popularity', 'wstore_offering', {
+        'state': 'published'
+    }, [('rating', DESCENDING), ('_id', DESCENDING)]),
+    ('published offerings by name', 'wstore_offering', {
+        'state': 'published'
+    }, [('name', ASCENDING), ('_id', ASCENDING)]),
+    ('offering by description url', 'wstore_offering', {
+        'description_url': 'http://localhost/usdl'
+    }, None),
+    ('offerings by tag', 'wstore_offering', {
+        'tags': 'tag'
+    }, None),
+    ('purchase by offering and organization', 'wstore_purchase', {
+        'offering_id': ObjectId(),
+        'owner_organization_id': ObjectId()
+    }, None),
+    ('purchase by customer and offering', 'wstore_purchase', {
+        'customer_id': ObjectId(),
+        'offering_id': ObjectId(),
+        'organization_owned': False
+    }, None),
+    ('purchase by reference', 'wstore_purchase', {
+        'ref': 'reference'
+    }, None),
+    ('resource by provider, name and version', 'wstore_resource', {
+        'provider_id': ObjectId(),
+        'name': 'name',
+        'version': '1.0'
+    }, None),
+    ('reviews by offering', 'wstore_review', {
+        'offering_id': ObjectId()
+    }, [('timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ('contract by purchase', 'charging_engine_contract', {
+        'purchase_id': ObjectId()
+    }, None),
+    ('contracts with due pending sdrs', 'charging_engine_contract', {
+        'oldest_pending_ts': {'$lte': datetime.now()},
+        'pricing_model.subscription': {'$exists': False}
+    }, [('oldest_pending_ts', ASCENDING)]),
+    ('sdrs of a contract', 'charging_engine_servicerecord', {
+        'contract_id': ObjectId(),
+        'correlation_number': {'$gt': 0}
+    }, [('correlation_number', ASCENDING)]),
+    ('due cdrs of the outbox', 'wstore_cdr_outbox', {
+        'state': {'$in': ['pending', 'sending']},
+        'next_attempt': {'$lte': datetime.now()}
+    }, [('next_attempt', ASCENDING)]),
+    ('cdr of the outbox by correlation', 'wstore_cdr_outbox', {
+        'rss': 'rss',
+        'correlation': 0
+    }, None),
+    ('due invoice jobs', 'wstore_invoice_job', {
+        'state': {'$in': ['pending', 'rendering']},
+        'next_attempt': {'$lte': datetime.now()}
+    }, [('next_attempt', ASCENDING)]),
+    ('invoice job by name', 'wstore_invoice_job', {
+        'name': 'name'
+    }, None),
+)
+
+
+def ensure_indexes(db=None, background=True):
+    """
+    Creates the declared indexes that do not exist yet, returns the
+    names of the ensured indexes
+    """
+    if db is None:
+        db = get_database_connection()
+
+    names = []
+    for index in INDEXES:
+        collection, keys = index[:2]
+        options = dict(index[2]) if len(index) > 2 else {}
+
+        names.append(db[collection].create_index(keys, background=background, **options))
+
+    return names
+
+
+def _get_plan_problems(plan):
+    """
+    Returns the problems of a query plan, collection scans and sorts
+    performed in memory. Both the MongoDB 2.x explain format and the
+    query planner format of newer versions are supported
+    """
+    problems = []
+
+    if 'cursor' in plan:
+        if plan['cursor'].startswith('BasicCursor'):
+            problems.append('collection scan')
+
+        if plan.get('scanAndOrder'):
+            problems.append('in memory sort')
+
+        return problems
+
+    stages = [plan.get('queryPlanner', {}).get('winningPlan', {})]
+    while len(stages):
+        stage = stages.pop()
+
+        if stage.get('stage') == 'COLLSCAN':
+            problems.append('collection scan')
+
+        if stage.get('stage') == 'SORT':
+            problems.append('in memory sort')
+
+        if 'inputStage' in stage:
+            stages.append(stage['inputStage'])
+
+        stages.extend(stage.get('inputStages', []))
+
+    return problems
+
+
+def check_indexes(db=None):
+    """
+    Explains the queries of the catalogue, returns a list with the name
+    and the problems of the queries that are not fully served by an index
+    """
+    if db is None:
+        db = get_database_connection()
+
+    missing = []
+    for name, collection, query, sort in QUERY_CATALOGUE:
+        cursor = db[collection].find(query)
+
+        if sort is not None:
+            cursor = cursor.sort(sort)
+
+        problems = _get_plan_problems(cursor.explain())
+        if len(problems):
+            missing.append((name, problems))
+
+    return missing
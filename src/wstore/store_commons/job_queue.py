@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+
+from wstore.store_commons.database import get_database_connection
+
+
+logger = logging.getLogger('wstore.store_commons.job_queue')
+
+PENDING = 'pending'
+FAILED = 'failed'
+
+
+class JobQueue():
+    """
+    Queue of jobs persisted in a collection. Jobs are leased by the worker
+    processing them, so the jobs claimed by a dead process are due again
+    when their lease expires. Finished jobs are removed, while failed ones
+    are scheduled again with an exponential backoff and kept as failed once
+    they reach the maximum number of attempts
+    """
+
+    def __init__(self, collection, leased_state, lease_time, max_retry_delay=3600, fields=None):
+        self._collection = collection
+        self.leased_state = leased_state
+        self._lease_time = lease_time
+        self._max_retry_delay = max_retry_delay
+        # Projection of the jobs returned when inspecting the queue
+        self._fields = fields
+
+    def get_collection(self):
+        return get_database_connection()[self._collection]
+
+    def get_initial_fields(self, now=None):
+        """
+        Returns the fields of a new job, due immediately
+        """
+        if now is None:
+            now = datetime.now()
+
+        return {
+            'state': PENDING,
+            'attempts': 0,
+            'next_attempt': now,
+            'created': now,
+            'last_error': None
+        }
+
+    def claim(self, limit=1, group_by=None):
+        """
+        Leases the next due job and, if limit is greater than one, other
+        due jobs with its value of the group_by field. Returns the leased
+        jobs, an empty list if there are not due jobs
+        """
+        collection = self.get_collection()
+        now = datetime.now()
+
+        due = {
+            'state': {'$in': [PENDING, self.leased_state]},
+            'next_attempt': {'$lte': now}
+        }
+        lease = {
+            '$set': {
+                'state': self.leased_state,
+                'next_attempt': now + timedelta(seconds=self._lease_time),
+                'lease': ObjectId()
+            }
+        }
+
+        first = collection.find_and_modify(query=due, update=lease, sort=[('next_attempt', ASCENDING)], new=True)
+
+        if first is None:
+            return []
+
+        if limit == 1:
+            return [first]
+
+        query = dict(due)
+        if group_by is not None:
+            query[group_by] = first[group_by]
+
+        cursor = collection.find(query, {'_id': True}).sort('next_attempt', ASCENDING).limit(limit - 1)
+        ids = [doc['_id'] for doc in cursor]
+
+        if len(ids):
+            # The due condition is included so jobs claimed by
+            # other worker in the meantime are not taken
+            query['_id'] = {'$in': ids}
+            collection.update(query, lease, multi=True)
+
+        return list(collection.find({'lease': first['lease']}))
+
+    def complete(self, jobs):
+        """
+        Removes a list of jobs leased together
+        """
+        self.get_collection().remove({'lease': jobs[0]['lease']})
+
+    def fail(self, jobs, error, max_attempts, retry_delay):
+        """
+        Releases a list of jobs leased together whose processing has failed,
+        scheduling them again or marking them as failed
+        """
+        collection = self.get_collection()
+        leased = {'lease': jobs[0]['lease']}
+
+        attempts = max([job['attempts'] for job in jobs]) + 1
+        delay = min(retry_delay * (2 ** (attempts - 1)), self._max_retry_delay)
+
+        # Jobs that have reached the maximum number of attempts are kept
+        # as failed so they can be inspected and retried
+        collection.update(dict(leased, attempts={'$gte': max_attempts - 1}), {
+            '$inc': {'attempts': 1},
+            '$set': {'state': FAILED, 'last_error': error},
+            '$unset': {'lease': ''}
+        }, multi=True)
+
+        collection.update(leased, {
+            '$inc': {'attempts': 1},
+            '$set': {
+                'state': PENDING,
+                'next_attempt': datetime.now() + timedelta(seconds=delay),
+                'last_error': error
+            },
+            '$unset': {'lease': ''}
+        }, multi=True)
+
+    def get_stats(self, group_by=None):
+        """
+        Returns the number of jobs in each state and the creation date of
+        the oldest unfinished job. If group_by is provided the number of
+        unfinished jobs of each value of the field is included using it
+        as key
+        """
+        collection = self.get_collection()
+        unfinished = {'state': {'$in': [PENDING, self.leased_state]}}
+
+        stats = {}
+        for state in (PENDING, self.leased_state, FAILED):
+            stats[state] = collection.find({'state': state}).count()
+
+        oldest = list(collection.find(unfinished, self._fields).sort('created', ASCENDING).limit(1))
+        stats['oldest'] = oldest[0]['created'] if len(oldest) else None
+
+        if group_by is not None:
+            stats[group_by] = {}
+            for value in collection.distinct(group_by):
+                stats[group_by][value] = collection.find(dict(unfinished, **{group_by: value})).count()
+
+        return stats
+
+    def get_failed(self, limit=20):
+        """
+        Returns the jobs that reached the maximum number of attempts
+        """
+        return list(self.get_collection().find({'state': FAILED}, self._fields).sort('created', ASCENDING).limit(limit))
+
+    def retry_failed(self):
+        """
+        Schedules the failed jobs to be processed again, returns the
+        number of scheduled jobs
+        """
+        result = self.get_collection().update({'state': FAILED}, {
+            '$set': {
+                'state': PENDING,
+                'attempts': 0,
+                'next_attempt': datetime.now()
+            }
+        }, multi=True)
+
+        return result['n']
+
+
+class Worker(threading.Thread):
+    """
+    Background thread processing the due jobs of a worker pool
+    """
+
+    _pool = None
+
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._pool = pool
+
+    def run(self):
+        while True:
+            self._pool.wait_work()
+            self._pool.drain()
+
+
+class WorkerPool():
+    """
+    Bounded pool of workers processing the jobs of a queue. Workers are
+    woken up when new jobs are enqueued and poll the queue periodically,
+    so jobs waiting for a retry or left by a dead process are processed.
+    Subclasses implement process
+    """
+
+    _threads = None
+    _condition = None
+    _pid = None
+
+    def __init__(self, workers=2, poll_interval=10):
+        self._workers = workers
+        self._poll_interval = poll_interval
+        self._threads = []
+        self._condition = threading.Condition()
+        self._pending = 0
+
+    def _ensure_workers(self):
+        # Threads are not inherited by forked processes
+        if self._pid != os.getpid():
+            self._threads = []
+            self._pid = os.getpid()
+
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+
+        while len(self._threads) < self._workers:
+            thread = Worker(self)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake_up(self):
+        """
+        Notify a worker that there is a new job in the queue
+        """
+        with self._condition:
+            self._ensure_workers()
+            self._pending += 1
+            self._condition.notify()
+
+    def wait_work(self):
+        """
+        Block until a new job is enqueued or the poll interval expires
+        """
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(self._poll_interval)
+
+            self._pending = max(self._pending - 1, 0)
+
+    def process(self):
+        """
+        Claims and processes due jobs, returns the number of processed
+        jobs or None if there are not due jobs
+        """
+        raise NotImplementedError()
+
+    def drain(self):
+        """
+        Process due jobs until the queue has not due jobs, returns
+        the number of processed jobs
+        """
+        processed = 0
+
+        while True:
+            try:
+                count = self.process()
+            except:
+                logger.exception('Error draining the queue of %s' % self.__class__.__name__)
+                break
+
+            if count is None:
+                break
+
+            processed += count
+
+        return processed
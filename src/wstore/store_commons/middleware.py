@@ -289,7 +289,9 @@ class ConditionalGetMiddleware(object):
     """
     def process_response(self, request, response):
         response['Date'] = http_date()
-        if not response.has_header('Content-Length'):
+
+        # The length of streamed responses is not known in advance
+        if not getattr(response, 'streaming', False) and not response.has_header('Content-Length'):
             response['Content-Length'] = str(len(response.content))
 
         if response.has_header('ETag'):
@@ -300,7 +302,9 @@ class ConditionalGetMiddleware(object):
                 # http.conditional_content_removal()).
                 response.status_code = 304
 
-        if response.has_header('Last-Modified'):
+        # If-Modified-Since is ignored when the request includes If-None-Match,
+        # ETags may depend on the user while Last-Modified does not
+        if response.has_header('Last-Modified') and not (response.has_header('ETag') and 'HTTP_IF_NONE_MATCH' in request.META):
             if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
             if if_modified_since is not None:
                 try:
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from wstore.store_commons.job_queue import PENDING, FAILED
+
+
+def get_inspect_options(jobs_name, action):
+    """
+    Returns the options of a command inspecting a queue of jobs
+    """
+    return (
+        make_option('--retry-failed',
+            action='store_true',
+            dest='retry_failed',
+            default=False,
+            help='Schedule the %s that reached the maximum number of attempts to be %s again' % (jobs_name, action)),
+        make_option('--flush',
+            action='store_true',
+            dest='flush',
+            default=False,
+            help='Process the due %s in this process before showing the queue' % jobs_name),
+        make_option('--limit',
+            action='store',
+            type='int',
+            dest='limit',
+            default=20,
+            help='Maximum number of failed %s shown' % jobs_name),
+    )
+
+
+class InspectQueueCommand(BaseCommand):
+    """
+    Base command showing the jobs of a queue. Subclasses provide the
+    queue, the worker pool and the descriptions of the jobs
+    """
+
+    # Plural name of the jobs and the past participle of their processing
+    jobs_name = 'jobs'
+    action = 'processed'
+    # Label of the jobs being processed and of the oldest unfinished job
+    leased_label = 'Processing'
+    oldest_label = 'Oldest unfinished job'
+    # Field used for counting the unfinished jobs of each value
+    group_by = None
+
+    def get_queue(self):
+        raise NotImplementedError()
+
+    def get_pool(self):
+        raise NotImplementedError()
+
+    def describe_group(self, value, count):
+        return '%s %s: %d unfinished %s' % (self.group_by, value, count, self.jobs_name)
+
+    def describe_failed(self, job):
+        return 'Failed job %s after %d attempts: %s' % (job['_id'], job['attempts'], job['last_error'])
+
+    def handle(self, *args, **options):
+        queue = self.get_queue()
+
+        if options.get('retry_failed'):
+            self.stdout.write('%d failed %s scheduled again.\n' % (queue.retry_failed(), self.jobs_name))
+
+        if options.get('flush'):
+            self.stdout.write('%d %s %s.\n' % (self.get_pool().drain(), self.jobs_name, self.action))
+
+        stats = queue.get_stats(group_by=self.group_by)
+
+        self.stdout.write('Pending: %d\n' % stats[PENDING])
+        self.stdout.write('%s: %d\n' % (self.leased_label, stats[queue.leased_state]))
+        self.stdout.write('Failed: %d\n' % stats[FAILED])
+
+        if stats['oldest'] is not None:
+            self.stdout.write('%s created at %s\n' % (self.oldest_label, stats['oldest']))
+
+        if self.group_by is not None:
+            for value, count in stats[self.group_by].iteritems():
+                if count:
+                    self.stdout.write(self.describe_group(value, count) + '\n')
+
+        if stats[FAILED]:
+            for job in queue.get_failed(options.get('limit') or 20):
+                self.stdout.write(self.describe_failed(job) + '\n')
@@ -20,6 +20,7 @@
 
 from __future__ import unicode_literals
 
+import json
 import rdflib
 from mock import MagicMock
 from nose_parameterized import parameterized
@@ -29,6 +30,9 @@ from django.contrib.sites.models import Site
 
 from wstore.store_commons.utils.usdlParser import USDLParser, validate_usdl
 from wstore.store_commons.utils import usdlParser
+from wstore.store_commons.utils.http import stream_json_list
+from wstore.store_commons import database
+from wstore.store_commons import indexes
 from wstore.models import Organization, Context
 
 __test__ = False
@@ -626,3 +630,118 @@ class PriceFunctionParsingTestCase(TestCase):
 
             self.assertTrue(error)
             self.assertEquals(msg, 'Invalid price function: ' + error_messages[i])
+
+
+class StreamJSONTestCase(TestCase):
+
+    tags = ('http-utils',)
+
+    @parameterized.expand([
+        ([],),
+        ([{'name': 'offering1'}],),
+        ([{'name': 'offering' + unicode(i)} for i in range(5)],),
+        ([{'name': 'offering' + unicode(i)} for i in range(6)],)
+    ])
+    def test_stream_json_list(self, items):
+        chunks = list(stream_json_list(iter(items), chunk_size=3))
+
+        self.assertEquals(json.loads(''.join(chunks)), items)
+        # Opening bracket, encoded chunks and closing bracket
+        self.assertEquals(len(chunks), 2 + (len(items) + 2) / 3)
+
+
+class DatabaseConnectionTestCase(TestCase):
+
+    tags = ('database',)
+
+    def setUp(self):
+        database.MongoClient = MagicMock()
+        database.settings = MagicMock()
+        database.settings.DATABASES = {
+            'default': {
+                'NAME': 'test_db',
+                'HOST': 'mongo1.example.com',
+                'PORT': '27018',
+                'OPTIONS': {
+                    'REPLICASET': 'rs0',
+                    'MAX_POOL_SIZE': 50,
+                    'OPERATIONS': {}
+                }
+            }
+        }
+
+    def tearDown(self):
+        reload(database)
+
+    def test_shared_client(self):
+        db = database.get_database_connection()
+
+        client = database.MongoClient.return_value
+        database.MongoClient.assert_called_once_with('mongo1.example.com', 27018, replicaset='rs0', max_pool_size=50)
+        client.__getitem__.assert_called_once_with('test_db')
+        self.assertEquals(db, client.__getitem__.return_value)
+
+        # The client is reused
+        database.get_database_connection()
+        self.assertEquals(database.MongoClient.call_count, 1)
+
+    def test_client_created_after_fork(self):
+        client = database.get_client()
+        self.assertTrue(client is database.get_client())
+
+        # Simulate a forked process
+        database._client_pid = -1
+        database.get_client()
+        self.assertEquals(database.MongoClient.call_count, 2)
+
+
+class IndexProvisioningTestCase(TestCase):
+
+    tags = ('database',)
+
+    def setUp(self):
+        self.db = MagicMock()
+        self.collections = {}
+        self.db.__getitem__.side_effect = self._get_collection
+
+    def _get_collection(self, name):
+        if not name in self.collections:
+            self.collections[name] = MagicMock(name=name)
+        return self.collections[name]
+
+    def test_ensure_indexes(self):
+        indexes.ensure_indexes(db=self.db)
+
+        calls = 0
+        for index in indexes.INDEXES:
+            collection, keys = index[:2]
+            options = {'background': True}
+            if len(index) > 2:
+                options.update(index[2])
+
+            self.assertTrue(((keys,), options) in self.collections[collection].create_index.call_args_list)
+            calls += 1
+
+        # The SDRs of a contract are unique by correlation number
+        self.collections['charging_engine_servicerecord'].create_index.assert_called_once_with(
+            [('contract_id', 1), ('correlation_number', 1)], background=True, unique=True)
+
+        self.assertEquals(sum([col.create_index.call_count for col in self.collections.values()]), calls)
+
+    @parameterized.expand([
+        ('btree', {'cursor': 'BtreeCursor state_1_rating_-1__id_-1', 'scanAndOrder': False}, []),
+        ('basic', {'cursor': 'BasicCursor'}, ['collection scan']),
+        ('scan_and_order', {'cursor': 'BtreeCursor state_1', 'scanAndOrder': True}, ['in memory sort']),
+        ('ixscan', {'queryPlanner': {'winningPlan': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}}}, []),
+        ('collscan', {'queryPlanner': {'winningPlan': {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}}}, ['in memory sort', 'collection scan'])
+    ])
+    def test_check_indexes(self, name, plan, problems):
+        self._get_collection('wstore_offering').find.return_value.explain.return_value = plan
+        self._get_collection('wstore_offering').find.return_value.sort.return_value.explain.return_value = plan
+
+        missing = [query for query in indexes.check_indexes(db=self.db) if query[0] == 'offering by description url']
+
+        if len(problems):
+            self.assertEquals(missing, [('offering by description url', problems)])
+        else:
+            self.assertEquals(missing, [])
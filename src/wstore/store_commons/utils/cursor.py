@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Values accepted in a cursor when their types are not given
+_SCALAR_TYPES = (unicode, int, long, float, Decimal, datetime, ObjectId)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'$date': value.strftime(_DATE_FORMAT)}
+
+    if isinstance(value, ObjectId):
+        return {'$oid': unicode(value)}
+
+    if isinstance(value, Decimal):
+        return {'$decimal': unicode(value)}
+
+    raise TypeError('Invalid cursor value')
+
+
+def _decode_value(obj):
+    if '$date' in obj:
+        return datetime.strptime(obj['$date'], _DATE_FORMAT)
+
+    if '$oid' in obj:
+        return ObjectId(obj['$oid'])
+
+    if '$decimal' in obj:
+        return Decimal(obj['$decimal'])
+
+    return obj
+
+
+def encode_cursor(*values):
+    """
+    Builds an opaque pagination cursor containing the sort values
+    of the last element of a page
+    """
+    return urlsafe_b64encode(json.dumps(list(values), default=_encode_value))
+
+
+def decode_cursor(cursor, types=None):
+    """
+    Returns the sort values included in a pagination cursor, raises
+    a ValueError if the cursor is not valid. The types of each value
+    can be given as a sequence of classes or tuples of classes, by
+    default the cursor includes two scalar values
+    """
+    if types is None:
+        types = (_SCALAR_TYPES, _SCALAR_TYPES)
+
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode('ascii')), object_hook=_decode_value)
+    except (TypeError, ValueError, UnicodeError, InvalidId, InvalidOperation):
+        # Values crafted in the cursor are reported as an invalid cursor
+        raise ValueError('Invalid cursor')
+
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError('Invalid cursor')
+
+    # Values are used in queries, so objects, lists or values of other
+    # types than the sort field are rejected. Booleans are never valid
+    # although they are integers
+    for value, value_types in zip(values, types):
+        if isinstance(value, bool) or not isinstance(value, value_types):
+            raise ValueError('Invalid cursor')
+
+    return values
@@ -18,6 +18,7 @@
 # along with WStore.  
 # If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
 
+import json
 import socket
 from urlparse import urljoin
 from xml.dom.minidom import getDOMImplementation
@@ -29,6 +30,16 @@ from django.core.urlresolvers import reverse
 from django.http import HttpResponse
 from django.utils.translation import ugettext as _
 
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    class StreamingHttpResponse(HttpResponse):
+        """
+        Response whose content is an iterator. Django versions older than 1.5
+        stream the content of HttpResponse objects created with an iterator
+        """
+        streaming = True
+
 from wstore.store_commons.utils.error_response import get_json_response, get_xml_response, get_unicode_response
 from wstore.store_commons.utils import mimeparser
 
@@ -141,3 +152,26 @@ def get_absolute_static_url(url, request=None):
     scheme = get_current_scheme()
     base = urljoin(scheme + '://' + get_current_domain(request), settings.STATIC_URL)
     return urljoin(base, url)
+
+
+def stream_json_list(items, chunk_size=20):
+    """
+    Encodes an iterable as a JSON list yielding the encoded items in
+    chunks, so the complete list is never kept in memory
+    """
+    yield '['
+
+    separator = ''
+    chunk = []
+    for item in items:
+        chunk.append(json.dumps(item))
+
+        if len(chunk) == chunk_size:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk = []
+
+    if len(chunk):
+        yield separator + ','.join(chunk)
+
+    yield ']'
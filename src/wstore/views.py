@@ -37,6 +37,7 @@ from wstore.store_commons.resource import Resource as API_Resource
 from wstore.models import UserProfile, Organization
 from wstore.models import Purchase, Resource, Offering
 from wstore.offerings.offerings_management import get_offering_info
+from wstore.charging_engine.invoice_queue import get_invoice_job
 
 
 MAIN_PORTAL_URL = "http://help.lab.fi-ware.org/"
@@ -308,6 +309,10 @@ class ServeMedia(API_Resource):
         local_path = os.path.join(dir_path, name)
 
         if not os.path.isfile(local_path):
+            # The PDF of an invoice is not available until its job finishes
+            if dir_path.endswith('bills') and name.endswith('.pdf') and get_invoice_job(name[:-4]) is not None:
+                return build_response(request, 503, 'The invoice is being generated', headers={'Retry-After': '10'})
+
             return build_response(request, 404, 'Not found')
 
         if not getattr(settings, 'USE_XSENDFILE', False):